@@ -0,0 +1,20 @@
+from .BaseApi import BaseHandler
+
+class ApiMetrics(BaseHandler):
+    """
+    The counters and timings of the filtering engines, as json, or in the
+        Prometheus text format with ?format=prometheus or an Accept header
+        asking for text/plain
+    """
+    def initialize(self, db, metrics):
+        super(ApiMetrics, self).initialize(db)
+        self.metrics = metrics
+
+    def get(self):
+        accept = self.request.headers.get("Accept", "")
+        if self.get_argument("format", None) == "prometheus" or ("text/plain" in accept and "application/json" not in accept):
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(self.metrics.prometheus())
+        else:
+            self.write(self.render_object(self.metrics.snapshot()))
+        self.finish()
@@ -4,9 +4,10 @@ The base class from which most (all? other api handlers will inherit)
 from tornado.web import RequestHandler
 import tornado
 import json
+from handlers.RequestAccounting import RequestAccounting
 
 
-class BaseHandler(RequestHandler):
+class BaseHandler(RequestAccounting, RequestHandler):
     """
     """
     def get_current_user(self):
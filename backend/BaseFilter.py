@@ -0,0 +1,311 @@
+"""
+The base class from which the collaborative filtering engines inherit
+"""
+
+
+import databases.database as databases
+from backend.Metrics import METRICS
+from backend.OpinionMatrix import OpinionMatrix
+from backend.utils import ReadWriteLock
+import numpy as np
+
+class BaseFilter(object):
+    """
+    The parts shared by every filtering engine: the opinion matrix, access to
+    the database, and the batch prediction api.  Engines implement
+    predictOpinion, changeOpinion and _predictedRatings.
+    """
+
+    def __init__(self, name, path, table, debug=False, cache=True, db=None, opinions=None, metrics=None):
+        """
+        Initilialies the filter with the values
+
+        Arguments:
+            name  -> the name of the database file
+            path  -> the path to the database file (an sqlalchemy database url)
+            table -> the name of the table in the database file
+            debug -> activates debug mode, providing additional outputs and
+                     information about what is happening
+            cache -> used for testing, to compare between the caches being used
+                     and a normal, cache free version both for benchmarking and
+                     for error checking
+            db    -> an already open databases.database.Database, used instead
+                     of opening name/path when provided
+            opinions -> an OpinionMatrix to use instead of loading one from
+                        the database, such as one from a snapshot
+            metrics  -> the backend.Metrics.Metrics to record what the
+                        engine does in, the shared METRICS by default
+        """
+
+        self.name = name
+        self.path = path
+        self.table = table
+        self.debug = debug
+        self.cache = cache
+        self.db = db if db is not None else databases.Database(self.name, self.path)
+        self.metrics = METRICS if metrics is None else metrics
+
+        #implemented as a csr matrix of users x items, bulk loaded from the opinions table
+        #opinions are 1-5, with 0 meaning the user has no opinion
+        self.opinions = OpinionMatrix.fromDatabase(self.db) if opinions is None else opinions
+        #held for reading by predictions and for writing by changes to the opinions, so any number of predictions
+        #run at once and a change is never seen half made
+        self.lock = ReadWriteLock()
+
+
+    def items(self):
+        """
+        Returns the items in the matrix
+
+        Return -> the list of items
+        """
+        return self.opinions.items()
+
+    def users(self):
+        """
+        Returns the users in the database
+
+        Return -> The users as a list
+        """
+        return self.opinions.users()
+
+    def fetchOpinion(self, user, item): #done
+        """
+        Directly fetches an opinion from the database
+
+        Arguments:
+            user -> the user who has an opinion
+            item -> the item of which they have an opinion
+
+        Return -> a value representing the user's opinion of the item, or none if the user has no opinion
+        """
+
+        self.metrics.count("db_queries", operation="fetch")
+        with self.db.session_scope() as session:
+            try:
+                return self.db.fetch_opinion(session, user, item).rating
+            except databases.ItemDoesNotExistError:
+                return None
+
+
+    def fetchOpinions(self, user, items=None):
+        """
+        Directly fetches a user's opinions from the database, in one query
+
+        Arguments:
+            user  -> the user who has the opinions
+            items -> the items to fetch the user's opinions of, None for every item they have an opinion of
+
+        Return -> map(item->opinion) of the opinions the user has
+        """
+
+        self.metrics.count("db_queries", operation="fetch user")
+        with self.db.session_scope() as session:
+            return self.db.fetch_user_opinions(session, user, items)
+
+
+    def fetchProfile(self, user):
+        """
+        Directly fetches a user's profile from the database, added up by the database instead of fetching every
+            opinion
+
+        Arguments:
+            user -> the user whose profile it is
+
+        Return -> tuple(count, sum, squares) of the user's opinions
+        """
+
+        self.metrics.count("db_queries", operation="fetch profile")
+        with self.db.session_scope() as session:
+            return self.db.fetch_user_profile(session, user)
+
+
+    def fetchFingerprint(self):
+        """
+        Directly fetches the fingerprint of every opinion in the database, see
+            databases.database.Database.fetch_opinions_fingerprint
+
+        Return -> tuple(count, sum, user sum, item sum) of the opinions
+        """
+
+        self.metrics.count("db_queries", operation="fetch fingerprint")
+        with self.db.session_scope() as session:
+            return self.db.fetch_opinions_fingerprint(session)
+
+
+    def storeOpinion(self, user, item, opinion):
+        """
+        Directly writes an opinion to the database
+
+        Arguments:
+            user    -> the user who has an opinion
+            item    -> the item of which they have an opinion
+            opinion -> the new opinion, 0 or None removes it
+
+        Return -> None
+        """
+
+        self.metrics.count("db_queries", operation="store")
+        with self.db.session_scope() as session:
+            if not opinion:
+                self.db.remove_opinion(session, user, item)
+            else:
+                self.db.upsert_opinion(session, user, item, opinion)
+
+
+    def storeOpinions(self, changes):
+        """
+        Writes many opinions to the database in a single transaction
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion), an opinion of 0 or None removes it, each opinion
+                       changed at most once
+
+        Return -> None
+        """
+
+        self.metrics.count("db_queries", operation="store many")
+        with self.db.session_scope() as session:
+            self.db.change_opinions(session, changes)
+
+
+    @staticmethod
+    def _latestChanges(changes):
+        """
+        Keeps only the last change to each opinion
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion)
+
+        Return -> a list of tuple(user, item, opinion), in the order each opinion was first changed
+        """
+
+        latest = {}
+        for user, item, opinion in changes:
+            latest[(user, item)] = opinion
+        return [(user, item, opinion) for (user, item), opinion in latest.items()]
+
+
+    def predictOpinion(self, user, item):
+        """
+        Calculates a user's opinion of an item
+
+        Arguments:
+            user -> the user whose opinion is to be calculated
+            item -> the item of which the user has an unknown opinion
+
+        Return -> the opinion that a user should have for an item
+        """
+        raise NotImplementedError
+
+
+    def changeOpinion(self, user, item, opinion):
+        """
+        Changes a users opinion of an item and pushes the changes out as necessary
+
+        Arguments:
+            user    -> a user whose opinion is changing
+            item    -> the item for the user that changes
+            opinion -> the new ratings the user has for the item
+
+        Return -> None
+        """
+        raise NotImplementedError
+
+
+    def applyOpinions(self, changes):
+        """
+        Changes many opinions at once, engines push the changes out once for all of them where they can
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion), an opinion of 0 or None removes it, the last change
+                       to an opinion wins
+
+        Return -> None
+        """
+
+        for user, item, opinion in self._latestChanges(changes):
+            self.changeOpinion(user, item, opinion)
+
+
+    def _predictedRatings(self, userIndex):
+        """
+        Calculates a user's opinion of every item at once
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> an array of the predicted opinions by dense item index
+        """
+        raise NotImplementedError
+
+
+    def predictOpinions(self, user, items):
+        """
+        Calculates a user's opinion of several items at once, scoring every item in a single pass
+
+        Arguments:
+            user  -> the user whose opinions are to be calculated
+            items -> the items of which the user has an unknown opinion
+
+        Return -> a list of the opinions that the user should have for each item, in the same order
+        """
+
+        start = self.metrics.start()
+        self.metrics.count("predictions", len(items))
+        try:
+            with self.lock.reading():
+                if user not in self.opinions.userIndex:
+                    return [0] * len(items)
+
+                ratings = self._predictedRatings(self.opinions.userIndex[user])
+                indices = self.opinions.itemRegistry.lookup(items)
+                return np.where(indices >= 0, ratings[indices], 0).tolist()
+        finally:
+            self.metrics.stop("prediction_seconds", start, call="predictOpinions")
+
+
+    def recommend(self, user, n=10, excludeRated=True):
+        """
+        Finds the items that a user should like the most
+
+        Arguments:
+            user         -> the user to whom items are being recommended
+            n            -> the number of items to recommend
+            excludeRated -> leaves out items the user already has an opinion of
+
+        Return -> a list of up to n tuple(item, predicted opinion), best first
+        """
+
+        start = self.metrics.start()
+        try:
+            with self.lock.reading():
+                if user not in self.opinions.userIndex or n <= 0:
+                    return []
+
+                userIndex = self.opinions.userIndex[user]
+                ratings = self._predictedRatings(userIndex)
+                candidates = np.arange(len(ratings))
+                if excludeRated:
+                    candidates = np.setdiff1d(candidates, self.opinions.row(userIndex)[0], assume_unique=True)
+                if len(candidates) > n:
+                    #only the best n need to be sorted
+                    candidates = candidates[np.argpartition(-ratings[candidates], n - 1)[:n]]
+                candidates = candidates[np.argsort(-ratings[candidates], kind="stable")]
+                return [(self.opinions.itemIds[index], float(ratings[index])) for index in candidates]
+        finally:
+            self.metrics.stop("prediction_seconds", start, call="recommend")
+
+
+    def _opinion(self, user, item): #done
+        """
+        gets the opinion a user has about an item from the database
+
+        Arguments:
+            user -> a user whose opinion we want
+            item -> the item for which we want their opinion
+
+        Return -> the opinion a user has for an item based directly on the database, either a number or 0 representing a null value
+        """
+
+        return self.opinions.opinion(user, item)
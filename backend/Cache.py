@@ -0,0 +1,219 @@
+"""
+Memory bounded caches for the values the filtering engines calculate.
+"""
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from itertools import count
+from threading import RLock
+import heapq
+import sys
+import numpy as np
+
+#about how much a dict entry and its key cost on top of the value itself
+ENTRY_OVERHEAD = 100
+
+
+def sizeOf(value):
+    """
+    Approximates the number of bytes a cached value takes up
+
+    Arguments:
+        value -> an array, a tuple or list of values, or any other object
+
+    Return -> the approximate size in bytes
+    """
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes + ENTRY_OVERHEAD
+    if isinstance(value, (tuple, list)):
+        return sum(sizeOf(part) for part in value) + sys.getsizeof(value)
+    return sys.getsizeof(value)
+
+
+class Cache(MutableMapping):
+    """
+    A dict that forgets entries once their total size goes over a byte
+    budget, dropping the least recently used (lru) or least frequently used
+    (lfu) entries first.  Whatever uses it has to be able to calculate an
+    evicted entry again, a missing key looks the same as one never cached.
+
+    Reading an entry with [] or get counts as a hit or a miss and as a use of
+    the entry, `in`, iteration, items(), values() and pop() do neither.  Entries that are
+    changed in place keep the size they had when they were stored.
+
+    Reads move entries around too, so every access holds the cache's lock,
+    which is only held for the bookkeeping of a single entry.
+    """
+
+    POLICIES = ("lru", "lfu")
+
+    def __init__(self, budget=None, policy="lru", sizer=sizeOf):
+        """
+        Creates an empty cache
+
+        Arguments:
+            budget -> the most bytes the entries may take up, None for no limit
+            policy -> "lru" or "lfu", which entries are evicted first
+            sizer  -> a function from a value to its approximate size in bytes
+        """
+
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown cache policy {}, expected one of {}".format(policy, ", ".join(self.POLICIES)))
+        self.budget = budget
+        self.policy = policy
+        self.sizer = sizer
+
+        #implemented as an OrderedDict(key->value) kept in order of use, least recently used first
+        self._entries = OrderedDict()
+        #implemented as map(key->size) of the size each entry was stored with
+        self._sizes = {}
+        self.bytes = 0
+
+        #for lfu, map(key->uses) and a heap of tuple(uses, tick, key), stale heap entries are skipped when popped
+        self._uses = {}
+        self._heap = []
+        self._ticks = count()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = RLock()
+
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._touch(key)
+            return value
+
+    def __setitem__(self, key, value):
+        size = self.sizer(value)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._sizes[key]
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            self._touch(key)
+            self._evict(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+            self.bytes -= self._sizes.pop(key)
+            self._uses.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def values(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key not in self._entries:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            value = self._entries[key]
+            del self[key]
+            return value
+
+
+    def get(self, key, default=None):
+        """
+        Gets an entry, counting the hit or miss
+
+        Arguments:
+            key     -> the key of the entry
+            default -> returned when the key is not cached
+
+        Return -> the cached value or default
+        """
+
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def stats(self):
+        """
+        Gets the counters of the cache
+
+        Return -> map(name->value) of the entries, bytes, budget, hits, misses, evictions and hit rate
+        """
+
+        lookups = self.hits + self.misses
+        return {"entries": len(self), "bytes": self.bytes, "budget": self.budget, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "hit rate": self.hits / float(lookups) if lookups else 0}
+
+
+    def _touch(self, key):
+        """
+        Records a use of an entry for the eviction policy
+
+        Arguments:
+            key -> the key of the entry
+
+        Return -> None
+        """
+
+        if self.policy == "lru":
+            self._entries.move_to_end(key)
+            return
+        self._uses[key] = self._uses.get(key, 0) + 1
+        heapq.heappush(self._heap, (self._uses[key], next(self._ticks), key))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            #too many stale entries, the heap is made again from the live ones
+            self._heap = [(uses, next(self._ticks), key) for key, uses in self._uses.items()]
+            heapq.heapify(self._heap)
+
+
+    def _evict(self, keep):
+        """
+        Evicts entries until the cache is within its budget
+
+        Arguments:
+            keep -> the key of the entry just stored, it is never evicted so that it can be returned
+
+        Return -> None
+        """
+
+        if self.budget is None:
+            return
+        #lfu heap entries of the new entry are put back once the eviction is done
+        setAside = []
+        while self.bytes > self.budget and len(self._entries) > 1:
+            if self.policy == "lru":
+                key = next(key for key in self._entries if key != keep)
+            else:
+                uses, tick, key = heapq.heappop(self._heap)
+                if self._uses.get(key) != uses:
+                    #a stale heap entry from before the entry was used again or removed
+                    continue
+                if key == keep:
+                    setAside.append((uses, tick, key))
+                    continue
+            del self[key]
+            self.evictions += 1
+        for entry in setAside:
+            heapq.heappush(self._heap, entry)
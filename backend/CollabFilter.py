@@ -1,475 +1,1037 @@
-"""
-The collaborative filtering portion of the system.
-"""
-
-
-import databases.database as databases
-from math import sqrt
-from sys import stdout
-
-class CollaborativeFilter(object):
-    """
-    A Collaborative Filtering algorithm/object meant to be heavily optimized
-    for speed
-    """
-
-    def __init__(self, name, path, table, debug=False, cache=True):
-        """
-        Initilialies the collaborative filter with the values
-
-        Arguments:
-            name  -> the name of the database file
-            path  -> the path to the database file
-            table -> the name of the table in the database file
-            debug -> activates debug mode, providing additional outputs and
-                     information about what is happening
-            cache -> used for testing, to compare between the caches being used
-                     and a normal, cache free version both for benchmarking and
-                     for error checking
-        """
-
-        self.name = name
-        self.path = path
-        self.table = table
-        self.debug = debug
-        self.cache = cache
-        self.db = databases.Database(self.name, self.table, self.path)
-
-        #implemented as map(user->map(item->opinion))
-        #opinions can be None or 1-5
-        self.opinions = {}
-
-        #implemented as map(user1->map(user2->tuple(rss(u1), rss(u2), multSum(u1, u2))))
-        #rss(u) is root sum squared
-        #multSum(u1, u2) is sum(u1[item]*u2[item] for item in sharedItems)
-        self.similarities = {}
-
-        #implemented as map(user1->map(item->tuple(sum(simil*opinions[user][item] for user in users), sum(simil for user in users))))
-        self.calculated = {}
-
-
-    def items(self):
-        """
-        Returns the items in the matrix
-
-        Return -> the list of items
-        """
-        return self.db.items()
-
-    def users(self):
-        """
-        Returns the users in the database
-
-        Return -> The users as a list
-        """
-        return self.db.users();
-
-    def fetchOpinion(self, user, item): #done
-        """
-        Directly fetches an opinion from the database
-
-        Arguments:
-            user -> the user who has an opinion
-            item -> the item of which they have an opinion
-
-        Return -> a value representing the user's opinion of the item, or none if the user has no opinion
-        """
-
-        return self.db.currentOpinion(user, item)
-
-
-    def predictOpinion(self, user, item): #done except for when the cache is disabled
-        """
-        Calculates a user's opinion of an item based on the collaborative filtering algorithm.  Uses caches if possible
-            and falls back to the long method of calculation if necessary
-
-        Arguments:
-            user -> the user whose opinion is to be calculated
-            item -> the item of which the user has an unknown opinion
-
-        Return -> the opinion that a user should have for an item based on collaborative filtering
-        """
-
-        if self.cache == True:
-            if user not in self.calculated:
-                self.calculated[user] = {}
-            if item not in self.calculated[user]:
-                self.calculated[user][item] = self._calculateWeights(user, item)
-            return self._ratingFromCalculated(*self.calculated[user][item])
-        else:
-            pass #for now
-            #return self._ratingFromCalculated(*self._forceNoCacheRating(user, item))
-
-
-    def _ratingFromCalculated(self, weightedRatings, sumSimilarities): #done
-        """
-        Uses the values stored in self.calculated to find the final rating for a user
-
-        Arguments:
-            weightedRatings -> The first value in self.calulated it is represented by
-                               sum(simil(u, u') * opinions[u'][i] for u' in Users)
-
-            sumSimilarities -> The second value in self.calculated, which represents
-                               sum(simil(u, u') for u' in Users)
-
-        Return -> r[u][i], the rating that user u would give to item i
-        """
-
-        #forces floating point division
-        return float(weightedRatings) / sumSimilarities
-
-
-    def _calculateWeights(self, user, item): #done
-        """
-        Calculates the weightedRatings and sum of similarities for a given user based on all of the other users
-
-        Arguments:
-            user -> the user for which you are calulating an opinion
-            item -> the item that the user does not have an opinion of
-
-        Return -> a tuple (self._ratingTop(user, item), self._ratingBottom(user, item))
-        """
-
-        #create the users and items sets
-        users = {person[0] for person in self.users()} - {user}
-
-        #use those sets to seperately calculate the top and bottom values for the final rating
-        return (self._ratingTop(user, item, users), self._ratingBottom(user, item, users))
-
-
-    def _ratingTop(self, user, item, users): #done
-        """
-        Calculates the top portion of the fraction that a user would have for an item based on other users
-
-        Arguments:
-            user -> the user whose opinion is to be calculated
-            item -> the item of which the user has an unknown opinion
-
-        Return -> the top portion of the calculated opinion
-        """
-
-        #get the items shared by both users
-        return sum(self._similarity(user, other) * self._opinion(other, item) for other in users)
-
-
-    def _ratingBottom(self, user, item, users): #done
-        """
-        Calcuates the sum of the similarities between users for a given user/item pair
-
-        Arguments:
-            user -> the user whose opinion is to be calculated
-            item -> the item of which the user has an unknown opinion
-
-        Return -> the bottom portion of the rating
-        """
-
-        return sum(self._similarity(user, other) for other in users)
-
-
-    def _similarity(self, user, other): #done
-        """
-        Calulates the similarity for a given pair of users
-
-        Arguments:
-            user  -> the user whose opinion is being calculated
-            other -> the other user to whom the user is being compared
-
-        Return -> the similarity between user and other
-        """
-
-        if user not in self.similarities:
-            self.similarities[user] = {}
-        if other not in self.similarities[user]:
-            self.similarities[user][other] = self._setSimilarities(user, other)
-        return self._calculateSimilarity(*self.similarities[user][other])
-
-
-    def _calculateSimilarity(self, rssUser, rssOther, multSum): #done
-        """
-        calculates the similarity between users based on the rss and multSum values
-
-        Arguments:
-            rssUser  -> the root sum squared of the ratings of items for the given user
-            rssOther -> the root sum squared of the ratings of items for the other used
-            multsum  -> the sum of the multiplication of the rating by user and other for an item ie. r{u, i} * r{o, i}
-
-        Return -> the similarity value between two users
-        """
-
-        return multSum / (rssUser * rssOther)
-
-
-    def _setSimilarities(self, user, other): #done
-        """
-        seperately calculate rss(user), rss(other), and multsum(user, other) and return them
-
-        Arguments:
-            user  -> a user whose opinion is being predicted
-            other -> the user to whom user is being compared
-
-        Return -> tuple(rss(user), rss(other), multsum(user, other))
-        """
-
-        items = [column[0] for column in self.items()]
-        sharedItems = {item for item in items if self._opinion(user, item) is not 0} & {item for item in items if self._opinion(other, item) is not 0}
-        userRss = self._rss(user, sharedItems)
-        otherRss = self._rss(other, sharedItems)
-        multsum = self._multSum(user, other, sharedItems)
-        return (userRss, otherRss, multsum)
-
-
-    def _rss(self, user, shared): #done
-        """
-        Calulates the root sum squred of the ratings for the given user of the items they share with the other user
-
-        Arguments:
-            user   -> a user who has opinions on items
-            shared -> the list of items shared with another user to whom they are being compared
-
-        Return -> rss(user) over the shared items with other
-        """
-
-        return sqrt(sum(self._opinion(user, item) ** 2 for item in shared))
-
-
-    def _multSum(self, user, other, shared): #done
-        """
-        Calulates the sum of the values or r{u, i} * r{o, i} for all shared items
-
-        Arguments:
-            user   -> the user whose opinion is being predicted
-            other  -> a user to whome user is being compared
-            shared -> the set of items shared by the two users
-
-        Return -> the sum of the multiples of the ratings of both users
-        """
-
-        return sum(self._opinion(user, item) * self._opinion(other, item) for item in shared)
-
-
-    def _opinion(self, user, item): #done
-        """
-        gets the opinion a user has about an item from the database
-
-        Arguments:
-            user -> a user whose opinion we want
-            item -> the item for which we want their opinion
-
-        Return -> the opinion a user has for an item based directly on the database, either a number or 0 representing a null value
-        """
-
-        if user not in self.opinions:
-            self.opinions[user] = {}
-        if item not in self.opinions[user]:
-            self.opinions[user][item] = self.fetchOpinion(user, item) or 0
-        return self.opinions[user][item]
-
-
-    def changeOpinion(self, user, item, opinion): #in progress
-        """
-        Changes a users opinion of an item and psuhes the changes out as necessary
-
-        Arguments:
-            user    -> a user whose opinion is changing
-            item    -> the item for the user that changes
-            opinion -> the new ratings the user has for the item
-
-        Return -> None
-        """
-
-        #used to keep track of any changes in the items compared, if an item is removed or added
-        items = [column[0] for column in self.items()]
-        usersItems = {item for item in items if self._opinion(user, item) is not 0}
-
-
-        #first, changes the opinion in the database and holds on to the old opinion for use later
-        oldOpinion = self.fetchOpinion(user, item)
-        self.db.changeOpinion(user, item, opinion)
-
-        #checks to see if the item is removed or not
-        change = self._checkNewOrRemoved(user, item, usersItems, opinion, oldOpinion)
-        #then this needs to be updated in the opinions matrix
-        if user not in self.opinions:
-            self.opinions[user] = {}
-        self.opinions[user][item] = opinion
-
-        #then this change needs to propgate out to all of the similarities
-        users = {person[0] for person in self.users()} - {user}
-        for other in users:
-            self._updateSimilarities(user, item, other, opinion, change, oldOpinion)
-
-
-    def _checkNewOrRemoved(self, user, item, items, opinion, oldOpinion):#done
-        """
-        Checks to see if the item being removed or added
-
-        Arguments:
-            user       -> the user whose opinion is being changed
-            item       -> the item for which the opinion is changing
-            items      -> the list of all items known by that user
-            opinion    -> the new opinion
-
-            Return -> -1, 0, or 1.  -1 if the item should be removed from the list, 0 if there are no changes,
-                      and 1 if the item should be added to the list
-        """
-
-        if item not in items:
-            return 1
-        elif item in items and (opinion == 0 or opinion == None):
-            return -1
-        else:
-            return 0
-
-
-    def _updateSimilarities(self, user, item, other, opinion, change, oldOpinion):#done
-        """
-        updates the similarity values in the relevant tables
-
-        Arguments:
-            user       -> the user whose opinion is being changed
-            item       -> the item about which the users opinion changes
-            other      -> the other use whose similarity is being compared to
-            opinion    -> the new opinion a user has for the item
-            change     -> a value -1, 0, or 1, representing whether or not an item needs to be added or removed
-                          from the list of items
-            oldOpinion -> the old opinion the user had for the item
-
-        Return -> None
-        """
-
-        #this whole secion could probably be cleaned up, I'm almost certain it could be in fact
-        #maybe refactor it into its own sub-function that gets called twice
-
-        if user in self.similarities:
-            #updates the similarities matrix for user
-            if other in self.similarities[user]:
-                rssUser = sqrt(self.similarities[user][other][0] ** 2 - oldOpinion ** 2 + opinion ** 2)
-                newA = self.similarities[user][other][2] + self._opinion(other, item) * (opinion - oldOpinion)
-                if change == 1:
-                    #adds item to the overall list of items
-                    rssOther = sqrt(self.similarities[user][other][1] + self._opinion(other, item) ** 2)
-                elif change == -1:
-                    #removes item from the overall list of items
-                    rssOther = sqrt(self.similarities[user][other][1] - self._opinion(other, item) ** 2)
-                else:
-                    rssOther = sqrt(self.similarities[user][other][1])
-                oldSimil = self._calculateSimilarity(*self.similarities[user][other])
-                self.similarities[user][other] = (rssUser, rssOther, newA)
-                items = [column[0] for column in self.items()]
-                for otherItem in items:
-                    self._updateCalculatedRating(user, item, other, opinion, oldOpinion, oldSimil)
-            else:
-                pass
-                #although this could reasonably be set up to instead calculate the ratings instead
-
-        #this should be tested
-        if other in self.similarities:
-            #updates the similarities matrix for other, in case similarities[other][user] exists
-            if user in self.similarities[other]:
-                rssUser = sqrt(self.similarities[other][user][0] ** 2 - oldOpinion ** 2 + opinion ** 2)
-                newA = self.similarities[other][user][2] + self._opinion(other, item) * (opinion - oldOpinion)
-                if change == 1:
-                    #adds item to the overall list of items
-                    rssOther = sqrt(self.similarities[other][user][1] + self._opinion(other, item) ** 2)
-                elif change == -1:
-                    #removes item from the overall list of items
-                    rssOther = sqrt(self.similarities[other][user][1] - self._opinion(other, item) ** 2)
-                else:
-                    rssOther = sqrt(self.similarities[other][user][1])
-                    #keep in mind that user and other switch in this case,everything else is the same
-                oldSimil = self._calculateSimilarity(*self.similarities[other][user])
-                self.similarities[other][user] = (rssOther, rssUser, newA)
-                items = [column[0] for column in self.items()]
-                for otherItem in items:
-                    self._updateCalculatedRating(user, item, other, opinion, oldOpinion, oldSimil)
-                #then update for the user
-                #self.caculated[user][item] = self._forceNoCacheRating(user, item)
-            else:
-                pass
-                #although once more, this could recalulate everything and set it.
-
-
-    def _noCacheRating(self, user, item):#done
-        """
-        Calculates the rating value without using any cached values
-
-        Arguments:
-            user -> the user whose rating is being calculated
-            item -> the item for which the user is calculating a rating
-
-        Return -> tuple(top, bottom)
-        """
-
-        users = {person[0] for person in self.users()} - {user}
-        topPart = sum(self._noCacheSimilarity(user, other) * self._opinion(other, item) for other in users)
-        bottomPart = sum(self._noCacheSimilarity(user, other) for other in users)
-        return (topPart, bottomPart)
-
-
-    def _noCacheSimilarity(self, user, other): #done
-        """
-        Calculates the similarity without caching anything directly from the database
-
-        Arguments:
-            user  -> the user whose rating is being calculated
-            other -> the user to whom they are being compared
-
-        Return -> the similarity value multsum / (rss(u) * rss(u'))
-        """
-
-        items = [column[0] for column in self.items()]
-        sharedItems = {item for item in items if self._opinion(user, item) is not 0} & {item for item in items if self._opinion(other, item) is not 0}
-        multsum = sum(self._noCacheOpinion(user, item) * self._noCacheOpinion(other, item) for item in sharedItems)
-        rssUser = sqrt(sum(self._noCacheOpinion(user, item) ** 2 for item in sharedItems))
-        rssOther = sqrt(sum(self._noCacheOpinion(other, item) ** 2 for item in sharedItems))
-        return multsum / (rssOther * rssUser)
-
-
-    def _noCacheOpinion(self, user, item):#done
-        """
-        Gets the opinion from the database, this is quick and easy
-
-        Arguments:
-            user -> the user whose rating is being calculated
-            item -> the item whose rating is being fetched
-
-        Return ->
-        """
-        return self.fetchOpinion(user, item) or 0
-
-
-    def _updateCalculatedRating(self, user, item, other, opinion, oldOpinion, oldSimil):#done
-        """
-        Updates the calculated ratings matrix for the ratings of all items by a user
-
-        Arguments:
-            user       -> the user whose rating is being calculated
-            item       -> the item whose rating is being calculated
-            other      -> the user to whome they are being compared
-            opinion    -> the opinion the user now has for the item
-            oldOpinion -> the user's previous opinion for the item
-            oldSimil   -> the previous similarity between the two users
-
-        Return -> None
-        """
-
-        if other not in self.calculated:
-            return
-        if item not in self.calculated[other]:
-            return
-        newTop = self.calculated[other][item][0] + self.similarities[other][other] * opinion - oldOpinion * oldSimil
-        newBot = self.calculated[other][item][1] - oldSimil + self.similarities[other][other]
-        self.calculated[other][item] = (newTop, newBot)
-
-
-
-if __name__ == "__main__":
-    assert 1 == 1
-    #do more
-    x = CollaborativeFilter("database.db", "databases/data", "main")
-    users = ["one", "two", "three", "four"]
-    classes = ["CS1331", "CS1332", "CS1333", "CS1334"]
-    for user in users:
-        for clazz in classes:
-            assert x._noCacheRating(user, clazz)[0] / x._noCacheRating(user, clazz)[1] == x.predictOpinion(user, clazz)
-            stdout.write(user+" "+clazz+" - "+str(x.predictOpinion(user, clazz))+"\n")
+"""
+The collaborative filtering portion of the system.
+"""
+
+
+from backend.BaseFilter import BaseFilter
+from backend.Cache import Cache
+from backend.NeighborIndex import NeighborIndex
+from backend.OpinionMatrix import OpinionMatrix
+from backend.Precompute import allPairs
+from backend.PropagationQueue import PropagationQueue
+from backend.SimilarityKernels import createKernel, PROFILE_COUNT, PROFILE_SUM, PROFILE_SQUARES
+from backend.SimilarityStore import SimilarityStore, RSS_USER, RSS_OTHER, MULT_SUM, SHARED, SUM_USER, SUM_OTHER
+from backend.Snapshot import saveSnapshot, openSnapshot, snapshotVersions
+from backend.utils import StripedLocks
+import databases.database as databases
+from math import sqrt
+from sys import stdout
+import numpy as np
+
+class CollaborativeFilter(BaseFilter):
+    """
+    A Collaborative Filtering algorithm/object meant to be heavily optimized
+    for speed
+    """
+
+    def __init__(self, name, path, table, debug=False, cache=True, db=None, neighbors=None, minSimilarity=0, minShared=1, lsh=None,
+                 similarityStore=None, calculatedCache=None, snapshot=None, kernel="cosine", writeBehind=False,
+                 metrics=None):
+        """
+        Initilialies the collaborative filter with the values
+
+        Arguments:
+            name  -> the name of the database file
+            path  -> the path to the database file (an sqlalchemy database url)
+            table -> the name of the table in the database file
+            debug -> activates debug mode, providing additional outputs and
+                     information about what is happening
+            cache -> used for testing, to compare between the caches being used
+                     and a normal, cache free version both for benchmarking and
+                     for error checking
+            db    -> an already open databases.database.Database, used instead
+                     of opening name/path when provided
+            neighbors     -> when set, only this many of the most similar users
+                             are used to predict a user's opinions
+            minSimilarity -> in neighbor mode, neighbors must be more similar
+                             than this
+            minShared     -> in neighbor mode, neighbors must share at least
+                             this many rated items
+            lsh           -> in neighbor mode, an empty LSHIndex used to find
+                             candidate neighbors instead of comparing a user
+                             to every other user
+            similarityStore -> a backend.SimilarityStore.SimilarityStore to keep
+                               the similarity statistics in, an unbounded one
+                               by default
+            calculatedCache -> a backend.Cache.Cache (or any dict like object)
+                               to keep the calculated ratings in, an unbounded
+                               Cache by default
+            snapshot        -> a snapshot directory written by saveSnapshot,
+                               when it has a version the opinions, similarity
+                               statistics and neighbors are memory mapped from
+                               it instead of being loaded and calculated.  The
+                               ids, the known users and the neighbor lists'
+                               bounds are still read, O(users + items), and an
+                               lsh index is built from the opinions, O(opinions).
+                               A snapshot whose fingerprint no longer matches
+                               the database's opinions is stale and ignored
+            kernel          -> the similarity measure, a name from
+                               backend.SimilarityKernels.KERNELS or a
+                               SimilarityKernel
+            writeBehind     -> when set, changeOpinion and applyOpinions
+                               only store the opinions and queue them, a
+                               background thread pushes them out to the
+                               caches, so predictions lag behind by
+                               pendingUpdates() changes until flush()
+            metrics         -> the backend.Metrics.Metrics to record what
+                               the engine does in, the shared METRICS by
+                               default
+        """
+
+        db = databases.Database(name, path) if db is None else db
+        arrays, metadata = self._openSnapshot(snapshot, db, debug)
+        opinions = None if arrays is None else OpinionMatrix.fromSnapshot(arrays)
+        super(CollaborativeFilter, self).__init__(name, path, table, debug, cache, db, opinions, metrics)
+
+        #the kernel decides which statistics of each pair are kept, and whether the users' profiles are
+        self.kernel = createKernel(kernel)
+        if similarityStore is not None and similarityStore.width != self.kernel.width:
+            raise ValueError("The {} kernel needs a similarity store of width {}".format(self.kernel.name, self.kernel.width))
+        #implemented as an array of shape (users, 3) of the count, sum and sum of squares of each user's opinions
+        self.profiles = None
+        if self.kernel.profiles:
+            self.profiles = arrays["profiles"] if arrays is not None and "profiles" in arrays else self._buildProfiles()
+
+        #a row for user1 is an array(user2->tuple(rss(u1), rss(u2), multSum(u1, u2), shared(u1, u2)))
+        #users are the dense indices of self.opinions, each row is an array of shape (users, 4)
+        #rss(u) is root sum squared
+        #multSum(u1, u2) is sum(u1[item]*u2[item] for item in sharedItems)
+        #shared(u1, u2) is len(sharedItems)
+        #sum(u1, u2) is sum(u1[item] for item in sharedItems), and sum(u2, u1) the other way around, kept for the
+        #kernels that need them
+        #each pair is stored once and read from either side, rows may be forgotten at any time and are
+        #calculated again when they are next needed
+        self.similarities = SimilarityStore(width=self.kernel.width) if similarityStore is None else similarityStore
+
+        #the k most similar users of each user, None when every user is used
+        self.neighborIndex = None if neighbors is None else NeighborIndex(neighbors, minSimilarity, minShared)
+        self.lsh = lsh
+        if self.lsh is not None:
+            self.lsh.build(self.opinions)
+
+        #implemented as map(user1->tuple(array(item->sum(simil*opinions[user][item] for user in users)), sum(simil for user in users),
+        #array(user->simil), version))
+        #the sum of the similarities does not depend on the item, so it is kept once per user
+        #entries are brought up to date when they are read, from the weights and the version they were built with
+        self.calculated = Cache() if calculatedCache is None else calculatedCache
+        #predictions only hold self.lock for reading, so two of them can fill or refresh the same user's entries at
+        #once, the entries of a user are filled under the lock of the user's stripe instead
+        self.stripes = StripedLocks()
+
+        #every change to an opinion is a new version, the user and the item are stamped with it
+        #implemented as arrays(index->version of the last change), grown as users and items are added
+        self.version = 0
+        self.userVersions = np.zeros(0, dtype=np.int64)
+        self.itemVersions = np.zeros(0, dtype=np.int64)
+
+        #the stored changes the caches have not seen yet, None when they see them before changeOpinion returns
+        self.propagation = PropagationQueue(self._propagateOpinions, "opinion-propagation") if writeBehind else None
+        #the dense indices of the users and items whose opinions changed in a batch that failed part way, they are
+        #pushed out again with the next one since their opinions no longer look changed
+        self.unpropagated = (set(), set())
+
+        #the hits and misses the caches count anyway are read when the metrics are, instead of being counted twice
+        self.metrics.collect("cache", self.cacheStats, "cache")
+        if self.propagation is not None:
+            self.metrics.collect("propagation", self.propagation.stats)
+
+        if arrays is not None:
+            self.similarities.restore(arrays)
+            #neighbor lists picked with other settings are picked again
+            if self.neighborIndex is not None and metadata.get("neighbors") == self._neighborSettings() and \
+                    metadata.get("kernel") == self.kernel.name:
+                self.neighborIndex.restore(arrays)
+            if self.debug:
+                stdout.write("Opened snapshot {} of {} users\n".format(snapshot, self.opinions.shape[0]))
+
+
+    def cacheStats(self):
+        """
+        Gets the counters of the similarity and calculated rating caches
+
+        Return -> map(cache name->map(counter->value)), see backend.Cache.Cache.stats
+        """
+
+        return {name: cache.stats() for name, cache in (("similarities", self.similarities), ("calculated", self.calculated))
+                if hasattr(cache, "stats")}
+
+
+    @staticmethod
+    def _openSnapshot(snapshot, db, debug=False):
+        """
+        Maps the newest version of a snapshot, unless the opinions in the database changed since it was saved, which
+            is found by comparing the fingerprint it was saved with to the database's
+
+        Arguments:
+            snapshot -> the snapshot directory or None
+            db       -> the databases.database.Database the engine uses
+            debug    -> writes out why a stale snapshot is ignored
+
+        Return -> tuple(map(name->array), metadata map), or (None, None) when there is no usable snapshot
+        """
+
+        if snapshot is None or not snapshotVersions(snapshot):
+            return None, None
+        arrays, metadata = openSnapshot(snapshot)
+        with db.session_scope() as session:
+            fingerprint = db.fetch_opinions_fingerprint(session)
+        #the sums are exact integers, so any change to them is a changed opinion
+        if metadata.get("fingerprint") != list(fingerprint):
+            if debug:
+                stdout.write("Ignoring snapshot {}, the opinions changed since it was saved\n".format(snapshot))
+            return None, None
+        return arrays, metadata
+
+
+    def saveSnapshot(self, directory, keep=2):
+        """
+        Saves the opinions, similarity statistics and neighbors as a new version of a snapshot, which a restarted
+            server opens with the snapshot argument instead of starting from nothing
+
+        Arguments:
+            directory -> the snapshot directory, see backend.Snapshot.saveSnapshot
+            keep      -> the number of versions to keep
+
+        Return -> the number of the new version
+        """
+
+        with self.lock.reading():
+            arrays = self.opinions.snapshotArrays()
+            arrays.update(self.similarities.snapshotArrays())
+            #stores happen under the writer lock, so the database holds exactly the opinions being saved
+            metadata = {"engine": "user", "kernel": self.kernel.name, "neighbors": None, "fingerprint": list(self.fetchFingerprint())}
+            if self.profiles is not None:
+                arrays["profiles"] = self._userProfiles()
+            if self.neighborIndex is not None:
+                arrays.update(self.neighborIndex.snapshotArrays())
+                metadata["neighbors"] = self._neighborSettings()
+            return saveSnapshot(directory, arrays, metadata, keep)
+
+
+    def _neighborSettings(self):
+        """
+        Return -> the settings the neighbor lists were picked with, as a list that survives a json round trip
+        """
+
+        return [self.neighborIndex.k, self.neighborIndex.minSimilarity, self.neighborIndex.minShared]
+
+
+    def predictOpinion(self, user, item): #done
+        """
+        Calculates a user's opinion of an item based on the collaborative filtering algorithm.  Uses caches if possible
+            and falls back to the long method of calculation if necessary
+
+        Arguments:
+            user -> the user whose opinion is to be calculated
+            item -> the item of which the user has an unknown opinion
+
+        Return -> the opinion that a user should have for an item based on collaborative filtering
+        """
+
+        start = self.metrics.start()
+        self.metrics.count("predictions")
+        try:
+            with self.lock.reading():
+                if self.cache == True:
+                    if user not in self.opinions.userIndex or item not in self.opinions.itemIndex:
+                        return 0
+                    weightedRatings, sumSimilarities = self._calculatedRow(self.opinions.userIndex[user])
+                    return self._ratingFromCalculated(weightedRatings[self.opinions.itemIndex[item]], sumSimilarities)
+                else:
+                    return self._ratingFromCalculated(*self._noCacheRating(user, item))
+        finally:
+            self.metrics.stop("prediction_seconds", start, call="predictOpinion")
+
+
+    def predictOpinions(self, user, items):
+        """
+        Calculates a user's opinion of several items at once, scoring every item in a single pass
+
+        Arguments:
+            user  -> the user whose opinions are to be calculated
+            items -> the items of which the user has an unknown opinion
+
+        Return -> a list of the opinions that the user should have for each item, in the same order
+        """
+
+        if not self.cache:
+            return [self.predictOpinion(user, item) for item in items]
+        return super(CollaborativeFilter, self).predictOpinions(user, items)
+
+
+    def _predictedRatings(self, userIndex):
+        """
+        Calculates a user's opinion of every item at once from self.calculated
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> an array of r[u][i] by item
+        """
+
+        return self._ratingsFromCalculated(*self._calculatedRow(userIndex))
+
+
+    def _calculatedRow(self, userIndex):
+        """
+        Gets the weighted ratings of every item for a user, calculating them if they are not already known and
+            bringing them up to date if opinions changed since they were
+
+        Arguments:
+            userIndex -> the dense index of the user whose opinions are being calculated
+
+        Return -> tuple(array of weightedRatings by item, sumSimilarities), from the entry of self.calculated for the user
+        """
+
+        with self.stripes(userIndex):
+            entry = self.calculated.get(userIndex)
+            if entry is None:
+                entry = self.calculated[userIndex] = self._calculateWeights(userIndex)
+            elif entry[3] < self.version:
+                entry = self.calculated[userIndex] = self._refreshWeights(userIndex, *entry)
+            #entries are replaced, never changed in place, so the arrays stay as they are once the stripe is let go of
+            return entry[:2]
+
+
+    def _ratingFromCalculated(self, weightedRatings, sumSimilarities): #done
+        """
+        Uses the values stored in self.calculated to find the final rating for a user
+
+        Arguments:
+            weightedRatings -> The first value in self.calulated it is represented by
+                               sum(simil(u, u') * opinions[u'][i] for u' in Users)
+
+            sumSimilarities -> The second value in self.calculated, which represents
+                               sum(simil(u, u') for u' in Users)
+
+        Return -> r[u][i], the rating that user u would give to item i, 0 if the user is similar to no one
+        """
+
+        if sumSimilarities == 0:
+            return 0
+        #forces floating point division
+        return float(weightedRatings) / sumSimilarities
+
+
+    def _ratingsFromCalculated(self, weightedRatings, sumSimilarities):
+        """
+        The vectorized form of _ratingFromCalculated, for every item at once
+
+        Arguments:
+            weightedRatings -> the array of weighted ratings by item from self.calculated
+            sumSimilarities -> the sum of the similarities from self.calculated
+
+        Return -> an array of r[u][i] by item
+        """
+
+        if sumSimilarities == 0:
+            return np.zeros(len(weightedRatings))
+        return weightedRatings / sumSimilarities
+
+
+    def _calculateWeights(self, userIndex): #done
+        """
+        Calculates the weightedRatings of every item and the sum of similarities for a given user based on all of
+            the other users
+
+        Arguments:
+            userIndex -> the dense index of the user for which you are calulating opinions
+
+        Return -> a tuple (self._ratingTop(similarities), self._ratingBottom(similarities), array of the weight of
+                  every user, the current version), the entry of self.calculated for the user
+        """
+
+        weights = self._currentWeights(userIndex)
+        #in neighbor mode only the neighbors' opinions are read
+        users = np.flatnonzero(weights) if self.neighborIndex is not None else None
+        #use those to seperately calculate the top and bottom values for the final ratings
+        top = self._ratingTop(weights if users is None else weights[users], users)
+        self.metrics.count("neighbors_visited", self.opinions.shape[0] if users is None else len(users))
+        return (top, self._ratingBottom(weights), weights, self.version)
+
+
+    def _currentWeights(self, userIndex, weights=None, version=None):
+        """
+        Gets the weight of every user in a user's ratings as they are now, their similarity to the user or in
+            neighbor mode their similarity if they are one of the user's neighbors and 0 if not.  Only a change by
+            one of the two users moves their similarity, so when the user has not changed since weights were
+            calculated only the users who have are calculated again
+
+        Arguments:
+            userIndex -> the dense index of the user
+            weights   -> the weights as they were at version, or None
+            version   -> the version weights were calculated at
+
+        Return -> an array of the weights by user
+        """
+
+        users = self.opinions.shape[0]
+        if self.neighborIndex is not None:
+            #only the nearest neighbors take part in the rating
+            neighbors, similarities = self._neighbors(userIndex)
+            current = np.zeros(users)
+            current[neighbors] = similarities
+            return current
+
+        if weights is None or self._versions("user")[userIndex] > version:
+            #the weight of every other user, the user's own entry is always 0
+            return self._similarityWeights(userIndex)
+        current = np.pad(weights, (0, users - len(weights)))
+        changed = np.flatnonzero(self._versions("user") > version)
+        current[changed] = np.maximum(self._calculateSimilarities(self._pairStatistics(userIndex, changed), userIndex, changed), 0)
+        return current
+
+
+    def _refreshWeights(self, userIndex, weightedRatings, sumSimilarities, weights, version):
+        """
+        Brings a user's entry of self.calculated up to date.  The weighted ratings move by the change in the
+            weights of the users whose weight moved, and items whose opinions changed are weighted again from
+            scratch, instead of starting over
+
+        Arguments:
+            userIndex       -> the dense index of the user
+            weightedRatings -> the weighted ratings of the entry
+            sumSimilarities -> the sum of the similarities of the entry
+            weights         -> the weights the entry was calculated with
+            version         -> the version the entry was calculated at
+
+        Return -> the new entry, see _calculateWeights
+        """
+
+        users, items = self.opinions.shape
+        current = self._currentWeights(userIndex, weights, version)
+        old = np.pad(weights, (0, users - len(weights)))
+        weightedRatings = np.pad(weightedRatings, (0, items - len(weightedRatings)))
+
+        #the other items were rated the same then as now, only the weights moved
+        moved = np.flatnonzero(current != old)
+        self.metrics.count("neighbors_visited", len(moved))
+        if len(moved):
+            weightedRatings += self.opinions.csr[moved].T.dot(current[moved] - old[moved])
+        stale = np.flatnonzero(self._versions("item") > version)
+        if len(stale):
+            weightedRatings[stale] = self.opinions.csc[:, stale].T.dot(current)
+        return (weightedRatings, self._ratingBottom(current), current, self.version)
+
+
+    def _versions(self, kind):
+        """
+        Gets the versions of the users or the items, with version 0 for those added since they were last grown
+
+        Arguments:
+            kind -> "user" or "item"
+
+        Return -> the array of self.userVersions or self.itemVersions
+        """
+
+        name, size = ("userVersions", self.opinions.shape[0]) if kind == "user" else ("itemVersions", self.opinions.shape[1])
+        versions = getattr(self, name)
+        if len(versions) < size:
+            versions = np.pad(versions, (0, size - len(versions)))
+            setattr(self, name, versions)
+        return versions
+
+
+    def _ratingTop(self, similarities, users=None): #done
+        """
+        Calculates the top portion of the fraction that a user would have for every item based on other users, as a
+            single sparse matrix-vector product
+
+        Arguments:
+            similarities -> the array of similarities between the user and the other users
+            users        -> the dense indices of the other users, or None for every user
+
+        Return -> the array of the top portions of the calculated opinions by item
+        """
+
+        if users is None:
+            return self.opinions.csr.T.dot(similarities)
+        return self.opinions.csr[users].T.dot(similarities)
+
+
+    def _ratingBottom(self, similarities): #done
+        """
+        Calcuates the sum of the similarities between a user and every other user
+
+        Arguments:
+            similarities -> the array of similarities between the user and every other user
+
+        Return -> the bottom portion of the rating
+        """
+
+        return float(similarities.sum())
+
+
+    def _neighbors(self, userIndex):
+        """
+        Gets the nearest neighbors of a user, picking them from the user's similarities if they are not already known
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> tuple(array(neighbor), array(similarity)), most similar first
+        """
+
+        if userIndex not in self.neighborIndex:
+            if self.lsh is not None:
+                #only the users hashed into the same buckets are compared exactly
+                candidates = self.lsh.candidates(userIndex)
+                row = self._setUserSimilarities(userIndex, candidates)
+                similarities = self._calculateSimilarities(row, userIndex, candidates)
+                return self.neighborIndex.build(userIndex, similarities, row[:, SHARED], candidates)
+            others, statistics = self._similarityRow(userIndex)
+            return self.neighborIndex.build(userIndex, self._calculateSimilarities(statistics, userIndex, others), statistics[:, SHARED], others)
+        return self.neighborIndex[userIndex]
+
+
+    def _updateNeighbors(self, users, items):
+        """
+        Forgets the neighbors of the users whose similarities moved when users changed their opinions of items,
+            those are the users and everyone else who has an opinion of the items, and for kernels that read the
+            users' profiles everyone who shares an item with the users, as their means moved.  Their neighbors are
+            picked again from their rows when they are next read, so a change costs the same whatever the kernel
+            instead of reading the row of everyone it touches
+
+        Arguments:
+            users -> the dense indices of the users whose opinions changed
+            items -> the dense indices of the items
+
+        Return -> None
+        """
+
+        affected = set(users)
+        for itemIndex in items:
+            affected.update(self.opinions.column(itemIndex)[0].tolist())
+        for userIndex in users:
+            if self.lsh is not None:
+                self.lsh.update(userIndex, self.opinions)
+            if self.kernel.profiles:
+                affected.update(self._similarityRow(userIndex)[0].tolist())
+        for other in affected:
+            self.neighborIndex.discard(other)
+
+
+    def _similarity(self, user, other): #done
+        """
+        Calulates the similarity for a given pair of users
+
+        Arguments:
+            user  -> the user whose opinion is being calculated
+            other -> the other user to whom the user is being compared
+
+        Return -> the similarity between user and other
+        """
+
+        if user not in self.opinions.userIndex or other not in self.opinions.userIndex:
+            return 0
+        userIndex, otherIndex = self.opinions.userIndex[user], self.opinions.userIndex[other]
+        return float(self._calculateSimilarities(self._pairStatistics(userIndex, [otherIndex]), userIndex, [otherIndex])[0])
+
+
+    def _similarityRow(self, userIndex):
+        """
+        Gets the similarity statistics between a user and the users they share items with, calculating them all at
+            once if they are not already known
+
+        Arguments:
+            userIndex -> the dense index of the user whose opinion is being calculated
+
+        Return -> tuple(sorted array of the other users, array of shape (others, width) of tuple(rss(user),
+                  rss(other), multsum(user, other), shared) by other user, followed by tuple(sum(user, other),
+                  sum(other, user)) for kernels that need them), every user left out shares nothing with the user
+        """
+
+        with self.stripes(userIndex):
+            row = self.similarities.row(userIndex)
+            if row is None:
+                statistics = self._setUserSimilarities(userIndex)
+                others = np.flatnonzero(statistics[:, SHARED])
+                row = (others, statistics[others])
+                self.similarities.setRow(userIndex, *row)
+            return row
+
+
+    def _pairStatistics(self, userIndex, others):
+        """
+        Gets the similarity statistics between a user and some other users from the user's row
+
+        Arguments:
+            userIndex -> the dense index of the user
+            others    -> an array of the dense indices of the other users
+
+        Return -> an array of shape (others, width) in the order of others, 0 for those sharing nothing with the user
+        """
+
+        partners, statistics = self._similarityRow(userIndex)
+        others = np.asarray(others, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(partners, others), max(len(partners) - 1, 0))
+        found = partners[positions] == others if len(partners) else np.zeros(len(others), dtype=bool)
+        values = np.zeros((len(others), self.kernel.width))
+        values[found] = statistics[positions[found]]
+        return values
+
+
+    def precomputeSimilarities(self, workers=None, blockSize=2048):
+        """
+        Calculates the similarity statistics of every pair of users up front, spread over a pool of processes,
+            so that no user's row has to be calculated when it is first needed.  The pairs are calculated from a copy
+            of the opinions without holding the lock, predictions and changes go on meanwhile and the lock is only
+            held for writing to swap the new statistics in
+
+        Arguments:
+            workers   -> the number of processes, None for one per core, 1 to work in this process
+            blockSize -> the number of users in each block of the all pairs calculation
+
+        Return -> None
+        """
+
+        with self.lock.reading():
+            matrix, version = self.opinions.csr.copy(), self.version
+        keys, values = allPairs(matrix, workers, blockSize, self.kernel.width)
+        with self.lock.writing():
+            self.similarities.load(keys, values, matrix.shape[0])
+            #the users whose opinions changed, or who were added, while the pairs were calculated
+            for userIndex in np.flatnonzero(self._versions("user") > version).tolist():
+                self._setPairs(userIndex)
+        if self.debug:
+            stdout.write("Precomputed {} pairs of similar users\n".format(len(keys)))
+
+
+    def _calculateSimilarity(self, statistics, userProfile=None, otherProfile=None): #done
+        """
+        calculates the similarity between users with the kernel
+
+        Arguments:
+            statistics   -> the statistics of the pair from the user's point of view, tuple(rss(user), rss(other),
+                            multsum(user, other), shared, ...) as far as the kernel needs
+            userProfile  -> the user's (count, sum, squares), for kernels that read profiles
+            otherProfile -> the other user's (count, sum, squares), for kernels that read profiles
+
+        Return -> the similarity value between two users, 0 if they share no items
+        """
+
+        otherProfiles = None if otherProfile is None else np.array([otherProfile], dtype=float)
+        return float(self.kernel.similarities(np.array([statistics], dtype=float), userProfile, otherProfiles)[0])
+
+
+    def _calculateSimilarities(self, row, userIndex, others=None):
+        """
+        The vectorized form of _calculateSimilarity, for a whole row of self.similarities at once
+
+        Arguments:
+            row       -> a row of self.similarities
+            userIndex -> the dense index of the user the row belongs to
+            others    -> the dense indices of the users in the row, when it is not every user
+
+        Return -> an array of the similarity values between the user and every other user
+        """
+
+        if not self.kernel.profiles:
+            return self.kernel.similarities(row)
+        profiles = self._userProfiles()
+        return self.kernel.similarities(row, profiles[userIndex], profiles[slice(None) if others is None else others])
+
+
+    def _similarityWeights(self, userIndex):
+        """
+        Gets the weight of every other user in a user's calculated ratings, their similarity to the user.  Kernels
+            that can be negative are cut off at 0, so that the sum of the weights is never 0 or less by accident
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> an array of the weights by user
+        """
+
+        others, statistics = self._similarityRow(userIndex)
+        weights = np.zeros(self.opinions.shape[0])
+        weights[others] = np.maximum(self._calculateSimilarities(statistics, userIndex, others), 0)
+        return weights
+
+
+    def _buildProfiles(self):
+        """
+        Calculates every user's profile from the opinions
+
+        Return -> an array of shape (users, 3) of the count, sum and sum of squares of each user's opinions
+        """
+
+        csr = self.opinions.csr
+        users = np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))
+        ratings = csr.data.astype(np.float64)
+        profiles = np.empty((csr.shape[0], 3))
+        profiles[:, PROFILE_COUNT] = np.diff(csr.indptr)
+        profiles[:, PROFILE_SUM] = np.bincount(users, ratings, csr.shape[0])
+        profiles[:, PROFILE_SQUARES] = np.bincount(users, ratings ** 2, csr.shape[0])
+        return profiles
+
+
+    def _userProfiles(self):
+        """
+        Gets the users' profiles, with empty profiles for the users added since they were last grown
+
+        Return -> the array of shape (users, 3) of self.profiles
+        """
+
+        if len(self.profiles) < self.opinions.shape[0]:
+            self.profiles = np.concatenate((self.profiles, np.zeros((self.opinions.shape[0] - len(self.profiles), 3))))
+        return self.profiles
+
+
+    def _setUserSimilarities(self, userIndex, others=None):
+        """
+        Calculates rss(user), rss(other), multsum(user, other) and the number of shared items between a user and
+            every other user in a single pass over the opinions of the items the user has rated, and the sums of
+            the shared opinions for kernels that need them
+
+        Arguments:
+            userIndex -> the dense index of the user whose opinion is being predicted
+            others    -> an array of the dense indices of the other users to compare to, or None for every user
+
+        Return -> an array of shape (users, width), the row of self.similarities for the user, or of shape
+                  (others, width) in the order of others
+        """
+
+        items, ratings = self.opinions.row(userIndex)
+        if others is None:
+            #every opinion of an item the user has rated, the users who gave them are the ones sharing that item
+            shared = self.opinions.csc[:, items]
+            others = shared.indices
+            userRatings = np.repeat(ratings, np.diff(shared.indptr))
+            users = self.opinions.shape[0]
+        else:
+            #the same, but only from the rows of the given users
+            shared = self.opinions.csr[others][:, items]
+            users = len(others)
+            userRatings = ratings[shared.indices]
+            others, userIndex = np.repeat(np.arange(users), np.diff(shared.indptr)), None
+
+        self.metrics.count("similarity_rows")
+        self.metrics.count("similarity_pairs", users)
+        row = np.empty((users, self.kernel.width))
+        row[:, RSS_USER] = np.sqrt(np.bincount(others, userRatings ** 2, users))
+        row[:, RSS_OTHER] = np.sqrt(np.bincount(others, shared.data ** 2, users))
+        row[:, MULT_SUM] = np.bincount(others, userRatings * shared.data, users)
+        row[:, SHARED] = np.bincount(others, minlength=users)
+        if self.kernel.width > SUM_USER:
+            row[:, SUM_USER] = np.bincount(others, userRatings, users)
+            row[:, SUM_OTHER] = np.bincount(others, shared.data, users)
+        #a user is not one of their own neighbors
+        if userIndex is not None:
+            row[userIndex] = 0
+        return row
+
+
+    def _setSimilarities(self, user, other): #done
+        """
+        seperately calculate rss(user), rss(other), and multsum(user, other) and return them
+
+        Arguments:
+            user  -> a user whose opinion is being predicted
+            other -> the user to whom user is being compared
+
+        Return -> tuple(rss(user), rss(other), multsum(user, other))
+        """
+
+        items, userRatings, otherRatings = self._sharedRatings(user, other)
+        #the ratings are single precision, the sums are not
+        userRatings, otherRatings = userRatings.astype(np.float64), otherRatings.astype(np.float64)
+        return (sqrt(userRatings.dot(userRatings)), sqrt(otherRatings.dot(otherRatings)), float(userRatings.dot(otherRatings)))
+
+
+    def _sharedItems(self, user, other):
+        """
+        Finds the items that both users have an opinion of
+
+        Arguments:
+            user  -> a user whose opinion is being predicted
+            other -> the user to whom user is being compared
+
+        Return -> the set of items rated by both users
+        """
+
+        return {self.opinions.itemIds[index] for index in self._sharedRatings(user, other)[0].tolist()}
+
+
+    def _sharedRatings(self, user, other):
+        """
+        Finds the opinions both users have of the items they have both rated, with a merge of their sorted rows
+            instead of building sets
+
+        Arguments:
+            user  -> a user whose opinion is being predicted
+            other -> the user to whom user is being compared
+
+        Return -> tuple(item indices, user ratings, other ratings) as arrays
+        """
+
+        if user not in self.opinions.userIndex or other not in self.opinions.userIndex:
+            return (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+        return self.opinions.shared(self.opinions.userIndex[user], self.opinions.userIndex[other])
+
+
+    def changeOpinion(self, user, item, opinion):
+        """
+        Changes a users opinion of an item and pushes the change out to the cached similarities.  Only the users
+            with an opinion of the item share it with the user, so only their similarity statistics move, see "Change
+            an Opinion" in Math/CollabFilter.tex.  The calculated ratings are only stamped with a new version, they
+            are brought up to date when they are next read.  With writeBehind the change is queued once it is
+            stored, and pushed out by the background thread
+
+        Arguments:
+            user    -> a user whose opinion is changing
+            item    -> the item for the user that changes
+            opinion -> the new ratings the user has for the item, 0 or None removes it
+
+        Return -> None
+        """
+
+        #the opinion is stored and pushed out under the same lock, so the caches take the changes in the order the
+        #database committed them
+        with self.lock.writing():
+            self.storeOpinion(user, item, opinion)
+            if self.propagation is not None:
+                self.propagation.put(user, item, opinion)
+                return
+
+            start = self.metrics.start()
+            self.metrics.count("opinion_changes")
+            try:
+                userIndex, itemIndex = self.opinions.addUser(user), self.opinions.addItem(item)
+                opinion = opinion or 0
+                oldOpinion = self.opinions.value(userIndex, itemIndex)
+                if opinion == oldOpinion:
+                    return
+
+                self.opinions.setOpinion(user, item, opinion)
+                self.version += 1
+                self._versions("user")[userIndex] = self._versions("item")[itemIndex] = self.version
+                if self.profiles is not None:
+                    self._userProfiles()[userIndex] += (int(opinion != 0) - int(oldOpinion != 0), opinion - oldOpinion, opinion ** 2 - oldOpinion ** 2)
+
+                #everyone else with an opinion of the item, their opinions did not change
+                raters, ratings = self.opinions.column(itemIndex)
+                others = raters != userIndex
+                raters, ratings = raters[others], ratings[others]
+
+                self._updateSimilarities(userIndex, raters, ratings, opinion, oldOpinion)
+                if self.neighborIndex is not None:
+                    #the neighbors of everyone whose similarities moved are picked again
+                    self._updateNeighbors([userIndex], [itemIndex])
+            finally:
+                self.metrics.stop("propagation_seconds", start, call="changeOpinion")
+
+
+    def applyOpinions(self, changes):
+        """
+        Changes many opinions at once.  They are written in a single transaction, and instead of moving the
+            statistics once a change, every pair with a user whose opinions changed is calculated again once, and
+            the calculated ratings are stamped with a single new version.  With writeBehind the changes are queued
+            once they are stored
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion), an opinion of 0 or None removes it, the last change
+                       to an opinion wins
+
+        Return -> None
+        """
+
+        changes = self._latestChanges(changes)
+        #stored and pushed out under the same lock, see changeOpinion
+        with self.lock.writing():
+            self.storeOpinions(changes)
+            if self.propagation is not None:
+                self.propagation.putMany(changes)
+            else:
+                self._propagateOpinions(changes)
+
+
+    def pendingUpdates(self):
+        """
+        Gets how far the caches lag behind the stored opinions
+
+        Return -> the number of stored changes that are not pushed out yet, always 0 without writeBehind
+        """
+
+        return 0 if self.propagation is None else self.propagation.pending
+
+
+    def flush(self, timeout=None):
+        """
+        Waits until every stored change is pushed out to the caches, an error raised while pushing one out is raised
+            here
+
+        Arguments:
+            timeout -> the most seconds to wait, None to wait for as long as it takes
+
+        Return -> True once nothing is pending, False if the timeout ran out first
+        """
+
+        return True if self.propagation is None else self.propagation.flush(timeout)
+
+
+    def _propagateOpinions(self, changes):
+        """
+        Pushes stored changes out to the opinions and the caches, see applyOpinions
+
+        Arguments:
+            changes -> a list of tuple(user, item, opinion), each opinion at most once
+
+        Return -> None
+        """
+
+        start = self.metrics.start()
+        self.metrics.count("opinion_changes", len(changes))
+        try:
+            with self.lock.writing():
+                users, items = self.unpropagated
+                for user, item, opinion in changes:
+                    userIndex, itemIndex = self.opinions.addUser(user), self.opinions.addItem(item)
+                    if (opinion or 0) != self.opinions.value(userIndex, itemIndex):
+                        self.opinions.setOpinion(user, item, opinion)
+                        users.add(userIndex)
+                        items.add(itemIndex)
+                if not users:
+                    return
+
+                self.version += 1
+                self._versions("user")[list(users)] = self.version
+                self._versions("item")[list(items)] = self.version
+
+                for userIndex in sorted(users):
+                    if self.profiles is not None:
+                        ratings = self.opinions.row(userIndex)[1].astype(np.float64)
+                        self._userProfiles()[userIndex] = (len(ratings), ratings.sum(), ratings.dot(ratings))
+                    self._setPairs(userIndex)
+                if self.neighborIndex is not None:
+                    self._updateNeighbors(users, items)
+                self.unpropagated = (set(), set())
+        finally:
+            self.metrics.stop("propagation_seconds", start, call="applyOpinions")
+
+
+    def _setPairs(self, userIndex):
+        """
+        Calculates again the stored statistics between a user and everyone else, the user's whole row if it is
+            stored and otherwise only the pairs with the users whose rows are
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> None
+        """
+
+        row = self._setUserSimilarities(userIndex)
+        if userIndex in self.similarities:
+            #every pair, so that those no longer sharing an item are written over as well
+            others = np.flatnonzero(np.arange(len(row)) != userIndex)
+        else:
+            others = np.array([other for other in self.similarities if other != userIndex], dtype=np.int64)
+        self.similarities.setPairs(userIndex, others, row[others])
+
+
+    def _updateSimilarities(self, userIndex, raters, ratings, opinion, oldOpinion):
+        """
+        Updates the stored similarity statistics between a user and everyone else who has an opinion of the item
+            the user's opinion changed for, all of the pairs at once
+
+        Arguments:
+            userIndex  -> the dense index of the user whose opinion changed
+            raters     -> the array of the dense indices of the other users with an opinion of the item
+            ratings    -> the array of the raters' opinions of the item
+            opinion    -> the new opinion, 0 if it was removed
+            oldOpinion -> the old opinion, 0 if there was none
+
+        Return -> None
+        """
+
+        #adding or removing the opinion adds or removes the item from the items the user shares with each rater
+        sharedChange = int(opinion != 0) - int(oldOpinion != 0)
+        userSquares = opinion ** 2 - oldOpinion ** 2
+        otherSquares = ratings ** 2 * sharedChange
+        multSums = ratings * (opinion - oldOpinion)
+        #the item joins or leaves the shared items with its whole rating, or the rating moves
+        userSums = opinion - oldOpinion
+        otherSums = ratings * sharedChange
+
+        #each pair is changed once, for whichever of its two users have their rows stored
+        self.similarities.shift(userIndex, raters, userSquares, otherSquares, multSums, sharedChange, userSums, otherSums)
+
+
+    def _noCacheRating(self, user, item):#done
+        """
+        Calculates the rating value without using any cached values
+
+        Arguments:
+            user -> the user whose rating is being calculated
+            item -> the item for which the user is calculating a rating
+
+        Return -> tuple(top, bottom)
+        """
+
+        users = set(self.users()) - {user}
+        #the user's opinions are fetched once, and compared to each other user's opinions of the same items
+        userOpinions = self.fetchOpinions(user)
+        #the weights are cut off at 0 like in _similarityWeights
+        weights = {other: max(self._noCacheSimilarity(user, other, userOpinions), 0) for other in users}
+        topPart = sum(weights[other] * self._opinion(other, item) for other in users)
+        bottomPart = sum(weights.values())
+        return (topPart, bottomPart)
+
+
+    def _noCacheSimilarity(self, user, other, userOpinions=None): #done
+        """
+        Calculates the similarity without caching anything directly from the database.  Only the other user's
+            opinions of the items the user rated are fetched, and for kernels that read profiles the other user's
+            profile is added up by the database
+
+        Arguments:
+            user         -> the user whose rating is being calculated
+            other        -> the user to whom they are being compared
+            userOpinions -> the user's opinions as fetchOpinions returns them, when they are already fetched
+
+        Return -> the similarity value from the kernel, multsum / (rss(u) * rss(u')) for cosine, 0 if they share no items
+        """
+
+        userOpinions = self.fetchOpinions(user) if userOpinions is None else userOpinions
+        otherOpinions = self.fetchOpinions(other, userOpinions) if userOpinions else {}
+        sharedItems = {item for item, rating in otherOpinions.items() if rating and userOpinions[item]}
+
+        statistics = [0] * (SUM_OTHER + 1)
+        statistics[MULT_SUM] = sum(userOpinions[item] * otherOpinions[item] for item in sharedItems)
+        statistics[RSS_USER] = sqrt(sum(userOpinions[item] ** 2 for item in sharedItems))
+        statistics[RSS_OTHER] = sqrt(sum(otherOpinions[item] ** 2 for item in sharedItems))
+        statistics[SHARED] = len(sharedItems)
+        statistics[SUM_USER] = sum(userOpinions[item] for item in sharedItems)
+        statistics[SUM_OTHER] = sum(otherOpinions[item] for item in sharedItems)
+
+        profiles = [None, None]
+        if self.kernel.profiles:
+            ratings = [rating for rating in userOpinions.values() if rating]
+            profiles = [(len(ratings), sum(ratings), sum(rating ** 2 for rating in ratings)), self.fetchProfile(other)]
+        return self._calculateSimilarity(statistics[:self.kernel.width], *profiles)
+
+
+    def _noCacheOpinion(self, user, item):#done
+        """
+        Gets the opinion from the database, this is quick and easy
+
+        Arguments:
+            user -> the user whose rating is being calculated
+            item -> the item whose rating is being fetched
+
+        Return ->
+        """
+        return self.fetchOpinion(user, item) or 0
+
+
+if __name__ == "__main__":
+    assert 1 == 1
+    #do more
+    x = CollaborativeFilter("database.db", "databases/data", "main")
+    users = ["one", "two", "three", "four"]
+    classes = ["CS1331", "CS1332", "CS1333", "CS1334"]
+    for user in users:
+        for clazz in classes:
+            assert x._noCacheRating(user, clazz)[0] / x._noCacheRating(user, clazz)[1] == x.predictOpinion(user, clazz)
+            stdout.write(user+" "+clazz+" - "+str(x.predictOpinion(user, clazz))+"\n")
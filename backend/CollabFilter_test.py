@@ -0,0 +1,1110 @@
+"""
+tests for the collaborative filter and the structures behind it
+"""
+
+import unittest
+import unittest.mock
+import backend.CollabFilter
+from backend.Cache import Cache
+from backend.CollabFilter import CollaborativeFilter
+from backend.ItemFilter import ItemFilter
+from backend.FactorFilter import FactorFilter
+from backend.LSHIndex import LSHIndex
+from backend.Metrics import Metrics
+from backend.OpinionMatrix import OpinionMatrix
+from backend.PropagationQueue import PropagationQueue
+from backend.SimilarityKernels import KERNELS
+from backend.SimilarityStore import SimilarityStore, PAIR_BYTES
+from backend.Snapshot import openSnapshot, snapshotVersions
+from backend.engines import createFilter
+from backend.Evaluate import netflixOpinions, netflixProbe, splitOpinions, evaluate
+from backend.test import countingCalls
+from backend.utils import EXAMPLE, USERS, ITEMS, exampleDatabase, syntheticDatabase, syntheticOpinions, powerLawOpinions, ReadWriteLock
+import numpy as np
+import mmap
+import random
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+def denseRow(row, users, width=4):
+    """
+    Spreads a sparse row of similarity statistics over every user, with 0 for the users left out of it
+    """
+
+    dense = np.zeros((users, width))
+    if row is not None:
+        dense[row[0]] = row[1]
+    return dense
+
+
+def storedRow(collab, userIndex):
+    """
+    The row of similarity statistics the filter reads for a user, over every user
+    """
+
+    return denseRow(collab._similarityRow(userIndex), collab.opinions.shape[0], collab.kernel.width)
+
+
+class OpinionMatrixTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = exampleDatabase()
+        self.matrix = OpinionMatrix.fromDatabase(self.db)
+
+    def test_01_load(self):
+        #the whole table is loaded with dense indices
+        self.assertEqual(self.matrix.shape, (4, 4))
+        self.assertEqual(self.matrix.nnz, 15)
+        self.assertEqual(self.matrix.users(), USERS)
+        self.assertEqual(self.matrix.items(), ITEMS)
+        for user, row in zip(USERS, EXAMPLE):
+            for item, rating in zip(ITEMS, row):
+                self.assertEqual(self.matrix.opinion(user, item), rating)
+
+    def test_02_change(self):
+        #changing an existing opinion happens in place
+        self.assertEqual(self.matrix.setOpinion(1, 10, 4), 1)
+        self.assertEqual(self.matrix.opinion(1, 10), 4)
+        #adding a new one is merged into the csr structure when it is next read
+        self.assertEqual(self.matrix.setOpinion(2, 11, 3), 0)
+        self.assertEqual(self.matrix.opinion(2, 11), 3)
+        self.assertEqual(self.matrix.nnz, 16)
+        #and removing one drops it from the structure
+        self.assertEqual(self.matrix.setOpinion(3, 12, None), 1)
+        self.assertEqual(self.matrix.nnz, 15)
+        self.assertEqual(self.matrix.csr.toarray().tolist(), [[4, 2, 3, 5], [1, 3, 3, 5], [1, 1, 0, 1], [5, 5, 5, 5]])
+        self.assertEqual(self.matrix.column(2)[1].tolist(), [3, 3, 5])
+
+    def test_03_new_users_and_items(self):
+        self.matrix.setOpinion(5, 14, 2)
+        self.assertEqual(self.matrix.shape, (5, 5))
+        self.assertEqual(self.matrix.row(4)[0].tolist(), [4])
+        self.assertEqual(self.matrix.opinion(5, 10), 0)
+        self.assertEqual(self.matrix.opinion(6, 10), 0)
+
+    def test_04_in_place_change_with_more_users_than_items(self):
+        #the csc copy is changed in place too, even where a user index is past the number of items
+        matrix = OpinionMatrix.fromTriples([(user, 1, 1) for user in range(1, 7)] + [(6, 2, 2)])
+        self.assertEqual(matrix.column(0)[1].tolist(), [1] * 6)
+        matrix.setOpinion(6, 1, 5)
+        self.assertEqual(matrix.column(0)[1].tolist(), [1] * 5 + [5])
+        self.assertEqual((matrix.csc.toarray() == matrix.csr.toarray()).all(), True)
+
+    def test_05_compact_rows(self):
+        #ids are registered once, and a row is 8 bytes an opinion
+        self.assertEqual(self.matrix.itemRegistry.lookup([12, 99, 10]).tolist(), [2, -1, 0])
+        self.assertIs(self.matrix.userIndex, self.matrix.userRegistry.index)
+        items, ratings = self.matrix.row(0)
+        self.assertEqual(items.itemsize + ratings.itemsize, 8)
+        #the shared items come from merging the sorted rows
+        self.matrix.setOpinion(3, 12, None)
+        shared, userRatings, otherRatings = self.matrix.shared(0, 2)
+        self.assertEqual((shared.tolist(), userRatings.tolist(), otherRatings.tolist()), ([0, 1, 3], [1, 2, 5], [1, 1, 1]))
+
+
+class CollaborativeFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase())
+
+    def assertMatchesNoCache(self):
+        for user in USERS:
+            for item in ITEMS:
+                top, bottom = self.filter._noCacheRating(user, item)
+                self.assertAlmostEqual(self.filter.predictOpinion(user, item), top / bottom)
+
+    def test_01_example(self):
+        #the worked example from Math/CollabFilter.tex
+        self.assertAlmostEqual(self.filter._similarity(2, 3), 9 / (3 ** .5 * 35 ** .5))
+        self.assertAlmostEqual(self.filter.predictOpinion(2, 11), 2.638, places=2)
+
+    def test_02_matches_no_cache(self):
+        self.assertMatchesNoCache()
+
+    def test_03_vectorized_similarities(self):
+        #a whole row of similarity statistics matches the pair by pair calculation
+        for user in USERS:
+            row = storedRow(self.filter, self.filter.opinions.userIndex[user])
+            for other in USERS:
+                if other != user:
+                    index = self.filter.opinions.userIndex[other]
+                    for value, expected in zip(row[index], self.filter._setSimilarities(user, other)):
+                        self.assertAlmostEqual(value, expected)
+                    self.assertAlmostEqual(self.filter._similarity(user, other), self.filter._noCacheSimilarity(user, other))
+
+    def test_04_batch_predictions(self):
+        for user in USERS:
+            self.assertEqual(self.filter.predictOpinions(user, ITEMS), [self.filter.predictOpinion(user, item) for item in ITEMS])
+        #unknown items and users have no opinion
+        self.assertEqual(self.filter.predictOpinions(2, [11, 99]), [self.filter.predictOpinion(2, 11), 0])
+        self.assertEqual(self.filter.predictOpinions(99, [10]), [0])
+
+    def test_05_recommend(self):
+        #X has only not rated B
+        self.assertEqual(self.filter.recommend(2, 3), [(11, self.filter.predictOpinion(2, 11))])
+        ranked = self.filter.recommend(2, 3, excludeRated=False)
+        self.assertEqual(len(ranked), 3)
+        self.assertEqual([rating for item, rating in ranked], sorted(self.filter.predictOpinions(2, ITEMS), reverse=True)[:3])
+        self.assertEqual(self.filter.recommend(99, 3), [])
+
+    def test_06_change_opinion(self):
+        self.filter.changeOpinion(1, 12, 4)
+        self.assertEqual(self.filter.fetchOpinion(1, 12), 4)
+        self.assertEqual(self.filter._opinion(1, 12), 4)
+
+    def test_07_incremental_updates(self):
+        #a changed, an added and a removed opinion, then a new user rating a new item
+        changes = [(1, 12, 4), (2, 11, 4), (3, 12, None), (5, 14, 3), (5, 10, 2), (4, 13, None)]
+        for user, item, opinion in changes:
+            for known in self.filter.users():
+                self.filter.predictOpinions(known, self.filter.items())
+            cached = set(self.filter.calculated)
+            self.filter.changeOpinion(user, item, opinion)
+            #the caches were updated, not thrown away
+            self.assertEqual(cached, set(self.filter.calculated))
+            for userIndex in list(self.filter.similarities):
+                self.assertTrue(np.allclose(storedRow(self.filter, userIndex), self.filter._setUserSimilarities(userIndex)))
+            for known in self.filter.users():
+                for other in self.filter.items():
+                    expected = self.filter._ratingFromCalculated(*self.filter._noCacheRating(known, other))
+                    self.assertAlmostEqual(self.filter.predictOpinion(known, other), expected)
+
+    def test_08_lazy_refresh(self):
+        for known in self.filter.users():
+            self.filter.predictOpinions(known, self.filter.items())
+        before = {user: entry[0].copy() for user, entry in self.filter.calculated.items()}
+        self.filter.changeOpinion(1, 12, 4)
+        self.filter.changeOpinion(5, 14, 3)
+        #writes only stamp the versions, the entries are left as they were until they are read
+        self.assertEqual(self.filter.version, 2)
+        self.assertEqual(self.filter.userVersions.tolist(), [1, 0, 0, 0, 2])
+        for user, entry in self.filter.calculated.items():
+            self.assertEqual(entry[3], 0)
+            self.assertTrue(np.array_equal(entry[0], before[user]))
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=self.filter.db)
+        for known in fresh.users():
+            self.assertTrue(np.allclose(self.filter.predictOpinions(known, fresh.items()), fresh.predictOpinions(known, fresh.items())))
+        self.assertTrue(all(entry[3] == 2 for entry in self.filter.calculated.values()))
+
+    def test_09_apply_opinions(self):
+        for known in self.filter.users():
+            self.filter.predictOpinions(known, self.filter.items())
+        #the last change to an opinion wins, 3's opinion of 12 is changed and then removed
+        changes = [(1, 12, 4), (2, 11, 4), (3, 12, 2), (5, 14, 3), (5, 10, 2), (4, 13, None), (3, 12, None)]
+        self.filter.applyOpinions(changes)
+        self.assertEqual(self.filter.version, 1)
+        expected = {(1, 12): 4, (2, 11): 4, (3, 12): None, (5, 14): 3, (5, 10): 2, (4, 13): None}
+        for (user, item), opinion in expected.items():
+            self.assertEqual(self.filter.fetchOpinion(user, item), opinion)
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=self.filter.db)
+        for userIndex in list(self.filter.similarities):
+            self.assertTrue(np.allclose(storedRow(self.filter, userIndex), self.filter._setUserSimilarities(userIndex)))
+        for known in fresh.users():
+            self.assertTrue(np.allclose(self.filter.predictOpinions(known, fresh.items()), fresh.predictOpinions(known, fresh.items())))
+
+
+class NeighborModeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = exampleDatabase()
+
+    def test_01_nearest_neighbor(self):
+        #W is the most similar user to X, so with one neighbor X takes W's opinion of B
+        knn = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=1)
+        self.assertEqual(knn.predictOpinion(2, 11), 2)
+        users, similarities = knn._neighbors(knn.opinions.userIndex[2])
+        self.assertEqual([knn.opinions.userIds[index] for index in users], [1])
+        self.assertAlmostEqual(similarities[0], 1)
+
+    def test_02_all_neighbors(self):
+        #with enough neighbors the ratings are the same as without the index
+        full = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db)
+        knn = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=10)
+        for user in USERS:
+            for item, expected in zip(ITEMS, full.predictOpinions(user, ITEMS)):
+                self.assertAlmostEqual(knn.predictOpinion(user, item), expected)
+
+    def test_03_thresholds(self):
+        #X shares three items with everyone, so nobody is a neighbor when four are needed
+        knn = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=10, minShared=4)
+        self.assertEqual(knn.predictOpinion(2, 11), 0)
+        #and only W is more similar than .9
+        knn = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=10, minSimilarity=.9)
+        self.assertEqual(knn.predictOpinion(2, 11), 2)
+
+    def test_04_lsh_candidates(self):
+        knn = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=1, lsh=LSHIndex(bands=4, rows=2))
+        #a user is never their own candidate
+        for userIndex in range(len(USERS)):
+            self.assertNotIn(userIndex, knn.lsh.candidates(userIndex).tolist())
+        #a user who changes into a copy of another user ends up in all of the same buckets
+        knn.changeOpinion(3, 10, 1)
+        knn.changeOpinion(3, 11, 2)
+        knn.changeOpinion(3, 12, 3)
+        knn.changeOpinion(3, 13, 5)
+        self.assertEqual(knn.lsh.keys[0].tolist(), knn.lsh.keys[2].tolist())
+        self.assertIn(2, knn.lsh.candidates(0).tolist())
+
+    def test_05_lsh_neighbors(self):
+        #the neighbors found through the candidates are exact, so with enough candidates nothing is lost
+        exact = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=2)
+        approximate = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=2, lsh=LSHIndex(bands=64, rows=1))
+        for userIndex in range(len(USERS)):
+            self.assertEqual(len(approximate.lsh.candidates(userIndex)), len(USERS) - 1)
+            for found, expected in zip(approximate._neighbors(userIndex), exact._neighbors(userIndex)):
+                self.assertTrue(np.allclose(found, expected))
+
+    def test_06_change_opinion(self):
+        #after changes the neighbors and ratings are the same as a fresh engine's
+        knn = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=2)
+        for user, item, opinion in [(1, 12, 4), (2, 11, 4), (3, 12, None), (5, 14, 3)]:
+            for known in knn.users():
+                knn.predictOpinions(known, knn.items())
+            knn.changeOpinion(user, item, opinion)
+            fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=2)
+            for known in knn.users():
+                self.assertTrue(np.allclose(knn.predictOpinions(known, knn.items()), fresh.predictOpinions(known, knn.items())))
+
+
+class SimilarityStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase())
+
+    def test_01_pairs_stored_once(self):
+        for userIndex in range(len(USERS)):
+            self.filter._similarityRow(userIndex)
+        #every pair of the example users shares an item, and each is stored once
+        self.assertEqual(len(self.filter.similarities.keys), len(USERS) * (len(USERS) - 1) // 2)
+        for userIndex in range(len(USERS)):
+            self.assertTrue(np.allclose(denseRow(self.filter.similarities.row(userIndex), len(USERS)), self.filter._setUserSimilarities(userIndex)))
+
+    def test_02_turned_around(self):
+        #a row stored from one side is read from the other side with the rss values swapped
+        store = SimilarityStore()
+        row = self.filter._setUserSimilarities(2)
+        store.setRow(2, np.flatnonzero(row[:, 3]), row[np.flatnonzero(row[:, 3])])
+        self.assertEqual(store.row(0), None)
+        store.setRow(0, np.array([1, 2, 3]), self.filter._setUserSimilarities(0)[1:])
+        self.assertEqual(len(store.keys), 5)
+        self.assertTrue(np.allclose(denseRow(store.row(0), len(USERS))[2], row[0][[1, 0, 2, 3]]))
+        self.assertEqual(store.stats()["hits"], 1)
+
+    def test_03_shift(self):
+        #a change shifts each pair once, and pairs that start sharing an item are added
+        store = SimilarityStore()
+        store.setRow(0, np.array([1]), np.array([[2, 3, 6, 1]], dtype=float))
+        #user 0 rates an item 4 that user 1 rated 2 and user 2 rated 5
+        store.shift(0, np.array([1, 2]), 16, np.array([4, 25]), np.array([8, 20]), 1)
+        self.assertTrue(np.allclose(denseRow(store.row(0), 3), [[0, 0, 0, 0], [20 ** .5, 13 ** .5, 14, 2], [4, 5, 20, 1]]))
+        #and removed again when they share nothing
+        store.shift(2, np.array([0]), -25, -16, -20, -1)
+        self.assertTrue(np.allclose(denseRow(store.row(0), 3)[2], 0))
+        self.assertEqual(store.row(0)[0].tolist(), [1])
+
+    def test_04_precompute(self):
+        #every row of the parallel all pairs calculation matches the row calculated on its own
+        for db in (exampleDatabase(), syntheticDatabase(60, 25, .3)):
+            collab = CollaborativeFilter("test.db", "sqlite://", "main", db=db)
+            collab.precomputeSimilarities(workers=2, blockSize=16)
+            users = collab.opinions.shape[0]
+            self.assertEqual(len(collab.similarities), users)
+            for userIndex in range(users):
+                self.assertTrue(np.allclose(denseRow(collab.similarities.row(userIndex), users), collab._setUserSimilarities(userIndex)))
+        #and predictions made from it are the same as without it
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=db)
+        for user in collab.users()[:5]:
+            self.assertTrue(np.allclose(collab.predictOpinions(user, collab.items()), fresh.predictOpinions(user, fresh.items())))
+
+    def test_05_runs(self):
+        #rows stored one by one end up in a few runs, and pairs calculated again are written over wherever they are
+        store = SimilarityStore()
+        for userIndex in range(64):
+            others = np.delete(np.arange(64), userIndex)
+            store.setRow(userIndex, others, np.tile([1., 1., 1., 1.], (63, 1)))
+        self.assertEqual(store.stats()["pairs"], 64 * 63 // 2)
+        self.assertLess(store.stats()["runs"], 8)
+        store.setPairs(5, np.array([1, 60]), np.array([[0, 0, 0, 0], [2, 3, 4, 2]], dtype=float))
+        self.assertEqual(len(store.row(5)[0]), 62)
+        self.assertNotIn(1, store.row(5)[0].tolist())
+        self.assertTrue(np.allclose(denseRow(store.row(60), 64)[5], [3, 2, 4, 2]))
+        self.assertTrue(np.array_equal(store.keys, np.sort(store.keys)))
+
+    def test_06_precompute_unlocked(self):
+        #an opinion changed while the pairs are calculated, which only works if the lock is not held meanwhile, in a
+        #database file as the change is made on another thread
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        db = syntheticDatabase(40, 15, .3, path="sqlite:///" + os.path.join(folder, "precompute.db"))
+        self.addCleanup(db.engine.dispose)
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=db)
+        items, ratings = collab.opinions.row(0)
+        item, rating = collab.opinions.itemIds[items[0]], ratings[0] % 5 + 1
+        calculate = backend.CollabFilter.allPairs
+
+        def changing(*args):
+            writer = threading.Thread(target=collab.changeOpinion, args=(collab.users()[0], item, rating))
+            writer.start()
+            writer.join(5)
+            self.assertFalse(writer.is_alive())
+            return calculate(*args)
+
+        with unittest.mock.patch("backend.CollabFilter.allPairs", changing):
+            collab.precomputeSimilarities(workers=1)
+        self.assertEqual(collab.opinions.row(0)[1][0], rating)
+        users = collab.opinions.shape[0]
+        for userIndex in range(users):
+            self.assertTrue(np.allclose(denseRow(collab.similarities.row(userIndex), users), collab._setUserSimilarities(userIndex)))
+
+    def test_07_budget_indices(self):
+        #a lower user paired with a higher index than a later lower user, both over a budget
+        store = SimilarityStore(1, 4)
+        store.setRow(0, np.array([24]), np.array([[1., 1., 1., 1.]]))
+        store.setRow(1, np.array([5]), np.array([[2., 2., 2., 2.]]))
+        self.assertEqual((list(store), store.pairs), ([1], 1))
+        self.assertTrue(np.allclose(denseRow(store.row(1), 6)[5], 2))
+        #an engine over half of its precomputed size predicts the same as one without a budget
+        db = syntheticDatabase(40, 15, .3)
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=db)
+        fresh.precomputeSimilarities(workers=1)
+        budget = fresh.similarities.bytes // 2
+        small = CollaborativeFilter("test.db", "sqlite://", "main", db=db, similarityStore=SimilarityStore(budget))
+        small.precomputeSimilarities(workers=1)
+        self.assertLessEqual(small.similarities.bytes, budget)
+        for user in small.users()[:10]:
+            self.assertTrue(np.allclose(small.predictOpinions(user, small.items()), fresh.predictOpinions(user, fresh.items())))
+
+    def test_08_batched_eviction(self):
+        #every user is known after a load, the users to forget are worked out at once and compacted once
+        users = 30
+        lows, highs = np.triu_indices(users, 1)
+        keys = (lows.astype(np.int64) << 32) | highs
+        store = SimilarityStore(budget=len(keys) * PAIR_BYTES // 2)
+        with unittest.mock.patch.object(store, "_compact", wraps=store._compact) as compact:
+            store.load(keys, np.ones((len(keys), 4)), users)
+        self.assertEqual(compact.call_count, 1)
+        self.assertLessEqual(store.bytes, store.budget)
+        #as few users as possible are forgotten, the pairs of one more known user would not fit
+        forgotten = users - len(store)
+        self.assertEqual(store.evictions, forgotten)
+        self.assertGreater((len(keys) - (forgotten - 1) * forgotten // 2 + forgotten - 1) * PAIR_BYTES, store.budget)
+
+
+def waitForRecovery(queue, timeout=5):
+    #waits until a queue whose batches failed applies one again
+    deadline = time.monotonic() + timeout
+    while queue.error is not None and time.monotonic() < deadline:
+        time.sleep(.01)
+
+
+class PropagationTests(unittest.TestCase):
+
+    def test_01_coalescing(self):
+        batches, started, release = [], threading.Event(), threading.Event()
+        def apply(changes):
+            batches.append(changes)
+            started.set()
+            release.wait()
+        queue = PropagationQueue(apply)
+        queue.put(1, 10, 1)
+        started.wait()
+        #while the first batch is applied, two changes to the same opinion become one
+        queue.putMany([(1, 12, 4), (2, 11, 4), (1, 12, 2)])
+        self.assertEqual(queue.pending, 3)
+        self.assertGreater(queue.lag, 0)
+        release.set()
+        self.assertTrue(queue.flush())
+        self.assertEqual(batches, [[(1, 10, 1)], [(1, 12, 2), (2, 11, 4)]])
+        self.assertEqual((queue.pending, queue.lag), (0, 0))
+        self.assertEqual({key: queue.stats()[key] for key in ("queued", "coalesced", "applied", "batches")},
+                         {"queued": 4, "coalesced": 1, "applied": 3, "batches": 2})
+        queue.close()
+        self.assertRaises(RuntimeError, queue.put, 1, 10, 2)
+
+    def test_02_errors(self):
+        batches, failing = [], [True]
+        def apply(changes):
+            batches.append(changes)
+            if failing[0]:
+                raise KeyError(changes[0])
+        queue = PropagationQueue(apply, retryDelay=.01)
+        queue.put(1, 10, 1)
+        queue.put(2, 11, 3)
+        self.assertRaises(KeyError, queue.flush)
+        #the failed batch is kept, and the error is raised for as long as it keeps failing
+        queue.putMany([(2, 11, 5), (3, 12, 1)])
+        self.assertRaises(KeyError, queue.flush)
+        self.assertEqual(queue.pending, 3)
+        failing[0] = False
+        waitForRecovery(queue)
+        self.assertTrue(queue.flush(5))
+        #and tried again in front of the changes queued since, the newer ones winning
+        self.assertEqual(batches[-1], [(1, 10, 1), (2, 11, 5), (3, 12, 1)])
+        self.assertEqual({key: queue.stats()[key] for key in ("applied", "batches", "pending")}, {"applied": 3, "batches": 1, "pending": 0})
+        self.assertGreater(queue.stats()["failures"], 0)
+        queue.close()
+
+    def test_03_failed_batch(self):
+        #a batch that fails after changing the opinions is pushed out again in full
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase(), writeBehind=True)
+        collab.propagation.retryDelay = .01
+        for user in USERS:
+            collab.predictOpinions(user, ITEMS)
+        setPairs, failing = collab._setPairs, threading.Event()
+        def failingSetPairs(userIndex):
+            if failing.is_set():
+                raise RuntimeError("lost")
+            setPairs(userIndex)
+        collab._setPairs = failingSetPairs
+        failing.set()
+        collab.applyOpinions([(1, 12, 4), (2, 11, 4)])
+        self.assertRaises(RuntimeError, collab.flush)
+        self.assertEqual(collab._opinion(1, 12), 4)
+        failing.clear()
+        waitForRecovery(collab.propagation)
+        self.assertTrue(collab.flush(5))
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=collab.db)
+        for userIndex in list(collab.similarities):
+            self.assertTrue(np.allclose(storedRow(collab, userIndex), collab._setUserSimilarities(userIndex)))
+        for user in fresh.users():
+            self.assertTrue(np.allclose(collab.predictOpinions(user, fresh.items()), fresh.predictOpinions(user, fresh.items())))
+        collab.propagation.close()
+
+    def test_04_write_behind(self):
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase(), writeBehind=True)
+        for user in USERS:
+            collab.predictOpinions(user, ITEMS)
+        with collab.lock.writing():
+            #the opinions are stored before changeOpinion returns, and pushed out once the lock is let go of
+            collab.changeOpinion(1, 12, 4)
+            collab.changeOpinion(1, 12, 2)
+            collab.applyOpinions([(3, 12, None), (5, 14, 3)])
+            self.assertEqual(collab.fetchOpinion(1, 12), 2)
+            self.assertEqual(collab._opinion(1, 12), 3)
+            self.assertGreater(collab.pendingUpdates(), 0)
+        self.assertTrue(collab.flush())
+        self.assertEqual(collab.pendingUpdates(), 0)
+        self.assertEqual(collab._opinion(1, 12), 2)
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=collab.db)
+        for user in fresh.users():
+            self.assertTrue(np.allclose(collab.predictOpinions(user, fresh.items()), fresh.predictOpinions(user, fresh.items())))
+        collab.propagation.close()
+
+
+class ConcurrencyTests(unittest.TestCase):
+
+    def setUp(self):
+        #an in memory database is a different database in every thread
+        self.folder = tempfile.mkdtemp()
+        self.db = syntheticDatabase(10, 5, .5, seed=4, path="sqlite:///" + os.path.join(self.folder, "stress.db"))
+
+    def tearDown(self):
+        self.db.engine.dispose()
+        shutil.rmtree(self.folder)
+
+    def test_01_read_write_lock(self):
+        lock, events = ReadWriteLock(), []
+        def take(side, event):
+            with getattr(lock, side)():
+                events.append(event)
+        with lock.reading():
+            #readers share the lock
+            reader = threading.Thread(target=take, args=("reading", "read"))
+            reader.start()
+            reader.join(1)
+            #a writer waits for them, and a reader can take the lock again but can not become a writer
+            writer = threading.Thread(target=take, args=("writing", "written"))
+            writer.start()
+            writer.join(.1)
+            with lock.reading():
+                self.assertRaises(RuntimeError, lock.writing().__enter__)
+            self.assertEqual(events, ["read"])
+        writer.join(1)
+        self.assertEqual(events, ["read", "written"])
+
+    def stress(self, collab, changes, readers=3, writers=3):
+        #readers check every prediction against the cache free calculation while writers change opinions, with no
+        #locking of their own, the engine stores and pushes out each change under its lock
+        errors, done = [], threading.Event()
+        def read(seed):
+            rng = random.Random(seed)
+            while not done.is_set():
+                user, item = rng.choice(collab.users()), rng.choice(collab.items())
+                try:
+                    with collab.lock.reading():
+                        predicted = collab.predictOpinions(user, [item])[0]
+                        expected = collab._ratingFromCalculated(*collab._noCacheRating(user, item))
+                    if abs(predicted - expected) > 1e-6:
+                        errors.append((user, item, predicted, expected))
+                except Exception as error:
+                    errors.append(error)
+        def write(writer):
+            try:
+                mine = changes[writer::writers]
+                for position in range(0, len(mine), 3):
+                    if position % 2:
+                        collab.applyOpinions(mine[position:position + 3])
+                    else:
+                        for change in mine[position:position + 3]:
+                            collab.changeOpinion(*change)
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=read, args=(seed,)) for seed in range(readers)]
+        for thread in threads:
+            thread.start()
+        writing = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+        try:
+            for thread in writing:
+                thread.start()
+            for thread in writing:
+                thread.join()
+            collab.flush()
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        #whichever writer got there last, the engine holds the same opinions as the database
+        stored = OpinionMatrix.fromDatabase(collab.db)
+        self.assertEqual(sorted(collab.users()), sorted(stored.users()))
+        for user in stored.users():
+            for item in stored.items():
+                self.assertEqual(collab.opinions.opinion(user, item), stored.opinion(user, item))
+        for user in collab.users():
+            for item in collab.items():
+                self.assertAlmostEqual(collab.predictOpinion(user, item), collab._ratingFromCalculated(*collab._noCacheRating(user, item)))
+
+    def changes(self, count):
+        rng = random.Random(0)
+        return [(rng.randint(1, 12), rng.randint(1, 6), rng.choice([None, 1, 2, 3, 4, 5])) for change in range(count)]
+
+    def test_02_stress(self):
+        #small budgets, so that readers also evict each other's entries
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, similarityStore=SimilarityStore(budget=40 * PAIR_BYTES),
+                                     calculatedCache=Cache(budget=2000))
+        self.stress(collab, self.changes(36))
+
+    def test_03_stress_neighbors(self):
+        #with a neighbor for everyone the neighbor lists are picked and rebuilt, and still match every user
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=20, kernel="pearson")
+        self.stress(collab, self.changes(36))
+
+    def test_04_stress_write_behind(self):
+        #queued changes reach the caches in the order they were stored, readers would see them lag behind
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, writeBehind=True)
+        self.stress(collab, self.changes(36), readers=0)
+
+
+def isMapped(array):
+    #whether an array is a view of a memory mapped file
+    while array is not None and not isinstance(array, mmap.mmap):
+        array = getattr(array, "base", None)
+    return array is not None
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = syntheticDatabase(30, 12, .4)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_01_warm_start(self):
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=5)
+        for user in collab.users():
+            collab.predictOpinions(user, collab.items())
+        self.assertEqual(collab.saveSnapshot(self.folder), 1)
+
+        warm = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, neighbors=5, snapshot=self.folder)
+        #the opinions and statistics are mapped from the files, and every user is already known
+        self.assertTrue(isMapped(warm.opinions.csr.data) and isMapped(warm.opinions.csr.indices))
+        self.assertTrue(isMapped(warm.similarities.values))
+        self.assertEqual(len(warm.similarities), len(collab.users()))
+        self.assertEqual(len(warm.neighborIndex), len(collab.neighborIndex))
+        for user in collab.users():
+            self.assertTrue(np.allclose(warm.predictOpinions(user, warm.items()), collab.predictOpinions(user, collab.items())))
+        self.assertEqual(warm.similarities.stats()["misses"], 0)
+
+    def test_02_copy_on_write(self):
+        #changes made after opening a snapshot stay in the process, the files are left as they were
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db)
+        collab.precomputeSimilarities(workers=1)
+        collab.saveSnapshot(self.folder)
+        before = collab.predictOpinions(collab.users()[0], collab.items())
+
+        warm = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, snapshot=self.folder)
+        items, ratings = warm.opinions.row(0)
+        warm.changeOpinion(warm.users()[0], warm.opinions.itemIds[items[0]], ratings[0] % 5 + 1)
+        fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db)
+        self.assertTrue(np.allclose(warm.predictOpinions(warm.users()[1], warm.items()), fresh.predictOpinions(fresh.users()[1], fresh.items())))
+
+        arrays, metadata = openSnapshot(self.folder)
+        self.assertEqual(arrays["opinions.data"][0], collab.opinions.csr.data[0])
+        #the change reached the database, so the snapshot is stale and the opinions are loaded from the database
+        reopened = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, snapshot=self.folder)
+        self.assertFalse(isMapped(reopened.opinions.csr.data))
+        self.assertNotEqual(reopened.predictOpinions(reopened.users()[0], reopened.items()), before)
+        self.assertTrue(np.allclose(reopened.predictOpinions(reopened.users()[1], reopened.items()), fresh.predictOpinions(fresh.users()[1], fresh.items())))
+
+    def test_03_versions(self):
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db)
+        for version in range(1, 4):
+            self.assertEqual(collab.saveSnapshot(self.folder, keep=2), version)
+        self.assertEqual(snapshotVersions(self.folder), [2, 3])
+        #an empty directory is a cold start
+        cold = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, snapshot=os.path.join(self.folder, "none"))
+        self.assertEqual(len(cold.similarities), 0)
+
+    def test_04_stale(self):
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db)
+        collab.saveSnapshot(self.folder)
+        self.assertEqual(openSnapshot(self.folder)[1]["fingerprint"], list(collab.fetchFingerprint()))
+        self.assertTrue(isMapped(CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, snapshot=self.folder).opinions.csr.data))
+        #an opinion written to the database behind the engine's back, after the snapshot was saved
+        items, ratings = collab.opinions.row(0)
+        with self.db.session_scope() as session:
+            self.db.upsert_opinion(session, collab.users()[0], collab.opinions.itemIds[items[0]], ratings[0] % 5 + 1)
+        warm = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, snapshot=self.folder)
+        self.assertFalse(isMapped(warm.opinions.csr.data))
+        self.assertEqual(warm.opinions.row(0)[1][0], ratings[0] % 5 + 1)
+
+    def test_05_exact_fingerprint(self):
+        #a user with a huge id makes the user sum so large that swapping two ratings moves it by a tiny fraction
+        with self.db.session_scope() as session:
+            self.db.upsert_opinion(session, 10 ** 13, 1, 1)
+            self.db.upsert_opinion(session, 1, 1, 1)
+            self.db.upsert_opinion(session, 2, 1, 2)
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db)
+        collab.saveSnapshot(self.folder)
+        with self.db.session_scope() as session:
+            self.db.upsert_opinion(session, 1, 1, 2)
+            self.db.upsert_opinion(session, 2, 1, 1)
+        self.assertFalse(isMapped(CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, snapshot=self.folder).opinions.csr.data))
+
+
+class KernelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = syntheticDatabase(12, 6, .5, seed=4)
+
+    def test_01_matches_no_cache(self):
+        for kernel in sorted(KERNELS):
+            collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, kernel=kernel)
+            for user in collab.users():
+                for other in collab.users()[:4]:
+                    if other != user:
+                        self.assertAlmostEqual(collab._similarity(user, other), collab._noCacheSimilarity(user, other))
+                top, bottom = collab._noCacheRating(user, collab.items()[0])
+                self.assertAlmostEqual(collab.predictOpinion(user, collab.items()[0]), top / bottom if bottom else 0)
+
+    def test_02_no_cache_queries(self):
+        #the cache free rating fetches the user's opinions once, and each other user's shared opinions and profile once
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, kernel="pearson")
+        with countingCalls(collab) as counter:
+            collab._noCacheRating(collab.users()[0], collab.items()[0])
+        others = len(collab.users()) - 1
+        self.assertEqual((counter["fetchOpinions"], counter["fetchProfile"], counter["fetchOpinion"]), (others + 1, others, 0))
+
+    def test_03_pearson(self):
+        #the correlation over the shared items, each user centered on the mean of all of their opinions
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, kernel="pearson")
+        user, other = collab.users()[:2]
+        items, userRatings, otherRatings = collab._sharedRatings(user, other)
+        userCentered = userRatings - collab.opinions.row(0)[1].mean()
+        otherCentered = otherRatings - collab.opinions.row(1)[1].mean()
+        self.assertEqual(len(items), 4)
+        expected = userCentered.dot(otherCentered) / np.sqrt(userCentered.dot(userCentered) * otherCentered.dot(otherCentered))
+        self.assertAlmostEqual(collab._similarity(user, other), expected, places=5)
+        #only the kernels that read them keep the sums of the shared opinions
+        self.assertEqual(collab.similarities.width, 6)
+        self.assertEqual(CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, kernel="shrunk").similarities.width, 4)
+        self.assertRaises(ValueError, CollaborativeFilter, "test.db", "sqlite://", "main", db=self.db, kernel="pearson",
+                          similarityStore=SimilarityStore())
+
+    def test_04_incremental_updates(self):
+        #a change moves the user's mean, and with it their similarity to everyone they share an item with
+        for kernel in ("pearson", "adjusted"):
+            collab = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, kernel=kernel)
+            for user in collab.users():
+                collab.predictOpinions(user, collab.items())
+            for user, item, opinion in ((collab.users()[0], collab.items()[1], 5), (collab.users()[3], collab.items()[0], 0), (99, collab.items()[2], 2)):
+                collab.changeOpinion(user, item, opinion)
+            fresh = CollaborativeFilter("test.db", "sqlite://", "main", db=self.db, kernel=kernel)
+            for user in fresh.users():
+                self.assertTrue(np.allclose(collab.predictOpinions(user, fresh.items()), fresh.predictOpinions(user, fresh.items())))
+
+
+class CacheTests(unittest.TestCase):
+
+    def test_01_lru(self):
+        cache = Cache(budget=3, policy="lru", sizer=lambda value: 1)
+        cache["a"], cache["b"], cache["c"] = 1, 2, 3
+        cache["a"]
+        cache["d"] = 4
+        #b was used least recently
+        self.assertEqual(sorted(cache), ["a", "c", "d"])
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, cache.bytes), (1, 1, 1, 3))
+
+    def test_02_lfu(self):
+        cache = Cache(budget=3, policy="lfu", sizer=lambda value: 1)
+        cache["a"], cache["b"], cache["c"] = 1, 2, 3
+        for repeat in range(3):
+            cache["a"], cache["c"]
+        cache["d"] = 4
+        cache["e"] = 5
+        #b is used least, then d, while the newest entry is always kept
+        self.assertEqual(sorted(cache), ["a", "c", "e"])
+        self.assertEqual(cache.stats()["evictions"], 2)
+        self.assertRaises(ValueError, Cache, policy="fifo")
+
+    def test_03_budgeted_filter(self):
+        #with room for only a couple of rows everything is calculated again as needed, with the same results
+        db = exampleDatabase()
+        budget = 2 * Cache().sizer(np.zeros((len(USERS), 4)))
+        small = CollaborativeFilter("test.db", "sqlite://", "main", db=db, similarityStore=SimilarityStore(4 * PAIR_BYTES),
+                                    calculatedCache=Cache(budget, "lfu"))
+        full = CollaborativeFilter("test.db", "sqlite://", "main", db=db)
+        for user, item, opinion in [(None, None, None), (1, 12, 4), (3, 12, None), (5, 14, 3)]:
+            if user is not None:
+                small.changeOpinion(user, item, opinion)
+                full = CollaborativeFilter("test.db", "sqlite://", "main", db=db)
+            for known in full.users():
+                self.assertTrue(np.allclose(small.predictOpinions(known, full.items()), full.predictOpinions(known, full.items())))
+        stats = small.cacheStats()
+        self.assertGreater(stats["similarities"]["evictions"], 0)
+        self.assertGreater(stats["calculated"]["evictions"], 0)
+        self.assertLessEqual(small.similarities.bytes, 4 * PAIR_BYTES)
+
+
+class ItemFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = exampleDatabase()
+
+    def expected(self, user, item, adjusted=False):
+        """
+        the item based rating worked out by hand from the example matrix
+        """
+
+        matrix = np.array(EXAMPLE, dtype=float)
+        values = matrix.copy()
+        if adjusted:
+            for row in range(len(matrix)):
+                rated = matrix[row] != 0
+                values[row][rated] -= matrix[row][rated].mean()
+        column = ITEMS.index(item)
+        top = bottom = 0
+        for other in range(len(ITEMS)):
+            if other == column or not matrix[USERS.index(user)][other]:
+                continue
+            shared = (matrix[:, column] != 0) & (matrix[:, other] != 0)
+            rss = (values[shared, column] ** 2).sum() ** .5 * (values[shared, other] ** 2).sum() ** .5
+            similarity = 0 if rss == 0 else (values[shared, column] * values[shared, other]).sum() / rss
+            top += similarity * matrix[USERS.index(user)][other]
+            bottom += abs(similarity)
+        return 0 if bottom == 0 else top / bottom
+
+    def test_01_predictions(self):
+        for adjusted in (False, True):
+            engine = ItemFilter("test.db", "sqlite://", "main", db=self.db, adjusted=adjusted)
+            for user in USERS:
+                for item in ITEMS:
+                    self.assertAlmostEqual(engine.predictOpinion(user, item), self.expected(user, item, adjusted))
+                for rating, item in zip(engine.predictOpinions(user, ITEMS), ITEMS):
+                    self.assertAlmostEqual(rating, engine.predictOpinion(user, item))
+
+    def test_02_change_opinion(self):
+        #the statistics after a change are the same as recalculating them from scratch
+        for adjusted in (False, True):
+            engine = ItemFilter("test.db", "sqlite://", "main", db=self.db, adjusted=adjusted)
+            engine.changeOpinion(2, 11, 4)
+            engine.changeOpinion(3, 12, None)
+            engine.changeOpinion(5, 14, 3)
+            fresh = ItemFilter("test.db", "sqlite://", "main", db=self.db, adjusted=adjusted)
+            self.assertEqual(fresh.items(), engine.items())
+            self.assertTrue(np.allclose(engine.multSum, fresh.multSum))
+            self.assertTrue(np.allclose(engine.squareSum, fresh.squareSum))
+            #put the example back for the next pass
+            engine.changeOpinion(2, 11, None)
+            engine.changeOpinion(3, 12, 1)
+            engine.changeOpinion(5, 14, None)
+
+    def test_03_engines(self):
+        self.assertIsInstance(createFilter("item", "test.db", "sqlite://", "main", db=self.db), ItemFilter)
+        self.assertIsInstance(createFilter("user", "test.db", "sqlite://", "main", db=self.db), CollaborativeFilter)
+        self.assertRaises(ValueError, createFilter, "nope", "test.db", "sqlite://", "main", db=self.db)
+        #more items than the dense statistics are allowed to take up
+        self.assertRaises(ValueError, createFilter, "item", "test.db", "sqlite://", "main", db=self.db, maxItems=len(ITEMS) - 1)
+
+    def test_04_no_drift(self):
+        #many changes leave the statistics where calculating them again puts them, single precision drifts 1e-4 here
+        db = syntheticDatabase(30, 8, .6, seed=2)
+        engine = ItemFilter("test.db", "sqlite://", "main", db=db)
+        users, items = engine.users(), engine.items()
+        for change in range(300):
+            engine.changeOpinion(users[change % 7], items[change % 5], change * 37 % 41 / 10 + 1)
+        fresh = ItemFilter("test.db", "sqlite://", "main", db=db)
+        self.assertTrue(np.allclose(engine.multSum, fresh.multSum, rtol=0, atol=1e-9))
+        self.assertTrue(np.allclose(engine.squareSum, fresh.squareSum, rtol=0, atol=1e-9))
+
+    def test_05_concurrent_changes(self):
+        #writers with no locking of their own leave the statistics the same as a fresh engine's, in a database file
+        #as an in memory database is a different database in every thread
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        db = syntheticDatabase(10, 5, .5, seed=4, path="sqlite:///" + os.path.join(folder, "items.db"))
+        self.addCleanup(db.engine.dispose)
+        engine = ItemFilter("test.db", "sqlite://", "main", db=db, adjusted=True)
+        changes = [(user, user % 5 + 1, user % 5 + 1) for user in range(1, 12)] + [(2, 1, 3), (5, 6, 2), (1, 3, None)]
+        def write(changes):
+            for change in changes:
+                engine.changeOpinion(*change)
+            engine.applyOpinions(changes)
+        writers = [threading.Thread(target=write, args=(changes[start::3],)) for start in range(3)]
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        fresh = ItemFilter("test.db", "sqlite://", "main", db=db, adjusted=True)
+        self.assertEqual(engine.multSum.dtype, np.float64)
+        self.assertTrue(np.allclose(engine.multSum, fresh.multSum, atol=1e-5))
+        self.assertTrue(np.allclose(engine.squareSum, fresh.squareSum, atol=1e-5))
+
+
+class FactorFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = syntheticDatabase(60, 20, .5)
+        self.engine = FactorFilter("test.db", "sqlite://", "main", db=self.db, factors=5)
+
+    def test_01_training(self):
+        #the factors explain the known opinions better than the mean does
+        matrix = self.engine.opinions.csr
+        users, items = matrix.nonzero()
+        predicted = [self.engine.predictOpinion(self.engine.opinions.userIds[user], self.engine.opinions.itemIds[item])
+                     for user, item in zip(users, items)]
+        known = np.asarray(matrix[users, items]).ravel()
+        self.assertLess(np.sqrt(np.mean((predicted - known) ** 2)), .75 * known.std())
+        for rating, item in zip(self.engine.predictOpinions(1, self.engine.items()), self.engine.items()):
+            self.assertAlmostEqual(rating, self.engine.predictOpinion(1, item))
+
+    def test_02_fold_in(self):
+        itemFactors = self.engine.itemFactors.copy()
+        self.engine.changeOpinion(1, 3, 5)
+        #only the user moves, to where solving with the item factors fixed puts them
+        self.assertTrue(np.array_equal(itemFactors, self.engine.itemFactors))
+        row = self.engine.opinions.csr[self.engine.opinions.userIndex[1]].astype(np.float64)
+        row.data -= self.engine.mean
+        self.assertTrue(np.allclose(self.engine.userFactors[self.engine.opinions.userIndex[1]],
+                                    self.engine._solve(row, itemFactors)[0]))
+
+        #new users and items are folded in too
+        item = self.engine.opinions.itemIds[self.engine.opinions.row(self.engine.opinions.userIndex[2])[0][0]]
+        self.engine.applyOpinions([(1, 200, 4), (100, item, 5), (2, item, 1)])
+        self.assertEqual(self.engine.opinions.opinion(1, 200), 4)
+        self.assertEqual(self.engine.opinions.opinion(2, item), 1)
+        self.assertTrue(self.engine.itemFactors[self.engine.opinions.itemIndex[200]].any())
+        self.assertTrue(self.engine.userFactors[self.engine.opinions.userIndex[100]].any())
+
+    def test_03_save_and_load(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "factors.npz")
+        trained = FactorFilter("test.db", "sqlite://", "main", db=self.db, factors=5, factorsPath=path)
+        self.assertTrue(os.path.exists(path))
+        loaded = FactorFilter("test.db", "sqlite://", "main", db=self.db, factors=5, iterations=0, factorsPath=path)
+        self.assertTrue(np.allclose(trained.predictOpinions(1, trained.items()), loaded.predictOpinions(1, loaded.items())))
+
+        #the users whose opinions changed since the factors were saved are folded in when they are loaded, whoever
+        #changed them
+        trained.changeOpinion(1, 3, 5)
+        with self.db.session_scope() as session:
+            self.db.upsert_opinion(session, 2, 3, 1)
+        loaded = FactorFilter("test.db", "sqlite://", "main", db=self.db, factors=5, iterations=0, factorsPath=path)
+        for user in (1, 2):
+            row = loaded.opinions.csr[loaded.opinions.userIndex[user]].astype(np.float64)
+            row.data -= loaded.mean
+            self.assertTrue(np.allclose(loaded.userFactors[loaded.opinions.userIndex[user]], loaded._solve(row, loaded.itemFactors)[0]))
+        self.assertTrue(np.allclose(trained.predictOpinions(3, trained.items()), loaded.predictOpinions(3, loaded.items())))
+
+        #factors saved with another width are trained again, and can not be loaded as they are
+        wider = FactorFilter("test.db", "sqlite://", "main", db=self.db, factors=7, factorsPath=path)
+        self.assertEqual(wider.userFactors.shape[1], 7)
+        self.assertRaises(ValueError, self.engine.load, path)
+        shutil.rmtree(folder)
+        self.assertIsInstance(createFilter("factor", "test.db", "sqlite://", "main", db=self.db), FactorFilter)
+
+    def test_04_committed_writes(self):
+        #a write straight to the database is folded in once it commits, and a rolled back one is not
+        item = self.engine.opinions.itemIds[self.engine.opinions.row(self.engine.opinions.userIndex[1])[0][0]]
+        rating = self.engine.opinions.opinion(1, item) % 5 + 1
+        with self.db.session_scope() as session:
+            self.db.update_opinion(session, 1, item, rating)
+            self.assertNotEqual(self.engine.opinions.opinion(1, item), rating)
+        self.assertEqual(self.engine.opinions.opinion(1, item), rating)
+        row = self.engine.opinions.csr[self.engine.opinions.userIndex[1]].astype(np.float64)
+        row.data -= self.engine.mean
+        self.assertTrue(np.allclose(self.engine.userFactors[self.engine.opinions.userIndex[1]],
+                                    self.engine._solve(row, self.engine.itemFactors)[0]))
+
+        userFactors = self.engine.userFactors.copy()
+        session = self.db.sessionmaker()
+        self.db.update_opinion(session, 1, item, rating % 5 + 1)
+        session.rollback()
+        session.close()
+        self.assertEqual(self.engine.opinions.opinion(1, item), rating)
+        self.assertTrue(np.array_equal(userFactors, self.engine.userFactors))
+
+
+class EvaluationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_01_netflix_format(self):
+        os.mkdir(os.path.join(self.folder, "training_set"))
+        for movie, lines in ((1, ["6,3,2005-09-06", "7,5,2005-05-13"]), (2, ["6,4,2005-10-19", "8,1,2004-12-28"])):
+            with open(os.path.join(self.folder, "training_set", "mv_{:07}.txt".format(movie)), "w") as movieFile:
+                movieFile.write("{}:\n{}\n".format(movie, "\n".join(lines)))
+        with open(os.path.join(self.folder, "probe.txt"), "w") as probeFile:
+            probeFile.write("2:\n6\n")
+        opinions = list(netflixOpinions(os.path.join(self.folder, "training_set")))
+        self.assertEqual(opinions, [(6, 1, 3), (7, 1, 5), (6, 2, 4), (8, 2, 1)])
+        self.assertEqual(list(netflixOpinions(os.path.join(self.folder, "training_set"), movies=1)), opinions[:2])
+        probe = netflixProbe(os.path.join(self.folder, "probe.txt"))
+        train, holdout = splitOpinions(opinions, probe)
+        self.assertEqual((list(train), list(holdout)), (opinions[:2] + opinions[3:], [(6, 2, 4)]))
+
+    def test_02_evaluate(self):
+        opinions = syntheticOpinions(40, 15, .4)
+        train, holdout = splitOpinions(opinions, fraction=.2)
+        train, holdout = list(train), list(holdout)
+        #the same seed gives the same split
+        again, againHoldout = splitOpinions(opinions, fraction=.2)
+        self.assertEqual((list(again), list(againHoldout)), (train, holdout))
+        self.assertEqual(len(train) + len(holdout), len(opinions))
+        cached = evaluate(train, holdout, "user", warm=True)
+        uncached = evaluate(train, holdout[:10], "user", cache=False)
+        for results in (cached, uncached, evaluate(train, holdout, "item")):
+            self.assertGreater(results["predictions/sec"], 0)
+            self.assertLessEqual(results["p50 ms"], results["p99 ms"])
+            self.assertTrue(0 < results["mae"] <= results["rmse"] < 4)
+            self.assertGreater(results["coverage"], .9)
+        #the cache free predictions are the same ones, only slower
+        self.assertAlmostEqual(evaluate(train, holdout[:10], "user")["rmse"], uncached["rmse"])
+        #warming is opt in, without it the similarities are computed as the predictions miss them
+        self.assertEqual(cached["similarities hit rate"], 1)
+        self.assertLess(evaluate(train, holdout, "user")["similarities hit rate"], 1)
+        self.assertEqual((cached["train"], cached["holdout"]), (len(train), len(holdout)))
+
+    def test_03_streamed_split(self):
+        opinions = syntheticOpinions(30, 10, .5)
+        read = []
+        def source():
+            for opinion in opinions:
+                read.append(opinion)
+                yield opinion
+        train, holdout = splitOpinions(source(), fraction=.5, blockSize=3)
+        #nothing is read ahead of the training opinion asked for, and the held out ones wait for the rest
+        first = next(train)
+        self.assertEqual(read[-1], first)
+        self.assertRaises(RuntimeError, list, holdout)
+        train = [first] + list(train)
+        self.assertEqual(len(read), len(opinions))
+        #the draws come in blocks but the split is the one drawn all at once
+        held = np.random.RandomState(0).random_sample(len(opinions)) < .5
+        self.assertEqual(train, [opinion for opinion, out in zip(opinions, held) if not out])
+        self.assertEqual(list(holdout), [opinion for opinion, out in zip(opinions, held) if out])
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_01_power_law(self):
+        opinions = powerLawOpinions(300, 80, .05)
+        self.assertEqual(len({(user, item) for user, item, rating in opinions}), len(opinions))
+        self.assertTrue(all(1 <= rating <= 5 for user, item, rating in opinions))
+        #the first users and items have far more opinions than the typical one
+        users = np.bincount([user for user, item, rating in opinions])
+        items = np.bincount([item for user, item, rating in opinions])
+        self.assertGreater(users[1], 10 * np.median(users[1:]))
+        self.assertGreater(items[1], 5 * np.median(items[1:]))
+
+    def test_02_counting_calls(self):
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase())
+        with countingCalls(collab) as counter:
+            collab.predictOpinion(2, 11)
+            collab.predictOpinion(2, 12)
+        #the second prediction is read from the cache
+        self.assertEqual((counter["predictOpinion"], counter["_calculateWeights"]), (2, 1))
+        self.assertNotIn("predictOpinion", vars(collab))
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_01_disabled(self):
+        metrics = Metrics()
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase(), metrics=metrics)
+        collab.predictOpinion(2, 11)
+        collab.changeOpinion(2, 11, 4)
+        self.assertIsNone(metrics.start())
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot["counters"], snapshot["histograms"]), ([], []))
+
+    def test_02_engine(self):
+        metrics = Metrics(enabled=True)
+        collab = CollaborativeFilter("test.db", "sqlite://", "main", db=exampleDatabase(), metrics=metrics)
+        collab.predictOpinion(2, 11)
+        collab.predictOpinion(2, 12)
+        collab.predictOpinions(3, [10, 11])
+        collab.changeOpinion(2, 11, 4)
+        counters = {(counter["name"], tuple(sorted(counter["labels"].items()))): counter["value"] for counter in metrics.snapshot()["counters"]}
+        self.assertEqual(counters[("predictions", ())], 4)
+        self.assertEqual(counters[("opinion_changes", ())], 1)
+        self.assertEqual(counters[("db_queries", (("operation", "store"),))], 1)
+        self.assertEqual(counters[("neighbors_visited", ())], 2 * len(USERS))
+        self.assertGreater(counters[("similarity_pairs", ())], 0)
+
+        histograms = {(histogram["name"], histogram["labels"]["call"]): histogram for histogram in metrics.snapshot()["histograms"]}
+        self.assertEqual(histograms[("prediction_seconds", "predictOpinion")]["count"], 2)
+        self.assertEqual(histograms[("prediction_seconds", "predictOpinion")]["buckets"]["+Inf"], 2)
+        self.assertEqual(histograms[("propagation_seconds", "changeOpinion")]["count"], 1)
+        #the second prediction was read from the cache, and the cache counts its own hits
+        gauges = {(gauge["name"], gauge["labels"]["cache"]): gauge["value"] for gauge in metrics.snapshot()["gauges"]}
+        self.assertGreater(gauges[("cache_hits", "calculated")], 0)
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()["counters"], [])
+        #a gone engine's caches are not read any more
+        del collab
+        self.assertEqual(metrics.snapshot()["gauges"], [])
+
+    def test_03_prometheus(self):
+        metrics = Metrics(enabled=True, buckets=(.1, 1))
+        metrics.count("predictions", 3)
+        metrics.observe("prediction_seconds", .5, call="predictOpinion")
+        metrics.collect("queue", lambda: {"pending": 2, "closed": False})
+        self.assertEqual(metrics.prometheus().splitlines(), [
+            "# TYPE classrank_predictions_total counter",
+            "classrank_predictions_total 3",
+            "# TYPE classrank_prediction_seconds histogram",
+            'classrank_prediction_seconds_bucket{call="predictOpinion",le="0.1"} 0',
+            'classrank_prediction_seconds_bucket{call="predictOpinion",le="1"} 1',
+            'classrank_prediction_seconds_bucket{call="predictOpinion",le="+Inf"} 1',
+            'classrank_prediction_seconds_sum{call="predictOpinion"} 0.5',
+            'classrank_prediction_seconds_count{call="predictOpinion"} 1',
+            "# TYPE classrank_queue_pending gauge",
+            "classrank_queue_pending 2",
+            ])
+
+
+if __name__ == "__main__":
+    unittest.main()
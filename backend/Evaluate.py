@@ -0,0 +1,241 @@
+"""
+Measures how accurate and how fast a filtering engine is, on opinions in the
+Netflix prize format or on synthetic ones.
+"""
+
+from array import array
+from collections import OrderedDict
+from sys import argv, stdout
+from timeit import default_timer
+import json
+import os
+import resource
+import numpy as np
+
+from backend.engines import createFilter
+import databases.database as databases
+
+
+def netflixOpinions(folder, movies=None):
+    """
+    Reads the opinions in a Netflix training_set folder, one file a movie, each starting with "movie:" and followed by
+        "customer,rating,date" lines.  Customers are the users and movies the items
+
+    Arguments:
+        folder -> the training_set folder
+        movies -> the most movie files to read, in name order, None for all of them
+
+    Return -> a generator of tuple(user, item, rating)
+    """
+
+    names = sorted(name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name)))
+    for name in names[:movies]:
+        with open(os.path.join(folder, name)) as movieFile:
+            movie = None
+            for line in movieFile:
+                line = line.strip()
+                if line.endswith(":"):
+                    movie = int(line[:-1])
+                elif line:
+                    customer, rating = line.split(",")[:2]
+                    yield (int(customer), movie, int(rating))
+
+
+def netflixProbe(path):
+    """
+    Reads a Netflix probe file, "movie:" lines each followed by the customers whose opinion of it is held out
+
+    Arguments:
+        path -> the probe.txt file
+
+    Return -> a set of tuple(user, item)
+    """
+
+    probe, movie = set(), None
+    with open(path) as probeFile:
+        for line in probeFile:
+            line = line.strip()
+            if line.endswith(":"):
+                movie = int(line[:-1])
+            elif line:
+                probe.add((int(line), movie))
+    return probe
+
+
+class Holdout(object):
+    """
+    The opinions a split holds out, kept as three arrays instead of a list of tuples.  It is filled in as the training
+        opinions are read, and can only be read once all of them have been
+    """
+
+    def __init__(self):
+        self.users, self.items, self.ratings = array("q"), array("q"), array("f")
+        self.complete = False
+
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        if not self.complete:
+            raise RuntimeError("The held out opinions are only known once every training opinion has been read")
+        return zip(self.users, self.items, self.ratings)
+
+
+    def append(self, user, item, rating):
+        self.users.append(user)
+        self.items.append(item)
+        self.ratings.append(rating)
+
+
+def splitOpinions(opinions, probe=None, fraction=.1, seed=0, blockSize=65536):
+    """
+    Holds some of the opinions out of training, those in the probe set or else a random fraction of them.  The
+        opinions are streamed, never all in memory at once: the training ones are yielded as they are read and the
+        held out ones kept in a Holdout.  The same opinions and seed always give the same split
+
+    Arguments:
+        opinions  -> an iterable of tuple(user, item, rating)
+        probe     -> a set of tuple(user, item) to hold out, None for a random split
+        fraction  -> the fraction of the opinions held out by a random split
+        seed      -> the seed of the random split
+        blockSize -> the number of random draws made at a time, it does not change the split
+
+    Return -> tuple(generator of the training opinions, Holdout of the held out opinions, filled as the generator is read)
+    """
+
+    holdout = Holdout()
+    return (_splitTraining(opinions, probe, fraction, seed, blockSize, holdout), holdout)
+
+
+def _splitTraining(opinions, probe, fraction, seed, blockSize, holdout):
+    """
+    Yields the training opinions of splitOpinions and appends the others to holdout
+    """
+
+    random = np.random.RandomState(seed)
+    draws, position = np.empty(0), 0
+    for user, item, rating in opinions:
+        if probe is not None:
+            out = (user, item) in probe
+        else:
+            #drawn a block at a time from the same stream, so the split is the one drawing them all at once gives
+            if position == len(draws):
+                draws, position = random.random_sample(blockSize), 0
+            out = draws[position] < fraction
+            position += 1
+        if out:
+            holdout.append(user, item, rating)
+        else:
+            yield (user, item, rating)
+    holdout.complete = True
+
+
+def trainingDatabase(opinions, path="sqlite://"):
+    """
+    Creates a database holding only the training opinions
+
+    Arguments:
+        opinions -> an iterable of tuple(user, item, rating)
+        path     -> the sqlalchemy database url, an in memory database by default
+
+    Return -> tuple(the new databases.database.Database, the number of opinions loaded)
+    """
+
+    db = databases.Database("evaluation.db", path)
+    return db, db.bulk_load_opinions(opinions)["rows"]
+
+
+def evaluate(train, holdout, engine="user", warm=False, **options):
+    """
+    Trains an engine on some opinions and predicts the held out ones, a user at a time with predictOpinions
+
+    Arguments:
+        train   -> an iterable of tuple(user, item, rating) the engine learns from, read once
+        holdout -> an iterable of tuple(user, item, rating) the engine predicts, read once the training
+                   opinions have been, as splitOpinions fills it while they are
+        engine  -> the name of the engine, see backend.engines
+        warm    -> precomputes every similarity before predicting, for engines that can, instead of
+                   computing them as the predictions need them
+        options -> passed on to the engine, such as cache=False or neighbors=20
+
+    Return -> an OrderedDict of the results: the opinions, the seconds spent training and warming, the rmse and mae
+              over the predictions the engine could make and the fraction it could make, the predictions a second,
+              the p50 and p99 latency of a user's batch in milliseconds, the peak rss in megabytes, and the hit rates
+              of the engine's caches
+    """
+
+    start = default_timer()
+    db, trained = trainingDatabase(train)
+    model = createFilter(engine, "evaluation.db", "sqlite://", "opinions", db=db, **options)
+    trainSeconds = default_timer() - start
+
+    start = default_timer()
+    if warm and options.get("cache", True) and hasattr(model, "precomputeSimilarities"):
+        model.precomputeSimilarities()
+    warmSeconds = default_timer() - start
+
+    byUser, held = OrderedDict(), 0
+    for user, item, rating in holdout:
+        byUser.setdefault(user, []).append((item, rating))
+        held += 1
+
+    latencies, predicted, actual = [], [], []
+    for user, opinions in byUser.items():
+        items = [item for item, rating in opinions]
+        start = default_timer()
+        predictions = model.predictOpinions(user, items)
+        latencies.append(default_timer() - start)
+        predicted.extend(predictions)
+        actual.extend(rating for item, rating in opinions)
+
+    predicted, actual = np.array(predicted, dtype=np.float64), np.array(actual, dtype=np.float64)
+    #an engine predicts 0 when it knows nothing of the user or the item, those are counted in coverage, not error
+    made = predicted != 0
+    errors = predicted[made] - actual[made]
+    seconds = sum(latencies)
+
+    results = OrderedDict()
+    results["engine"] = engine
+    results["train"] = trained
+    results["holdout"] = held
+    results["train seconds"] = trainSeconds
+    results["warm seconds"] = warmSeconds
+    results["rmse"] = float(np.sqrt(np.mean(errors ** 2))) if len(errors) else None
+    results["mae"] = float(np.mean(np.abs(errors))) if len(errors) else None
+    results["coverage"] = float(made.mean()) if len(made) else None
+    results["predictions/sec"] = len(predicted) / seconds if seconds else None
+    results["p50 ms"] = float(np.percentile(latencies, 50) * 1000) if latencies else None
+    results["p99 ms"] = float(np.percentile(latencies, 99) * 1000) if latencies else None
+    #ru_maxrss is in kilobytes on linux, and the peak of the whole process, not just of this engine
+    results["peak rss mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    if hasattr(model, "cacheStats"):
+        for name, stats in model.cacheStats().items():
+            results[name + " hit rate"] = stats["hit rate"]
+    return results
+
+
+def report(results, out=stdout):
+    """
+    Writes the results of evaluate, one per line
+
+    Arguments:
+        results -> the OrderedDict from evaluate
+        out     -> the file to write to
+
+    Return -> None
+    """
+
+    for name, value in results.items():
+        out.write("{}: {}\n".format(name, "{:.4f}".format(value) if isinstance(value, float) else value))
+
+
+if __name__ == "__main__":
+    #python3 -m backend.Evaluate training_set [probe.txt] [engine] [movies] ['{"engine": "options"}']
+    folder = argv[1]
+    probe = netflixProbe(argv[2]) if len(argv) > 2 and argv[2] != "-" else None
+    engine = argv[3] if len(argv) > 3 else "user"
+    movies = int(argv[4]) if len(argv) > 4 else None
+    options = json.loads(argv[5]) if len(argv) > 5 else {}
+    train, holdout = splitOpinions(netflixOpinions(folder, movies), probe)
+    report(evaluate(train, holdout, engine, **options))
@@ -0,0 +1,365 @@
+"""
+The latent factor (matrix factorization) filtering engine.
+"""
+
+
+from backend.BaseFilter import BaseFilter
+from sys import stdout
+import numpy as np
+import os
+
+class FactorFilter(BaseFilter):
+    """
+    A matrix factorization engine trained with alternating least squares.
+    Every user and item gets a vector of latent factors, and an opinion is
+    predicted as mean + user factors . item factors, a single dot product.
+    Scoring every item for a user is one matrix-vector product.
+
+    New opinions are folded in once the database commits them, whether they
+    come through changeOpinion, applyOpinions or a write straight to the
+    database such as Database.update_opinion, by solving for the user's
+    factors again with the item factors held fixed, which is O(items the user
+    rated), instead of retraining everything.
+    The factors are saved to a .npz file so a restart does not retrain either,
+    along with a digest of every user's opinions, so the users whose opinions
+    changed since the factors were saved are folded in again when they are
+    loaded, whether the engine or anything else changed them.
+    """
+
+    def __init__(self, name, path, table, debug=False, cache=True, db=None, factors=20, regularization=.1,
+                 iterations=10, seed=0, factorsPath=None):
+        """
+        Initilialies the factor filter, loading the factors from factorsPath if it exists and training them otherwise
+
+        Arguments:
+            name           -> the name of the database file
+            path           -> the path to the database file (an sqlalchemy database url)
+            table          -> the name of the table in the database file
+            debug          -> activates debug mode, providing additional outputs and
+                              information about what is happening
+            cache          -> kept for compatibility with CollaborativeFilter
+            db             -> an already open databases.database.Database, used
+                              instead of opening name/path when provided
+            factors        -> the number of latent factors for each user and item
+            regularization -> the weight of the l2 penalty on the factors
+            iterations     -> the number of alternating least squares sweeps
+            seed           -> the seed for the initial item factors
+            factorsPath    -> a .npz file the factors are saved to after training
+                              and loaded from on the next start, they are
+                              trained again if it has a different number of
+                              factors
+        """
+
+        super(FactorFilter, self).__init__(name, path, table, debug, cache, db)
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.seed = seed
+        self.factorsPath = factorsPath
+
+        #implemented as arrays of shape (users, factors) and (items, factors) by dense index
+        self.userFactors = None
+        self.itemFactors = None
+        #the mean of every opinion, the factors model the differences from it
+        self.mean = 0
+
+        loaded = False
+        if factorsPath is not None and os.path.exists(factorsPath):
+            try:
+                self.load(factorsPath)
+                loaded = True
+            except ValueError as error:
+                #saved with another number of factors, they are trained again and written over
+                if self.debug:
+                    stdout.write("Training the factors again: {}\n".format(error))
+        if not loaded:
+            self.train()
+            if factorsPath is not None:
+                self.save(factorsPath)
+        self.db.opinion_listeners.append(self._foldInCommitted)
+
+
+    def train(self):
+        """
+        Trains the factors from scratch on every opinion
+
+        Return -> None
+        """
+
+        matrix = self.opinions.csr
+        self.mean = float(matrix.data.mean()) if matrix.nnz else 0
+        centered = matrix.astype(np.float64)
+        centered.data -= self.mean
+        byItem = centered.T.tocsr()
+
+        random = np.random.RandomState(self.seed)
+        self.itemFactors = random.normal(0, .1, (matrix.shape[1], self.factors))
+        self.userFactors = np.zeros((matrix.shape[0], self.factors))
+        for iteration in range(self.iterations):
+            self.userFactors = self._solve(centered, self.itemFactors)
+            self.itemFactors = self._solve(byItem, self.userFactors)
+
+
+    def _solve(self, matrix, fixed, rows=None, blockSize=100000):
+        """
+        Solves the regularized least squares problem for some rows' factors with the other side's factors held fixed,
+            in vectorized blocks
+
+        Arguments:
+            matrix    -> a csr matrix of centered opinions, with the rows being solved for as rows
+            fixed     -> the factors of the columns of matrix
+            rows      -> an array of the rows to solve for, or None for every row
+            blockSize -> about how many opinions are handled at once, this bounds the memory used
+
+        Return -> an array of shape (len(rows), factors) of the new factors
+        """
+
+        rows = np.arange(matrix.shape[0]) if rows is None else np.asarray(rows)
+        solved = np.zeros((len(rows), self.factors))
+        counts = np.diff(matrix.indptr)[rows]
+        start = 0
+        while start < len(rows):
+            #grows the block until it holds about blockSize opinions
+            end = start + max(1, int(np.searchsorted(np.cumsum(counts[start:]), blockSize)))
+            block = matrix[rows[start:end]]
+            owner = np.repeat(np.arange(end - start), np.diff(block.indptr))
+            columns = fixed[block.indices]
+
+            #sum(q q^T) and sum(r q) over each row's opinions, plus the penalty
+            gram = np.zeros((end - start, self.factors, self.factors))
+            np.add.at(gram, owner, columns[:, :, None] * columns[:, None, :])
+            gram += self.regularization * np.maximum(counts[start:end], 1)[:, None, None] * np.eye(self.factors)
+            target = np.zeros((end - start, self.factors))
+            np.add.at(target, owner, block.data[:, None] * columns)
+
+            solved[start:end] = np.linalg.solve(gram, target[:, :, None])[:, :, 0]
+            start = end
+        return solved
+
+
+    def _grow(self):
+        """
+        Gives users and items added since training empty factors
+
+        Return -> None
+        """
+
+        users, items = self.opinions.shape
+        if len(self.userFactors) < users:
+            self.userFactors = np.vstack((self.userFactors, np.zeros((users - len(self.userFactors), self.factors))))
+        if len(self.itemFactors) < items:
+            self.itemFactors = np.vstack((self.itemFactors, np.zeros((items - len(self.itemFactors), self.factors))))
+
+
+    def foldInUser(self, userIndex):
+        """
+        Solves for a user's factors again with the item factors held fixed
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> None
+        """
+
+        self._grow()
+        row = self.opinions.csr[userIndex].astype(np.float64)
+        row.data -= self.mean
+        self.userFactors[userIndex] = self._solve(row, self.itemFactors)[0]
+
+
+    def foldInItem(self, itemIndex):
+        """
+        Solves for an item's factors again with the user factors held fixed
+
+        Arguments:
+            itemIndex -> the dense index of the item
+
+        Return -> None
+        """
+
+        self._grow()
+        column = self.opinions.csc[:, itemIndex].T.tocsr().astype(np.float64)
+        column.data -= self.mean
+        self.itemFactors[itemIndex] = self._solve(column, self.userFactors)[0]
+
+
+    def predictOpinion(self, user, item):
+        """
+        Calculates a user's opinion of an item, mean + user factors . item factors
+
+        Arguments:
+            user -> the user whose opinion is to be calculated
+            item -> the item of which the user has an unknown opinion
+
+        Return -> the opinion that a user should have for an item
+        """
+
+        with self.lock.reading():
+            if user not in self.opinions.userIndex or item not in self.opinions.itemIndex:
+                return 0
+            self._grow()
+            return float(self.mean + self.userFactors[self.opinions.userIndex[user]].dot(self.itemFactors[self.opinions.itemIndex[item]]))
+
+
+    def _predictedRatings(self, userIndex):
+        """
+        Calculates a user's opinion of every item at once
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> an array of the predicted opinions by dense item index
+        """
+
+        self._grow()
+        return self.mean + self.itemFactors.dot(self.userFactors[userIndex])
+
+
+    def changeOpinion(self, user, item, opinion):
+        """
+        Changes a users opinion of an item and folds it in
+
+        Arguments:
+            user    -> a user whose opinion is changing
+            item    -> the item for the user that changes
+            opinion -> the new ratings the user has for the item
+
+        Return -> None
+        """
+
+        #stored under the lock, which the fold in on commit takes again, so the factors take the changes in the
+        #order the database committed them and no prediction sees them half made
+        with self.lock.writing():
+            self.storeOpinion(user, item, opinion)
+
+
+    def applyOpinions(self, changes):
+        """
+        Changes many opinions at once in a single transaction and folds them in, each user once
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion), the last change to an opinion wins
+
+        Return -> None
+        """
+
+        changes = self._latestChanges(changes)
+        #stored under the lock, see changeOpinion
+        with self.lock.writing():
+            self.storeOpinions(changes)
+
+
+    def _foldInCommitted(self, changes):
+        """
+        Folds in the opinions the database committed, the database's opinion listener
+
+        Arguments:
+            changes -> a list of tuple(user, item, opinion), an opinion of 0 removes it
+
+        Return -> None
+        """
+
+        with self.lock.writing():
+            self._foldIn(self._latestChanges(changes))
+
+
+    def _foldIn(self, changes):
+        """
+        Updates the opinion matrix with stored changes and folds them in
+
+        Arguments:
+            changes -> a list of tuple(user, item, opinion), each opinion at most once
+
+        Return -> None
+        """
+
+        newItems, users = [], set()
+        for user, item, opinion in changes:
+            if item not in self.opinions.itemIndex:
+                newItems.append(item)
+            self.opinions.setOpinion(user, item, opinion)
+            users.add(self.opinions.userIndex[user])
+        #a new item has no factors yet, so it is placed from its first opinions before the users move
+        for item in newItems:
+            self.foldInItem(self.opinions.itemIndex[item])
+        for userIndex in sorted(users):
+            self.foldInUser(userIndex)
+
+
+    def _digests(self):
+        """
+        Sums up every user's opinions, so that a change to any of them shows
+
+        Return -> an array of shape (users, 3) of the count, the sum of the opinions and the sum of the opinions
+                  weighted by their items' ids, by dense index
+        """
+
+        csr = self.opinions.csr
+        users = np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))
+        ratings = csr.data.astype(np.float64)
+        itemIds = np.asarray(self.opinions.itemIds, dtype=np.float64)
+        return np.column_stack((np.diff(csr.indptr), np.bincount(users, ratings, csr.shape[0]),
+                                np.bincount(users, ratings * itemIds[csr.indices], csr.shape[0])))
+
+
+    def save(self, factorsPath):
+        """
+        Saves the factors so that a restarted server does not need to train them again
+
+        Arguments:
+            factorsPath -> the .npz file to write
+
+        Return -> None
+        """
+
+        self._grow()
+        np.savez(factorsPath, userFactors=self.userFactors, itemFactors=self.itemFactors, mean=self.mean,
+                 userIds=np.array(self.opinions.userIds), itemIds=np.array(self.opinions.itemIds), userDigests=self._digests())
+
+
+    def load(self, factorsPath):
+        """
+        Loads saved factors, lining them up with the current opinion matrix.  Users and items that are not in the
+            file are folded in, and so are the users whose opinions changed since it was saved
+
+        Arguments:
+            factorsPath -> the .npz file to read
+
+        Return -> None
+        """
+
+        saved = np.load(factorsPath)
+        for side in ("userFactors", "itemFactors"):
+            if saved[side].shape[1] != self.factors:
+                raise ValueError("{} has {} factors, the engine has {}".format(factorsPath, saved[side].shape[1], self.factors))
+        self.mean = float(saved["mean"])
+        self.userFactors = self._align(saved["userFactors"], saved["userIds"].tolist(), self.opinions.userIndex)
+        self.itemFactors = self._align(saved["itemFactors"], saved["itemIds"].tolist(), self.opinions.itemIndex)
+        #every user is folded in when the file has no digests to compare to
+        savedDigests = saved["userDigests"] if "userDigests" in saved else np.full((len(saved["userIds"]), 3), np.nan)
+        changed = np.any(self._align(savedDigests, saved["userIds"].tolist(), self.opinions.userIndex, 3) != self._digests(), axis=1)
+
+        for itemIndex in np.flatnonzero(~self.itemFactors.any(axis=1)):
+            self.foldInItem(itemIndex)
+        for userIndex in np.flatnonzero(~self.userFactors.any(axis=1) | changed):
+            self.foldInUser(userIndex)
+
+
+    def _align(self, saved, savedIds, index, width=None):
+        """
+        Reorders saved factors into the dense order of the opinion matrix
+
+        Arguments:
+            saved    -> the saved factors
+            savedIds -> the external ids of the saved rows
+            index    -> map(external id->dense index) of the opinion matrix
+            width    -> the number of columns saved, self.factors by default
+
+        Return -> an array of factors by dense index, with zeros where nothing was saved
+        """
+
+        aligned = np.zeros((len(index), self.factors if width is None else width))
+        for row, identifier in enumerate(savedIds):
+            if identifier in index:
+                aligned[index[identifier]] = saved[row]
+        return aligned
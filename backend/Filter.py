@@ -1,4 +1,5 @@
 from math import sqrt
+from backend.Metrics import METRICS
 
 class Filter(object):
     """
@@ -15,6 +16,7 @@ class Filter(object):
     def similarity(self, user_id, other_id):
         """
         """
+        METRICS.count("naive_similarities", rating=self.rating)
         with self.table.session_scope() as session:
             user = self.table.fetch_user_by_id(session, user_id)
             other = self.table.fetch_user_by_id(session, other_id)
@@ -29,17 +31,21 @@ class Filter(object):
     def calculated_rating(self, user_id, course_id):
         """
         """
-        with self.table.session_scope() as session:
-            user = self.table.fetch_user_by_id(session, user_id)
-            users = {person for person in self.table.users}
-            new_users = set()
-            for person in users:
-                try:
-                    session.add(person)
-                    new_users.add(person)
-                except:
-                    pass
-            other_users = {other for other in new_users if user.school == other.school and getattr(self.table.fetch_rating_by_id(session, other.user_id, course_id), self.rating) is not None and other.user_id is not user_id}
-            top = sum(self.similarity(user_id, other.user_id) * getattr(self.table.fetch_rating_by_id(session, other.user_id, course_id), self.rating) for other in other_users)
-            bottom = sum(self.similarity(user_id, other.user_id) for other in other_users)
+        start = METRICS.start()
+        try:
+            with self.table.session_scope() as session:
+                user = self.table.fetch_user_by_id(session, user_id)
+                users = {person for person in self.table.users}
+                new_users = set()
+                for person in users:
+                    try:
+                        session.add(person)
+                        new_users.add(person)
+                    except:
+                        pass
+                other_users = {other for other in new_users if user.school == other.school and getattr(self.table.fetch_rating_by_id(session, other.user_id, course_id), self.rating) is not None and other.user_id is not user_id}
+                top = sum(self.similarity(user_id, other.user_id) * getattr(self.table.fetch_rating_by_id(session, other.user_id, course_id), self.rating) for other in other_users)
+                bottom = sum(self.similarity(user_id, other.user_id) for other in other_users)
+        finally:
+            METRICS.stop("naive_prediction_seconds", start, rating=self.rating)
         return float(top)/float(bottom)
\ No newline at end of file
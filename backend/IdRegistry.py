@@ -0,0 +1,66 @@
+"""
+The mapping between external ids and the dense indices used inside the engines.
+"""
+
+import numpy as np
+
+
+class IdRegistry(object):
+    """
+    Gives every external id (a user or item id from the database, any
+    hashable) a contiguous integer index the first time it is seen.  The
+    engines keep everything in arrays by those indices, and only turn them
+    back into ids at the edges.  Indices are never reused or moved, so arrays
+    by index only ever grow at the end.
+    """
+
+    def __init__(self, ids=()):
+        """
+        Creates the registry
+
+        Arguments:
+            ids -> the ids that are already known, in index order
+        """
+
+        #implemented as a list(index->id) and a map(id->index)
+        self.ids = list(ids)
+        self.index = {identifier: index for index, identifier in enumerate(self.ids)}
+
+
+    def __contains__(self, identifier):
+        return identifier in self.index
+
+    def __getitem__(self, identifier):
+        return self.index[identifier]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def add(self, identifier):
+        """
+        Registers an id, giving it the next index if it is new
+
+        Arguments:
+            identifier -> the external id
+
+        Return -> the index of the id
+        """
+
+        if identifier not in self.index:
+            self.index[identifier] = len(self.ids)
+            self.ids.append(identifier)
+        return self.index[identifier]
+
+
+    def lookup(self, identifiers):
+        """
+        Finds the indices of many ids at once
+
+        Arguments:
+            identifiers -> an iterable of external ids
+
+        Return -> an array of their indices, -1 for ids that are not registered
+        """
+
+        return np.array([self.index.get(identifier, -1) for identifier in identifiers], dtype=np.int64)
@@ -0,0 +1,254 @@
+"""
+The item based collaborative filtering engine.
+"""
+
+
+from backend.BaseFilter import BaseFilter
+import numpy as np
+
+#the most items the dense item-item statistics are kept for by default, two double precision arrays of shape
+#(items, items) take 16 * items ** 2 bytes, 6.4GB at this limit and 5GB for the 17770 netflix items
+MAX_ITEMS = 20000
+
+
+class ItemFilter(BaseFilter):
+    """
+    An item-item Collaborative Filtering algorithm/object.  Instead of finding
+    users similar to the user, it finds items similar to the item, and weights
+    the user's own opinions of those items.
+
+    With far fewer items than users (the netflix data has about 17k items to
+    480k users) the item-item statistics are small enough to keep in memory in
+    full, and a prediction only looks at the items the user has rated.  They
+    are dense all the same, so the engine refuses to start with more than
+    maxItems items rather than run out of memory.
+    """
+
+    def __init__(self, name, path, table, debug=False, cache=True, db=None, adjusted=False, maxItems=MAX_ITEMS):
+        """
+        Initilialies the item filter and calculates the item-item statistics
+
+        Arguments:
+            name     -> the name of the database file
+            path     -> the path to the database file (an sqlalchemy database url)
+            table    -> the name of the table in the database file
+            debug    -> activates debug mode, providing additional outputs and
+                        information about what is happening
+            cache    -> kept for compatibility with CollaborativeFilter, the
+                        item-item statistics are always kept
+            db       -> an already open databases.database.Database, used
+                        instead of opening name/path when provided
+            adjusted -> uses adjusted cosine similarity, which subtracts each
+                        user's mean opinion before comparing items
+            maxItems -> the most items the engine starts with, see MAX_ITEMS
+        """
+
+        super(ItemFilter, self).__init__(name, path, table, debug, cache, db)
+        self.adjusted = adjusted
+        if self.opinions.shape[1] > maxItems:
+            raise ValueError("The item filter keeps {} bytes for every pair of items, {} items are more than the limit of {}".format(
+                2 * np.dtype(np.float64).itemsize, self.opinions.shape[1], maxItems))
+
+        #implemented as two double precision arrays of shape (items, items), every change adds to them so single
+        #precision would drift from what calculating them again gives
+        #multSum[i][j] is sum(r[u][i]*r[u][j] for u in sharedUsers), symmetric
+        #squareSum[i][j] is sum(r[u][i]**2 for u in sharedUsers), so rss(i) over the users shared with j
+        #with adjusted cosine every r[u][i] has the user's mean subtracted first
+        self.multSum = None
+        self.squareSum = None
+        self._setSimilarities()
+
+
+    def _centered(self, matrix):
+        """
+        Gets the values that are compared between items, the opinions themselves or for adjusted cosine the opinions
+            minus each user's mean opinion
+
+        Arguments:
+            matrix -> a csr matrix of opinions
+
+        Return -> a csr matrix with the same structure
+        """
+
+        #the opinions are single precision, the sums over them are not
+        matrix = matrix.astype(np.float64)
+        if not self.adjusted:
+            return matrix
+        counts = np.diff(matrix.indptr)
+        sums = np.bincount(np.repeat(np.arange(matrix.shape[0]), counts), matrix.data, matrix.shape[0])
+        means = np.divide(sums, counts, out=np.zeros(matrix.shape[0]), where=counts != 0)
+        centered = matrix.copy()
+        centered.data = matrix.data - np.repeat(means, counts)
+        return centered
+
+
+    def _setSimilarities(self):
+        """
+        Calculates the item-item statistics for every pair of items at once, as two sparse matrix products
+
+        Return -> None
+        """
+
+        matrix = self.opinions.csr
+        values = self._centered(matrix)
+        rated = matrix.copy()
+        rated.data = np.ones(len(rated.data))
+        squares = values.multiply(values).tocsr()
+
+        self.multSum = values.T.dot(values).toarray()
+        self.squareSum = squares.T.dot(rated).toarray()
+
+
+    def _grow(self):
+        """
+        Pads the item-item statistics with empty rows and columns for items added since they were calculated
+
+        Return -> None
+        """
+
+        items = self.opinions.shape[1]
+        if len(self.multSum) < items:
+            padding = ((0, items - len(self.multSum)), (0, items - len(self.multSum)))
+            self.multSum = np.pad(self.multSum, padding)
+            self.squareSum = np.pad(self.squareSum, padding)
+
+
+    def _similarities(self, items, others):
+        """
+        Calculates the similarity between some items and some other items
+
+        Arguments:
+            items  -> array of the dense indices of the items
+            others -> array of the dense indices of the other items
+
+        Return -> an array of shape (len(items), len(others)), an item is never similar to itself
+        """
+
+        bottom = np.sqrt(self.squareSum[np.ix_(items, others)] * self.squareSum[np.ix_(others, items)].T)
+        similarities = np.divide(self.multSum[np.ix_(items, others)], bottom, out=np.zeros(bottom.shape), where=bottom != 0)
+        similarities[items[:, None] == others[None, :]] = 0
+        return similarities
+
+
+    def _ratings(self, userIndex, items):
+        """
+        Calculates the opinions a user should have of some items from the user's own opinions of similar items
+
+        Arguments:
+            userIndex -> the dense index of the user
+            items     -> array of the dense indices of the items
+
+        Return -> an array of the predicted opinions, 0 for items not similar to anything the user rated
+        """
+
+        rated, ratings = self.opinions.row(userIndex)
+        similarities = self._similarities(items, rated)
+        top = similarities.dot(ratings)
+        bottom = np.abs(similarities).sum(axis=1)
+        return np.divide(top, bottom, out=np.zeros(len(items)), where=bottom != 0)
+
+
+    def predictOpinion(self, user, item):
+        """
+        Calculates a user's opinion of an item from the user's opinions of similar items, this is O(items the user
+            has rated)
+
+        Arguments:
+            user -> the user whose opinion is to be calculated
+            item -> the item of which the user has an unknown opinion
+
+        Return -> the opinion that a user should have for an item based on collaborative filtering
+        """
+
+        with self.lock.reading():
+            if user not in self.opinions.userIndex or item not in self.opinions.itemIndex:
+                return 0
+            return float(self._ratings(self.opinions.userIndex[user], np.array([self.opinions.itemIndex[item]]))[0])
+
+
+    def _predictedRatings(self, userIndex):
+        """
+        Calculates a user's opinion of every item at once
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> an array of the predicted opinions by dense item index
+        """
+
+        return self._ratings(userIndex, np.arange(self.opinions.shape[1]))
+
+
+    def changeOpinion(self, user, item, opinion):
+        """
+        Changes a users opinion of an item and updates the item-item statistics.  Only the pairs of items the user
+            has rated move, so this is O(items the user has rated ** 2)
+
+        Arguments:
+            user    -> a user whose opinion is changing
+            item    -> the item for the user that changes
+            opinion -> the new ratings the user has for the item
+
+        Return -> None
+        """
+
+        #stored and applied under the same lock, so the statistics take the changes in the order the database
+        #committed them and no prediction sees them half made
+        with self.lock.writing():
+            self.storeOpinion(user, item, opinion)
+
+            userIndex = self.opinions.addUser(user)
+            #the user's contribution to the statistics is taken out, and put back in with the new opinion
+            self._addContribution(userIndex, -1)
+            self.opinions.setOpinion(user, item, opinion)
+            self._grow()
+            self._addContribution(userIndex, 1)
+
+
+    def applyOpinions(self, changes):
+        """
+        Changes many opinions at once in a single transaction, each user's contribution to the item-item statistics
+            is taken out and put back once for all of their changes
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion), the last change to an opinion wins
+
+        Return -> None
+        """
+
+        changes = self._latestChanges(changes)
+        #stored and applied under the same lock, see changeOpinion
+        with self.lock.writing():
+            self.storeOpinions(changes)
+
+            byUser = {}
+            for user, item, opinion in changes:
+                byUser.setdefault(user, []).append((item, opinion))
+            for user, opinions in byUser.items():
+                userIndex = self.opinions.addUser(user)
+                self._addContribution(userIndex, -1)
+                for item, opinion in opinions:
+                    self.opinions.setOpinion(user, item, opinion)
+                self._grow()
+                self._addContribution(userIndex, 1)
+
+
+    def _addContribution(self, userIndex, sign):
+        """
+        Adds (or removes) the part of the item-item statistics that comes from a single user
+
+        Arguments:
+            userIndex -> the dense index of the user
+            sign      -> 1 to add the user's opinions, -1 to remove them
+
+        Return -> None
+        """
+
+        rated, ratings = self.opinions.row(userIndex)
+        #in double precision like the statistics, see _centered
+        ratings = ratings.astype(np.float64)
+        if self.adjusted and len(ratings):
+            ratings = ratings - ratings.mean()
+        pairs = np.ix_(rated, rated)
+        self.multSum[pairs] += sign * np.outer(ratings, ratings)
+        self.squareSum[pairs] += sign * (ratings ** 2)[:, None]
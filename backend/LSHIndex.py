@@ -0,0 +1,205 @@
+"""
+Locality sensitive hashing for finding the candidate neighbors of a user
+without comparing them to every other user.
+"""
+
+from sys import argv, stdout
+from timeit import default_timer
+import numpy as np
+
+
+class LSHIndex(object):
+    """
+    An approximate nearest neighbor index over the users' opinion vectors,
+    using random hyperplane signatures.  Two users land on the same side of a
+    random hyperplane with probability 1 - angle/pi, so signatures approximate
+    cosine similarity.
+
+    Signatures are split into bands of rows bits, each band hashed into its own
+    table.  Users sharing a bucket in any band are candidates, and only they
+    are compared exactly.  More bands find more of the true neighbors, more
+    rows per band make the buckets smaller and the search faster.
+    """
+
+    def __init__(self, bands=16, rows=4, seed=0):
+        """
+        Creates an empty index
+
+        Arguments:
+            bands -> the number of hash tables
+            rows  -> the number of signature bits in each band
+            seed  -> the seed for the random hyperplanes
+        """
+
+        self.bands = bands
+        self.rows = rows
+        self._random = np.random.RandomState(seed)
+
+        #implemented as an array of shape (items, bands * rows) of hyperplane normals
+        self.planes = np.empty((0, bands * rows))
+        #implemented as an array of shape (users, bands) of the bucket of each user in each band
+        self.keys = np.empty((0, bands), dtype=np.int64)
+        #implemented as a list, by band, of map(bucket->set(user))
+        self.tables = [{} for band in range(bands)]
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def build(self, opinions):
+        """
+        Hashes every user of an opinion matrix
+
+        Arguments:
+            opinions -> a backend.OpinionMatrix.OpinionMatrix
+
+        Return -> None
+        """
+
+        self._growPlanes(opinions.shape[1])
+        self.keys = self._hash(opinions.csr)
+        self.tables = []
+        for band in range(self.bands):
+            #groups the users by bucket without a python level loop over users
+            order = np.argsort(self.keys[:, band], kind="stable")
+            buckets, starts = np.unique(self.keys[order, band], return_index=True)
+            self.tables.append(dict(zip(buckets.tolist(), map(set, np.split(order, starts[1:])))))
+
+
+    def update(self, userIndex, opinions):
+        """
+        Hashes a single user again, after their opinions changed or when they are new
+
+        Arguments:
+            userIndex -> the dense index of the user
+            opinions  -> a backend.OpinionMatrix.OpinionMatrix
+
+        Return -> None
+        """
+
+        self._growPlanes(opinions.shape[1])
+        if userIndex >= len(self.keys):
+            #new users start out in no bucket
+            self.keys = np.vstack((self.keys, np.full((userIndex + 1 - len(self.keys), self.bands), -1, dtype=np.int64)))
+        keys = self._hash(opinions.csr[userIndex])[0]
+        for band, (old, new) in enumerate(zip(self.keys[userIndex].tolist(), keys.tolist())):
+            if old == new:
+                continue
+            if old in self.tables[band]:
+                self.tables[band][old].discard(userIndex)
+                if not self.tables[band][old]:
+                    del self.tables[band][old]
+            self.tables[band].setdefault(new, set()).add(userIndex)
+        self.keys[userIndex] = keys
+
+
+    def candidates(self, userIndex):
+        """
+        Finds the users who share a bucket with a user in at least one band
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> a sorted array of the dense indices of the candidates, never including the user
+        """
+
+        if userIndex >= len(self.keys):
+            return np.empty(0, dtype=np.int64)
+        found = set()
+        for band, key in enumerate(self.keys[userIndex].tolist()):
+            found.update(self.tables[band].get(key, ()))
+        found.discard(userIndex)
+        return np.array(sorted(found), dtype=np.int64)
+
+
+    def _growPlanes(self, items):
+        """
+        Adds hyperplane coordinates for items that were added since the planes were drawn
+
+        Arguments:
+            items -> the number of items
+
+        Return -> None
+        """
+
+        if len(self.planes) < items:
+            self.planes = np.vstack((self.planes, self._random.standard_normal((items - len(self.planes), self.bands * self.rows))))
+
+
+    def _hash(self, matrix):
+        """
+        Calculates the bucket of some users in every band
+
+        Arguments:
+            matrix -> a csr matrix of the users' opinions
+
+        Return -> an array of shape (users, bands) of buckets
+        """
+
+        #opinions are all positive, so they are centered on each user's mean to spread them around the hyperplanes
+        counts = np.diff(matrix.indptr)
+        users = np.repeat(np.arange(matrix.shape[0]), counts)
+        means = np.divide(np.bincount(users, matrix.data, matrix.shape[0]), counts, out=np.zeros(matrix.shape[0]), where=counts != 0)
+        centered = matrix.copy()
+        centered.data = matrix.data - means[users]
+
+        bits = centered.dot(self.planes[:matrix.shape[1]]) > 0
+        return bits.reshape(-1, self.bands, self.rows).dot(1 << np.arange(self.rows, dtype=np.int64))
+
+
+def benchmark(users=100, items=20, density=.4, queries=5, k=10, bands=16, rows=4):
+    """
+    Compares the neighbors found through the index with the exact neighbors from _noCacheSimilarity
+
+    Arguments:
+        users   -> the number of users in the synthetic data
+        items   -> the number of items in the synthetic data
+        density -> the fraction of opinions that are known
+        queries -> the number of users whose neighbors are searched for
+        k       -> the number of neighbors compared
+        bands   -> passed to the index
+        rows    -> passed to the index
+
+    Return -> map(name->value) of the results
+    """
+
+    from backend.CollabFilter import CollaborativeFilter
+    from backend.utils import syntheticDatabase
+
+    engine = CollaborativeFilter("benchmark.db", "sqlite://", "opinions", db=syntheticDatabase(users, items, density))
+    index = LSHIndex(bands, rows)
+    start = default_timer()
+    index.build(engine.opinions)
+    buildTime = default_timer() - start
+
+    recalls, candidates, exactTime, indexTime = [], [], 0, 0
+    for userIndex in range(min(queries, users)):
+        user = engine.opinions.userIds[userIndex]
+        others = [other for other in engine.users() if other != user]
+
+        start = default_timer()
+        userOpinions = engine.fetchOpinions(user)
+        exact = sorted(others, key=lambda other: -engine._noCacheSimilarity(user, other, userOpinions))[:k]
+        exactTime += default_timer() - start
+
+        start = default_timer()
+        found = index.candidates(userIndex)
+        row = engine._setUserSimilarities(userIndex, found)
+        similarities = engine._calculateSimilarities(row, userIndex, found)
+        approximate = [engine.opinions.userIds[other] for other in found[np.argsort(-similarities, kind="stable")[:k]]]
+        indexTime += default_timer() - start
+
+        recalls.append(len(set(exact) & set(approximate)) / float(k))
+        candidates.append(len(found))
+
+    return {"recall@k": np.mean(recalls), "k": k, "mean candidates": np.mean(candidates), "users": users,
+            "build seconds": buildTime, "exact seconds per query": exactTime / len(recalls),
+            "index seconds per query": indexTime / len(recalls)}
+
+
+if __name__ == "__main__":
+    #python3 -m backend.LSHIndex [bands] [rows]
+    settings = dict(zip(["bands", "rows"], map(int, argv[1:3])))
+    for name, value in sorted(benchmark(**settings).items()):
+        stdout.write("{}: {}\n".format(name, value))
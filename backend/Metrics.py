@@ -0,0 +1,255 @@
+"""
+Counters and latency histograms of what the filtering engines spend their
+time on, readable as json or in the Prometheus text format.
+"""
+
+from bisect import bisect_left
+from numbers import Number
+from threading import Lock
+from timeit import default_timer
+import re
+import weakref
+
+#the upper bounds in seconds of the histogram buckets, everything slower falls in +Inf
+BUCKETS = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5)
+#the prefix of every metric name in the Prometheus format
+PREFIX = "classrank_"
+
+
+class Metrics(object):
+    """
+    A registry of counters and histograms, each keyed by a name and labels.
+    Disabled, every call returns before taking a lock or reading the clock,
+    so instrumented code costs a method call.
+
+    Values that are already counted elsewhere, like the hits of a cache, are
+    not counted twice: a collector is a function read only when the metrics
+    are, and what it returns is reported as gauges.
+    """
+
+    def __init__(self, enabled=False, buckets=BUCKETS):
+        """
+        Creates an empty registry
+
+        Arguments:
+            enabled -> whether anything is recorded, it can be changed at any time
+            buckets -> the sorted upper bounds of the histogram buckets in seconds
+        """
+
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+
+        #implemented as map(tuple(name, labels)->value), labels are a sorted tuple of tuple(label, value)
+        self.counters = {}
+        #implemented as map(tuple(name, labels)->list(count in each bucket, then +Inf, then the sum of the values))
+        self.histograms = {}
+        #implemented as map(name->tuple(function or weak method, label)), see collect
+        self.collectors = {}
+
+
+    def count(self, name, amount=1, **labels):
+        """
+        Adds to a counter
+
+        Arguments:
+            name   -> the name of the counter
+            amount -> how much to add
+            labels -> the labels of the counter, strings
+
+        Return -> None
+        """
+
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def start(self):
+        """
+        Starts timing something for stop
+
+        Return -> the time now, or None when disabled
+        """
+
+        return default_timer() if self.enabled else None
+
+
+    def stop(self, name, start, **labels):
+        """
+        Records the seconds since start in a histogram
+
+        Arguments:
+            name   -> the name of the histogram
+            start  -> what start returned, nothing is recorded when it is None
+            labels -> the labels of the histogram, strings
+
+        Return -> None
+        """
+
+        if start is not None:
+            self.observe(name, default_timer() - start, **labels)
+
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram
+
+        Arguments:
+            name   -> the name of the histogram
+            value  -> the value, usually seconds
+            labels -> the labels of the histogram, strings
+
+        Return -> None
+        """
+
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bucket] += 1
+            histogram[-1] += value
+
+
+    def collect(self, name, function, label=None):
+        """
+        Registers a function whose values are read as gauges whenever the metrics are.  A bound method is held
+            weakly, so registering an engine's method does not keep the engine alive, and registering the same name
+            again replaces it
+
+        Arguments:
+            name     -> the prefix of the gauges
+            function -> a function returning map(gauge->number), or with a label map(label value->map(gauge->number))
+            label    -> the name of the label the outer keys are values of, None when there is no outer map
+
+        Return -> None
+        """
+
+        if hasattr(function, "__self__"):
+            function = weakref.WeakMethod(function)
+        self.collectors[name] = (function, label)
+
+
+    def reset(self):
+        """
+        Forgets every counter and histogram, collectors are kept
+
+        Return -> None
+        """
+
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+    def _gauges(self):
+        """
+        Reads every collector
+
+        Return -> a list of tuple(name, labels, value) of the numeric values the collectors returned
+        """
+
+        gauges = []
+        for name, (function, label) in list(self.collectors.items()):
+            if isinstance(function, weakref.WeakMethod):
+                function = function()
+                if function is None:
+                    self.collectors.pop(name, None)
+                    continue
+            values = function()
+            groups = values.items() if label is not None else [(None, values)]
+            for labelValue, group in groups:
+                labels = () if label is None else ((label, str(labelValue)),)
+                for gauge, value in group.items():
+                    if isinstance(value, Number) and not isinstance(value, bool):
+                        #numpy numbers are turned into python ones, so the snapshot stays json friendly
+                        gauges.append((name + "_" + gauge, labels, value.item() if hasattr(value, "item") else value))
+        return gauges
+
+
+    def snapshot(self):
+        """
+        Reads every metric
+
+        Return -> a json friendly map with whether the metrics are enabled, and lists of the counters, histograms
+                  and gauges, each with its name and labels.  Histogram buckets are cumulative, as in Prometheus
+        """
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self.histograms.items())
+
+        result = {"enabled": self.enabled, "counters": [], "histograms": [], "gauges": []}
+        for (name, labels), value in counters:
+            result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), histogram in histograms:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets + ("+Inf",), histogram[:-1]):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            result["histograms"].append({"name": name, "labels": dict(labels), "count": cumulative, "sum": histogram[-1],
+                                         "buckets": buckets})
+        for name, labels, value in self._gauges():
+            result["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+        return result
+
+
+    def prometheus(self):
+        """
+        Reads every metric in the Prometheus text exposition format
+
+        Return -> the text, counters are named PREFIX + name + "_total"
+        """
+
+        snapshot, lines, declared = self.snapshot(), [], set()
+        #the samples of a metric are sorted next to each other, under a single TYPE line
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        for counter in snapshot["counters"]:
+            name = _metricName(counter["name"]) + "_total"
+            declare(name, "counter")
+            lines.append("{}{} {}".format(name, _labels(counter["labels"]), counter["value"]))
+        for histogram in snapshot["histograms"]:
+            name = _metricName(histogram["name"])
+            declare(name, "histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append("{}_bucket{} {}".format(name, _labels(dict(histogram["labels"], le=bound)), count))
+            lines.append("{}_sum{} {}".format(name, _labels(histogram["labels"]), histogram["sum"]))
+            lines.append("{}_count{} {}".format(name, _labels(histogram["labels"]), histogram["count"]))
+        for gauge in snapshot["gauges"]:
+            name = _metricName(gauge["name"])
+            declare(name, "gauge")
+            lines.append("{}{} {}".format(name, _labels(gauge["labels"]), gauge["value"]))
+        return "\n".join(lines) + "\n"
+
+
+def _metricName(name):
+    """
+    Return -> name with PREFIX and every character Prometheus does not allow replaced by _
+    """
+
+    return PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _labels(labels):
+    """
+    Return -> labels in the Prometheus format, {name="value",...}, or nothing when there are none
+    """
+
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join("{}=\"{}\"".format(name, value) for name, value in zip(labels, escaped)) + "}"
+
+
+#the registry the engines and handlers share unless they are given their own, disabled until something enables it
+METRICS = Metrics()
@@ -0,0 +1,107 @@
+"""
+The k-nearest neighbor index used by the collaborative filter.
+"""
+
+import numpy as np
+
+
+class NeighborIndex(object):
+    """
+    Keeps only the k most similar users of each user, so that predictions are
+    O(k) instead of O(users).  This is the k-nearest neighbor approach from the
+    "An Analysis of Operations" section of Math/CollabFilter.tex.
+    """
+
+    def __init__(self, k=20, minSimilarity=0, minShared=1):
+        """
+        Creates an empty index
+
+        Arguments:
+            k             -> the most neighbors kept for a user
+            minSimilarity -> neighbors must have a similarity greater than this
+            minShared     -> neighbors must share at least this many rated items
+        """
+
+        self.k = k
+        self.minSimilarity = minSimilarity
+        self.minShared = minShared
+
+        #implemented as map(user->tuple(array(neighbor), array(similarity))), most similar first
+        self.neighbors = {}
+
+
+    def __contains__(self, userIndex):
+        return userIndex in self.neighbors
+
+    def __getitem__(self, userIndex):
+        return self.neighbors[userIndex]
+
+    def __len__(self):
+        return len(self.neighbors)
+
+
+    def build(self, userIndex, similarities, shared, users=None):
+        """
+        Picks the neighbors of a user from their similarity to every other user
+
+        Arguments:
+            userIndex    -> the dense index of the user
+            similarities -> the array of similarities between the user and every other user
+            shared       -> the array of the number of items the user shares with every other user
+            users        -> the dense indices of the users in similarities and shared, when they are not every user
+
+        Return -> tuple(array(neighbor), array(similarity)), the new entry for the user
+        """
+
+        users = np.arange(len(similarities)) if users is None else np.asarray(users)
+        candidates = np.flatnonzero((similarities > self.minSimilarity) & (shared >= self.minShared) & (users != userIndex))
+        if len(candidates) > self.k:
+            candidates = candidates[np.argpartition(-similarities[candidates], self.k - 1)[:self.k]]
+        candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+        self.neighbors[userIndex] = (users[candidates], similarities[candidates])
+        return self.neighbors[userIndex]
+
+
+    def discard(self, userIndex):
+        """
+        Forgets the neighbors of a user, they are picked again the next time they are needed
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> None
+        """
+
+        self.neighbors.pop(userIndex, None)
+
+
+    def snapshotArrays(self):
+        """
+        Gets the neighbor lists as flat arrays, for backend.Snapshot
+
+        Return -> map(name->array), the lists of users[i] are neighbors[indptr[i]:indptr[i + 1]]
+        """
+
+        users = np.array(sorted(self.neighbors), dtype=np.int64)
+        lists = [self.neighbors[user] for user in users.tolist()]
+        indptr = np.cumsum([0] + [len(neighbors) for neighbors, similarities in lists], dtype=np.int64)
+        return {"neighbors.users": users, "neighbors.indptr": indptr,
+                "neighbors.neighbors": np.concatenate([neighbors for neighbors, similarities in lists] + [np.empty(0, dtype=np.int64)]),
+                "neighbors.similarities": np.concatenate([similarities for neighbors, similarities in lists] + [np.empty(0)])}
+
+
+    def restore(self, arrays):
+        """
+        Replaces the neighbor lists with those of a snapshot, each list is a view of the snapshot's arrays, only
+            the users and bounds are read, O(users)
+
+        Arguments:
+            arrays -> map(name->array) as made by snapshotArrays, usually memory mapped by backend.Snapshot
+
+        Return -> None
+        """
+
+        bounds = arrays["neighbors.indptr"].tolist()
+        neighbors, similarities = arrays["neighbors.neighbors"], arrays["neighbors.similarities"]
+        self.neighbors = {user: (neighbors[bounds[position]:bounds[position + 1]], similarities[bounds[position]:bounds[position + 1]])
+                          for position, user in enumerate(arrays["neighbors.users"].tolist())}
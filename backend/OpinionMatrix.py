@@ -0,0 +1,393 @@
+"""
+A sparse, compressed sparse row (CSR) backed store for the opinions used by the
+collaborative filter.
+"""
+
+from array import array
+from backend.IdRegistry import IdRegistry
+from threading import RLock
+import numpy as np
+import scipy.sparse as sparse
+
+#ratings are small, so single precision is exact for them and halves the memory they take up
+DTYPE = np.float32
+
+
+class OpinionMatrix(object):
+    """
+    The opinion matrix from Math/CollabFilter.tex, stored as a CSR matrix with
+    users as rows and items as columns.
+
+    Users and items are given dense integer indices the first time they are
+    seen, everything inside of the matrix works on those indices and the
+    external ids are only used at the edges.  A value of 0 means that the user
+    has no opinion of the item, exactly like the old dict of dicts.
+
+    Each user's opinions are a sorted slice of int32 item indices next to a
+    slice of float32 ratings, 8 bytes an opinion, and another 8 once the csc
+    copy is needed for column access.
+    """
+
+    def __init__(self, users=(), items=(), matrix=None, canonical=False):
+        """
+        Creates the matrix, empty unless a csr matrix is provided
+
+        Arguments:
+            users     -> the external user ids, in dense index order
+            items     -> the external item ids, in dense index order
+            matrix    -> a csr matrix of shape (len(users), len(items)) or None
+            canonical -> the matrix is a float32 csr matrix already known to have sorted indices and no duplicates,
+                         so it is used as it is without reading it
+        """
+
+        self.userRegistry = IdRegistry(users)
+        self.itemRegistry = IdRegistry(items)
+        #external id -> dense index, and dense index -> external id, these are the registries' own
+        self.userIds, self.userIndex = self.userRegistry.ids, self.userRegistry.index
+        self.itemIds, self.itemIndex = self.itemRegistry.ids, self.itemRegistry.index
+
+        if matrix is None:
+            matrix = sparse.csr_matrix((len(self.userIds), len(self.itemIds)), dtype=DTYPE)
+        if canonical:
+            self._csr = matrix
+            self._csr.has_canonical_format = True
+        else:
+            self._csr = sparse.csr_matrix(matrix, dtype=DTYPE)
+            self._csr.sum_duplicates()
+            self._csr.sort_indices()
+        self._csc = None
+
+        #map((user, item)->rating) of new cells that are not yet in the csr structure
+        self._pending = {}
+        #set when a cell is zeroed in place, the zeros are pruned at the next compaction
+        self._zeroed = False
+        #held while the csr structure is compacted or the csc copy made, which readers may both start at once
+        self._lock = RLock()
+
+
+    @classmethod
+    def fromTriples(cls, triples):
+        """
+        Builds the matrix from an iterable of (user, item, rating) tuples
+
+        Arguments:
+            triples -> the opinions, ratings of None or 0 are skipped
+
+        Return -> a new OpinionMatrix
+        """
+
+        users, items, ratings = array("q"), array("q"), array("f")
+        for user, item, rating in triples:
+            if rating:
+                users.append(user)
+                items.append(item)
+                ratings.append(rating)
+        return cls._fromArrays(np.frombuffer(users, dtype=np.int64), np.frombuffer(items, dtype=np.int64), np.frombuffer(ratings, dtype=DTYPE))
+
+
+    @classmethod
+    def fromDatabase(cls, db, batchSize=10000):
+        """
+        Bulk loads the whole opinions table in a single streaming pass
+
+        Arguments:
+            db        -> a databases.database.Database
+            batchSize -> the number of rows fetched from the database at a time
+
+        Return -> a new OpinionMatrix
+        """
+
+        with db.session_scope() as session:
+            rows = session.query(db.opinion.user_id, db.opinion.item_id, db.opinion.rating).yield_per(batchSize)
+            return cls.fromTriples(rows)
+
+
+    @classmethod
+    def _fromArrays(cls, users, items, ratings):
+        """
+        Builds the matrix from parallel arrays of external ids and ratings
+
+        Arguments:
+            users   -> array of external user ids
+            items   -> array of external item ids
+            ratings -> array of ratings
+
+        Return -> a new OpinionMatrix
+        """
+
+        #np.unique hands back the dense indices for every row without a python level loop
+        userIds, rows = np.unique(users, return_inverse=True)
+        itemIds, columns = np.unique(items, return_inverse=True)
+        matrix = sparse.csr_matrix((ratings, (rows, columns)), shape=(len(userIds), len(itemIds)))
+        return cls(userIds.tolist(), itemIds.tolist(), matrix)
+
+
+    @classmethod
+    def fromSnapshot(cls, arrays):
+        """
+        Builds the matrix on top of the arrays of a snapshot, the csr arrays are used without copying or reading
+            them but the id arrays are read into the id maps, O(users + items)
+
+        Arguments:
+            arrays -> map(name->array) as made by snapshotArrays, usually memory mapped by backend.Snapshot
+
+        Return -> a new OpinionMatrix
+        """
+
+        shape = (len(arrays["opinions.userIds"]), len(arrays["opinions.itemIds"]))
+        matrix = sparse.csr_matrix((arrays["opinions.data"], arrays["opinions.indices"], arrays["opinions.indptr"]),
+                                   shape=shape, copy=False)
+        return cls(arrays["opinions.userIds"].tolist(), arrays["opinions.itemIds"].tolist(), matrix, canonical=True)
+
+
+    def snapshotArrays(self):
+        """
+        Gets the arrays that make up the matrix, for backend.Snapshot
+
+        Return -> map(name->array) of the csr structure and the external ids
+        """
+
+        csr = self.csr
+        return {"opinions.indptr": csr.indptr, "opinions.indices": csr.indices, "opinions.data": csr.data,
+                "opinions.userIds": np.array(self.userIds), "opinions.itemIds": np.array(self.itemIds)}
+
+
+    @property
+    def shape(self):
+        """
+        Return -> (number of users, number of items)
+        """
+        return (len(self.userIds), len(self.itemIds))
+
+    @property
+    def nnz(self):
+        """
+        Return -> the number of stored opinions
+        """
+        return self.csr.nnz
+
+    @property
+    def csr(self):
+        """
+        The opinions as a scipy csr matrix, with any pending changes merged in
+
+        Return -> a csr matrix of shape self.shape
+        """
+
+        if self._pending or self._zeroed or self._csr.shape != self.shape:
+            with self._lock:
+                if self._pending or self._zeroed or self._csr.shape != self.shape:
+                    self._compact()
+        return self._csr
+
+    @property
+    def csc(self):
+        """
+        The opinions as a scipy csc matrix, for fast column (item) access
+
+        Return -> a csc matrix of shape self.shape
+        """
+
+        csr = self.csr
+        with self._lock:
+            if self._csc is None:
+                csc = csr.tocsc()
+                csc.sort_indices()
+                self._csc = csc
+            return self._csc
+
+
+    def _compact(self):
+        """
+        Merges pending cells and new users or items into the csr structure
+        """
+
+        csr = self._csr
+        if csr.shape != self.shape:
+            #new users only add empty rows to the end, new items only widen the matrix
+            indptr = np.concatenate((csr.indptr, np.repeat(csr.indptr[-1], self.shape[0] - csr.shape[0])))
+            csr = sparse.csr_matrix((csr.data, csr.indices, indptr), shape=self.shape)
+        if self._pending:
+            cells = np.array(list(self._pending.keys()), dtype=np.int64)
+            values = np.fromiter(self._pending.values(), dtype=DTYPE, count=len(self._pending))
+            #pending cells are never in the structure, so adding them is the same as setting them
+            csr = csr + sparse.csr_matrix((values, (cells[:, 0], cells[:, 1])), shape=self.shape)
+        if self._zeroed:
+            csr.eliminate_zeros()
+        csr.sort_indices()
+        self._csr = csr
+        self._csc = None
+        self._pending = {}
+        self._zeroed = False
+
+
+    def addUser(self, user):
+        """
+        Registers a user, giving them the next dense index if they are new
+
+        Arguments:
+            user -> the external user id
+
+        Return -> the dense index of the user
+        """
+
+        return self.userRegistry.add(user)
+
+    def addItem(self, item):
+        """
+        Registers an item, giving it the next dense index if it is new
+
+        Arguments:
+            item -> the external item id
+
+        Return -> the dense index of the item
+        """
+
+        return self.itemRegistry.add(item)
+
+
+    def users(self):
+        """
+        Return -> the external ids of every user, in dense index order
+        """
+        return list(self.userIds)
+
+    def items(self):
+        """
+        Return -> the external ids of every item, in dense index order
+        """
+        return list(self.itemIds)
+
+
+    def row(self, userIndex):
+        """
+        The opinions of a single user
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> tuple(item indices, ratings), both sorted by item index
+        """
+
+        csr = self.csr
+        start, end = csr.indptr[userIndex], csr.indptr[userIndex + 1]
+        return (csr.indices[start:end], csr.data[start:end])
+
+    def shared(self, userIndex, otherIndex):
+        """
+        The opinions two users have of the items they have both rated, found by merging their sorted rows
+
+        Arguments:
+            userIndex  -> the dense index of a user
+            otherIndex -> the dense index of the other user
+
+        Return -> tuple(item indices, user ratings, other ratings) of the shared items
+        """
+
+        userItems, userRatings = self.row(userIndex)
+        otherItems, otherRatings = self.row(otherIndex)
+        #where each of the user's items would go in the other's row, the shared ones are already there
+        positions = np.minimum(np.searchsorted(otherItems, userItems), max(len(otherItems) - 1, 0))
+        found = otherItems[positions] == userItems if len(otherItems) else np.zeros(len(userItems), dtype=bool)
+        return (userItems[found], userRatings[found], otherRatings[positions[found]])
+
+    def column(self, itemIndex):
+        """
+        The opinions of every user about a single item
+
+        Arguments:
+            itemIndex -> the dense index of the item
+
+        Return -> tuple(user indices, ratings), both sorted by user index
+        """
+
+        csc = self.csc
+        start, end = csc.indptr[itemIndex], csc.indptr[itemIndex + 1]
+        return (csc.indices[start:end], csc.data[start:end])
+
+
+    def opinion(self, user, item):
+        """
+        The opinion a user has of an item
+
+        Arguments:
+            user -> the external user id
+            item -> the external item id
+
+        Return -> the rating, or 0 if the user has no opinion of the item
+        """
+
+        if user not in self.userIndex or item not in self.itemIndex:
+            return 0
+        return self.value(self.userIndex[user], self.itemIndex[item])
+
+    def value(self, userIndex, itemIndex):
+        """
+        The opinion at a cell of the matrix
+
+        Arguments:
+            userIndex -> the dense index of the user
+            itemIndex -> the dense index of the item
+
+        Return -> the rating, or 0 if the user has no opinion of the item
+        """
+
+        if (userIndex, itemIndex) in self._pending:
+            return self._pending[(userIndex, itemIndex)]
+        position = self._position(self._csr, userIndex, itemIndex)
+        return 0 if position is None else float(self._csr.data[position])
+
+
+    def setOpinion(self, user, item, rating):
+        """
+        Changes the opinion a user has of an item, registering either of them if
+            they are new
+
+        Arguments:
+            user   -> the external user id
+            item   -> the external item id
+            rating -> the new rating, 0 or None removes the opinion
+
+        Return -> the previous rating, or 0 if there was none
+        """
+
+        userIndex = self.addUser(user)
+        itemIndex = self.addItem(item)
+        rating = rating or 0
+        oldRating = self.value(userIndex, itemIndex)
+
+        position = self._position(self._csr, userIndex, itemIndex)
+        if position is not None:
+            #the cell is already part of the structure, so it is changed in place
+            self._csr.data[position] = rating
+            self._zeroed = self._zeroed or rating == 0
+            if self._csc is not None:
+                self._csc.data[self._position(self._csc, itemIndex, userIndex)] = rating
+        elif rating:
+            self._pending[(userIndex, itemIndex)] = rating
+        else:
+            self._pending.pop((userIndex, itemIndex), None)
+        return oldRating
+
+
+    @staticmethod
+    def _position(matrix, major, minor):
+        """
+        Finds where a cell is stored in a compressed matrix with sorted indices
+
+        Arguments:
+            matrix -> a csr or csc matrix
+            major  -> the row (csr) or column (csc) of the cell
+            minor  -> the column (csr) or row (csc) of the cell
+
+        Return -> the offset of the cell in matrix.data, or None if it is not stored
+        """
+
+        #the shape of a csc matrix is (minor, major), so the bound comes from the structure itself
+        if major >= len(matrix.indptr) - 1:
+            return None
+        start, end = matrix.indptr[major], matrix.indptr[major + 1]
+        offset = start + np.searchsorted(matrix.indices[start:end], minor)
+        if offset < end and matrix.indices[offset] == minor:
+            return offset
+        return None
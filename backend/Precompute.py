@@ -0,0 +1,160 @@
+"""
+Calculates the similarity statistics of every pair of users at once, in
+parallel.
+"""
+
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from os import cpu_count
+from sys import argv, stdout
+from timeit import default_timer
+import numpy as np
+import scipy.sparse as sparse
+
+from backend.SimilarityStore import RSS_USER, RSS_OTHER, SHARED
+
+#the opinions as seen by a worker process, attached to the shared memory once when the process starts
+_worker = {}
+
+
+def allPairs(matrix, workers=None, blockSize=2048, width=4):
+    """
+    Calculates rss(low), rss(high), multSum and the number of shared items, and the sums of the shared opinions
+        when width is 6, for every pair of users that share an item.  The users are split into blocks and every pair of blocks is a task, so the work spreads evenly over
+        the workers.  The workers read the opinions from shared memory, only the block bounds go to them and only
+        the pairs they find come back
+
+    Arguments:
+        matrix    -> a csr matrix of opinions, users by items
+        workers   -> the number of processes, None for one per core, 1 to work in this process
+        blockSize -> the number of users in a block
+        width     -> the number of statistics a pair, see backend.SimilarityStore
+
+    Return -> tuple(array of (low << 32) | high keys, array of shape (pairs, width) from the lower users' point of view),
+              sorted by key
+    """
+
+    workers = cpu_count() if workers is None else workers
+    users = matrix.shape[0]
+    blocks = [(start, min(start + blockSize, users)) for start in range(0, users, blockSize)]
+    tasks = [(low, high, width) for position, low in enumerate(blocks) for high in blocks[position:]]
+
+    if workers <= 1 or len(tasks) <= 1:
+        _worker["matrix"] = matrix
+        try:
+            results = [_blockPair(task) for task in tasks]
+        finally:
+            _worker.clear()
+    else:
+        segments, arrays = [], []
+        try:
+            for array in (matrix.indptr, matrix.indices, matrix.data):
+                segment = SharedMemory(create=True, size=max(array.nbytes, 1))
+                segments.append(segment)
+                np.ndarray(array.shape, array.dtype, buffer=segment.buf)[:] = array
+                arrays.append((segment.name, array.dtype.str, len(array)))
+            #spawned rather than forked, a fork of a server copies locks other threads may hold and never release
+            with get_context("spawn").Pool(workers, initializer=_attach, initargs=(arrays, matrix.shape)) as pool:
+                results = pool.map(_blockPair, tasks, chunksize=1)
+        finally:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+
+    if not results:
+        return (np.empty(0, dtype=np.int64), np.empty((0, width)))
+    keys = np.concatenate([keys for keys, values in results])
+    values = np.concatenate([values for keys, values in results])
+    order = np.argsort(keys, kind="stable")
+    return (keys[order], values[order])
+
+
+def _attach(arrays, shape):
+    """
+    Attaches a worker process to the shared opinions
+
+    Arguments:
+        arrays -> a list of tuple(segment name, dtype, length) for the indptr, indices and data of the csr matrix
+        shape  -> the shape of the matrix
+
+    Return -> None
+    """
+
+    segments, views = [], []
+    for name, dtype, length in arrays:
+        #the workers share the parent's resource tracker, which unlinks the segments if the parent dies
+        segment = SharedMemory(name=name)
+        segments.append(segment)
+        views.append(np.ndarray(length, dtype, buffer=segment.buf))
+    indptr, indices, data = views
+    _worker["segments"] = segments
+    _worker["matrix"] = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def _blockPair(task):
+    """
+    Calculates the statistics between the users of two blocks, as a sparse matrix product for each statistic
+
+    Arguments:
+        task -> tuple((start, end) of the lower block, (start, end) of the higher block, the number of statistics)
+
+    Return -> tuple(keys, values) of the pairs that share an item
+    """
+
+    (lowStart, lowEnd), (highStart, highEnd), width = task
+    matrix = _worker["matrix"]
+    low = matrix[lowStart:lowEnd].astype(np.float64)
+    high = matrix[highStart:highEnd].astype(np.float64)
+    lowRated, highRated = low.copy(), high.copy()
+    lowRated.data[:] = 1
+    highRated.data[:] = 1
+
+    #ratings are all positive, so all of the products have the same structure, that of shared
+    products = [low.multiply(low).dot(highRated.T), lowRated.dot(high.multiply(high).T), low.dot(high.T),
+                lowRated.dot(highRated.T), low.dot(highRated.T), lowRated.dot(high.T)][:width]
+    products = [product.tocsr() for product in products]
+    for product in products:
+        product.sort_indices()
+
+    shared = products[SHARED].tocoo()
+    keep = shared.row + lowStart < shared.col + highStart
+    keys = ((shared.row[keep].astype(np.int64) + lowStart) << 32) | (shared.col[keep].astype(np.int64) + highStart)
+
+    values = np.column_stack([product.data[keep] for product in products])
+    values[:, [RSS_USER, RSS_OTHER]] = np.sqrt(values[:, [RSS_USER, RSS_OTHER]])
+    return (keys, values)
+
+
+def benchmark(users=100000, items=20000, perUser=20, workers=None, blockSize=2048):
+    """
+    Times allPairs on synthetic opinions with more and more workers
+
+    Arguments:
+        users     -> the number of users in the synthetic data
+        items     -> the number of items in the synthetic data
+        perUser   -> the number of items each user rates
+        workers   -> a list of the numbers of workers to time, by default powers of 2 up to the number of cores
+        blockSize -> passed to allPairs
+
+    Return -> map(workers->tuple(seconds, speedup over one worker, pairs))
+    """
+
+    from backend.utils import syntheticSparseOpinions
+
+    matrix = syntheticSparseOpinions(users, items, perUser)
+    if workers is None:
+        workers = sorted({1 << power for power in range(cpu_count().bit_length())} | {cpu_count()})
+    results = {}
+    for count in workers:
+        start = default_timer()
+        keys, values = allPairs(matrix, count, blockSize)
+        seconds = default_timer() - start
+        results[count] = (seconds, results[workers[0]][0] / seconds if results else 1, len(keys))
+    return results
+
+
+if __name__ == "__main__":
+    #python3 -m backend.Precompute [users] [items] [ratings per user]
+    settings = dict(zip(["users", "items", "perUser"], map(int, argv[1:4])))
+    for count, (seconds, speedup, pairs) in sorted(benchmark(**settings).items()):
+        stdout.write("{} workers: {:.2f}s, {:.2f}x, {} pairs\n".format(count, seconds, speedup, pairs))
@@ -0,0 +1,217 @@
+"""
+A write-behind queue that pushes changed opinions out to an engine's caches
+on a background thread, so whoever changed them does not wait for it.
+"""
+
+from threading import Condition, Thread
+from timeit import default_timer
+
+
+class PropagationQueue(object):
+    """
+    Changes waiting to be propagated, keyed by (user, item).  A change to an
+    opinion that is still waiting replaces the one before it, so however many
+    times an opinion changes between two batches it is propagated once, with
+    its latest value.  A single worker thread takes everything waiting as one
+    batch and hands it to the apply function.
+
+    The changes must already be stored, the queue only holds what the caches
+    have not seen yet.  They must also be queued in the order they were stored,
+    which the engines do by storing and queueing under their writer lock.
+
+    A batch the apply function raises on is put back in front of the changes
+    queued since, which win where they change the same opinion, and tried
+    again after retryDelay seconds.  Until a batch is applied, flush raises the
+    last error.
+    """
+
+    def __init__(self, apply, name="propagation", retryDelay=1.):
+        """
+        Creates an empty queue, the worker thread is started by the first change
+
+        Arguments:
+            apply      -> a function taking a list of tuple(user, item, opinion), called on the worker thread
+            name       -> the name of the worker thread
+            retryDelay -> how many seconds to wait before applying a batch that failed again
+        """
+
+        self.apply = apply
+        self.name = name
+        self.retryDelay = retryDelay
+
+        #implemented as a dict(tuple(user, item)->opinion), in the order the opinions first started waiting
+        self._waiting = {}
+        #the number of changes in the batch the worker is applying
+        self._applying = 0
+        #when the oldest waiting change and the oldest change in the batch being applied were queued, None when
+        #there are none
+        self._oldest = None
+        self._applyingOldest = None
+        self._condition = Condition()
+        self._worker = None
+        self._closed = False
+        #the error the last batch raised, raised by flush until a batch is applied
+        self.error = None
+
+        self.queued = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.batches = 0
+        self.failures = 0
+
+
+    def put(self, user, item, opinion):
+        """
+        Queues a change to an opinion, replacing the one waiting for the same opinion if there is one
+
+        Arguments:
+            user    -> the user whose opinion changed
+            item    -> the item the opinion is of
+            opinion -> the new opinion, 0 or None when it was removed
+
+        Return -> None
+        """
+
+        self.putMany([(user, item, opinion)])
+
+
+    def putMany(self, changes):
+        """
+        Queues many changes at once, see put
+
+        Arguments:
+            changes -> an iterable of tuple(user, item, opinion)
+
+        Return -> None
+        """
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The {} queue is closed".format(self.name))
+            for user, item, opinion in changes:
+                self.queued += 1
+                if (user, item) in self._waiting:
+                    self.coalesced += 1
+                self._waiting[(user, item)] = opinion
+            if self._waiting and self._oldest is None:
+                self._oldest = default_timer()
+            if self._worker is None:
+                self._worker = Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+            self._condition.notify_all()
+
+
+    @property
+    def pending(self):
+        """
+        The number of changes that are not propagated yet, those waiting and those in the batch being applied
+        """
+
+        with self._condition:
+            return len(self._waiting) + self._applying
+
+
+    @property
+    def lag(self):
+        """
+        How many seconds the oldest change that is not propagated yet has been queued for, 0 when there is none
+        """
+
+        with self._condition:
+            return self._lag()
+
+
+    def stats(self):
+        """
+        Gets the counters of the queue
+
+        Return -> map(counter->value) of the changes queued, coalesced into a later change and applied, the batches
+                  applied and the ones that failed, and the pending changes and lag now
+        """
+
+        with self._condition:
+            return {"queued": self.queued, "coalesced": self.coalesced, "applied": self.applied, "batches": self.batches,
+                    "failures": self.failures, "pending": len(self._waiting) + self._applying, "lag": self._lag()}
+
+
+    def _lag(self):
+        """
+        Return -> the lag, see lag, with the condition already held
+        """
+
+        oldest = self._oldest if self._applyingOldest is None else self._applyingOldest
+        return 0 if oldest is None else default_timer() - oldest
+
+
+    def flush(self, timeout=None):
+        """
+        Waits until every change queued so far is propagated, raising the error of the last batch instead while
+            the batches fail
+
+        Arguments:
+            timeout -> the most seconds to wait, None to wait for as long as it takes
+
+        Return -> True once nothing is pending, False if the timeout ran out first
+        """
+
+        with self._condition:
+            done = self._condition.wait_for(lambda: not self._waiting and not self._applying or self.error is not None, timeout)
+            if self.error is not None:
+                raise self.error
+            return done
+
+
+    def close(self, timeout=None):
+        """
+        Propagates everything still waiting and stops the worker, no changes may be queued afterwards.  A batch that
+            fails is not tried again once the queue is closed, it stays pending
+
+        Arguments:
+            timeout -> the most seconds to wait for the worker
+
+        Return -> None
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+
+    def _run(self):
+        """
+        The worker thread, applies everything waiting as one batch until the queue is closed and empty
+
+        Return -> None
+        """
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._waiting or self._closed)
+                if not self._waiting:
+                    return
+                batch, self._waiting = self._waiting, {}
+                self._applying, self._applyingOldest, self._oldest = len(batch), self._oldest, None
+
+            try:
+                self.apply([(user, item, opinion) for (user, item), opinion in batch.items()])
+            except Exception as error:
+                with self._condition:
+                    #put back in front of the changes queued since, which are newer
+                    batch.update(self._waiting)
+                    self._waiting, self._oldest = batch, self._applyingOldest
+                    self._applying, self._applyingOldest = 0, None
+                    self.error = error
+                    self.failures += 1
+                    self._condition.notify_all()
+                    if self._condition.wait_for(lambda: self._closed, self.retryDelay):
+                        return
+                continue
+
+            with self._condition:
+                self.error = None
+                self._applying, self._applyingOldest = 0, None
+                self.applied += len(batch)
+                self.batches += 1
+                self._condition.notify_all()
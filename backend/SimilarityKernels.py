@@ -0,0 +1,194 @@
+"""
+The similarity measures the collaborative filter can weight users by, each
+calculated from the stored statistics of a pair of users.
+"""
+
+from backend.SimilarityStore import RSS_USER, RSS_OTHER, MULT_SUM, SHARED, SUM_USER, SUM_OTHER
+import numpy as np
+
+#the columns of a user's profile, the count, sum and sum of squares of all of their opinions
+PROFILE_COUNT, PROFILE_SUM, PROFILE_SQUARES = range(3)
+#centered sums of squares this small relative to the raw ones are rounding, the user rated every shared item the same
+TOLERANCE = 1e-9
+
+
+class SimilarityKernel(object):
+    """
+    A similarity measure between two users.  A kernel says which statistics
+    of a pair it reads, the store keeps those and no more, and whether it also
+    reads each user's profile, which is kept up to date in O(1) a change.
+
+    Every statistic is a sum over the items both users rated, so a change to an
+    opinion only moves the pairs of the users who rated that item, whichever
+    kernel is used.
+    """
+
+    name = None
+    #the columns of a row of similarity statistics the kernel reads
+    statistics = (RSS_USER, RSS_OTHER, MULT_SUM, SHARED)
+    #whether the kernel reads the users' profiles
+    profiles = False
+
+    @property
+    def width(self):
+        """
+        The number of columns the similarity store keeps, the statistics are laid out so that a kernel only needs
+            the first few
+        """
+
+        return max(self.statistics) + 1
+
+
+    def similarities(self, row, userProfile=None, otherProfiles=None):
+        """
+        Calculates the similarity between a user and other users
+
+        Arguments:
+            row           -> an array of shape (others, width) of the statistics from the user's point of view
+            userProfile   -> the user's profile, an array of (count, sum, squares), when the kernel reads profiles
+            otherProfiles -> an array of shape (others, 3) of the other users' profiles, when the kernel reads
+                             profiles
+
+        Return -> an array of the similarities, 0 where the users share no items
+        """
+
+        raise NotImplementedError
+
+
+    @staticmethod
+    def _divide(top, bottom):
+        """
+        Return -> top / bottom, 0 where bottom is 0
+        """
+
+        return np.divide(top, bottom, out=np.zeros(len(top)), where=bottom != 0)
+
+
+    @staticmethod
+    def _means(profiles):
+        """
+        Return -> the mean opinion of each profile, 0 for users without opinions
+        """
+
+        profiles = np.atleast_2d(profiles)
+        return SimilarityKernel._divide(profiles[:, PROFILE_SUM], profiles[:, PROFILE_COUNT])
+
+
+class Cosine(SimilarityKernel):
+    """
+    multSum / (rss(user) * rss(other)), the measure from Math/CollabFilter.tex
+    """
+
+    name = "cosine"
+
+    def similarities(self, row, userProfile=None, otherProfiles=None):
+        return self._divide(row[:, MULT_SUM], row[:, RSS_USER] * row[:, RSS_OTHER])
+
+
+class ShrunkCosine(Cosine):
+    """
+    The cosine shrunk towards 0 by shared / (shared + shrinkage), so that
+    users who agree on a couple of items are not trusted as much as users who
+    agree on many
+    """
+
+    name = "shrunk"
+
+    def __init__(self, shrinkage=10):
+        """
+        Arguments:
+            shrinkage -> the number of shared items at which the cosine is halved
+        """
+
+        self.shrinkage = shrinkage
+
+
+    def similarities(self, row, userProfile=None, otherProfiles=None):
+        shared = row[:, SHARED]
+        return super(ShrunkCosine, self).similarities(row) * shared / (shared + self.shrinkage)
+
+
+class Pearson(SimilarityKernel):
+    """
+    The correlation of the two users' opinions of the items they share, each
+    centered on the user's mean opinion.  The centered sums are expanded into
+    raw sums over the shared items and the users' means, so a change to a
+    user's mean moves no stored statistic
+    """
+
+    name = "pearson"
+    statistics = (RSS_USER, RSS_OTHER, MULT_SUM, SHARED, SUM_USER, SUM_OTHER)
+    profiles = True
+
+    def similarities(self, row, userProfile=None, otherProfiles=None):
+        userMean, otherMeans = self._means(userProfile)[0], self._means(otherProfiles)
+        shared = row[:, SHARED]
+        top = self._centeredMultSum(row, userMean, otherMeans)
+
+        #sum((r - mean) ** 2) = sum(r ** 2) - 2 * mean * sum(r) + shared * mean ** 2, over the shared items
+        userSquares, otherSquares = row[:, RSS_USER] ** 2, row[:, RSS_OTHER] ** 2
+        userCentered = userSquares - 2 * userMean * row[:, SUM_USER] + shared * userMean ** 2
+        otherCentered = otherSquares - 2 * otherMeans * row[:, SUM_OTHER] + shared * otherMeans ** 2
+        userCentered[userCentered <= TOLERANCE * userSquares] = 0
+        otherCentered[otherCentered <= TOLERANCE * otherSquares] = 0
+        return np.clip(self._divide(top, np.sqrt(userCentered * otherCentered)), -1, 1)
+
+
+    @staticmethod
+    def _centeredMultSum(row, userMean, otherMeans):
+        """
+        Return -> sum((r[user] - userMean) * (r[other] - otherMean)) over the shared items, from the raw sums
+        """
+
+        return (row[:, MULT_SUM] - otherMeans * row[:, SUM_USER] - userMean * row[:, SUM_OTHER]
+                + row[:, SHARED] * userMean * otherMeans)
+
+
+class AdjustedCosine(Pearson):
+    """
+    The cosine between the two users' whole rows of opinions, each centered
+    on the user's mean opinion.  Unlike pearson the lengths are those of the
+    users' whole profiles, not of the shared items, so two users agreeing on
+    one item out of many are not perfectly similar
+    """
+
+    name = "adjusted"
+
+    def similarities(self, row, userProfile=None, otherProfiles=None):
+        userMean, otherMeans = self._means(userProfile)[0], self._means(otherProfiles)
+        top = self._centeredMultSum(row, userMean, otherMeans)
+        return np.clip(self._divide(top, np.sqrt(self._centeredSquares(userProfile) * self._centeredSquares(otherProfiles))), -1, 1)
+
+
+    @staticmethod
+    def _centeredSquares(profiles):
+        """
+        Return -> sum((r - mean) ** 2) over each profile's opinions
+        """
+
+        profiles = np.atleast_2d(profiles)
+        squares = profiles[:, PROFILE_SQUARES]
+        centered = squares - SimilarityKernel._divide(profiles[:, PROFILE_SUM] ** 2, profiles[:, PROFILE_COUNT])
+        centered[centered <= TOLERANCE * squares] = 0
+        return centered
+
+
+#maps kernel name -> kernel class
+KERNELS = {kernel.name: kernel for kernel in (Cosine, ShrunkCosine, Pearson, AdjustedCosine)}
+
+
+def createKernel(kernel):
+    """
+    Creates a similarity kernel by name
+
+    Arguments:
+        kernel -> the name of the kernel, one of KERNELS, or a SimilarityKernel which is used as it is
+
+    Return -> the kernel
+    """
+
+    if isinstance(kernel, SimilarityKernel):
+        return kernel
+    if kernel not in KERNELS:
+        raise ValueError("Unknown similarity kernel {}, expected one of {}".format(kernel, ", ".join(sorted(KERNELS))))
+    return KERNELS[kernel]()
@@ -0,0 +1,639 @@
+"""
+The symmetric store of the similarity statistics between pairs of users.
+"""
+
+from collections import OrderedDict
+from threading import RLock
+import numpy as np
+
+#the columns of a row of similarity statistics, from the point of view of the user the row belongs to
+#the sums of the opinions of the shared items come last, they are only kept for the kernels that read them
+RSS_USER, RSS_OTHER, MULT_SUM, SHARED, SUM_USER, SUM_OTHER = range(6)
+#the columns as seen from the other user's side
+SWAPPED = [RSS_OTHER, RSS_USER, MULT_SUM, SHARED, SUM_OTHER, SUM_USER]
+
+#a pair is keyed by (low << 32) | high
+LOW_BITS = (1 << 32) - 1
+#about how much a stored pair costs, its key in both orders and its four statistics.  A dense row keeps the four
+#statistics of a pair in both users' rows, 64 bytes, so for pairs of known users the store takes about 25% less
+PAIR_BYTES = 2 * 8 + 4 * 8
+#and each statistic past the first four
+COLUMN_BYTES = 8
+#a run is merged into the one before it once that one is less than this many times its size, so runs shrink
+#geometrically, there are O(log(pairs)) of them, and a pair is copied O(log(pairs)) times over its life
+MERGE_RATIO = 4
+
+
+class SimilarityStore(object):
+    """
+    Keeps the similarity statistics of every pair of users once, no matter
+    how many of the two users' rows are in use.  A pair is stored from its
+    lower user's side, (rss(low), rss(high), multSum, shared), and turned
+    around when it is read from the higher user's side, so a change to a pair
+    is made once.
+
+    The store keeps the first width statistics, four by default, or six when
+    the similarity kernel also reads the sums of the shared opinions.
+
+    Pairs are kept in runs, each two sorted arrays of keys, by (low, high) next
+    to the statistics and by (high, low) to find a user's pairs as the higher
+    user, so reading a row is two slices and a lookup a run.  New pairs are
+    added as a run of their own, which is merged with the runs before it that
+    are not much bigger (see MERGE_RATIO), instead of being inserted into one
+    big sorted array that would be copied for every new pair.  A pair is only
+    ever in one run, and only pairs sharing at least one item are added.
+
+    A user is known once their whole row has been stored, and every stored
+    pair with a known user is kept up to date.  Over the byte budget the least
+    recently used users are forgotten, along with the pairs no known user
+    needs.
+
+    Reading a row moves the user to the back of the lru order and may store
+    it, so every method that touches the arrays holds the store's lock.  The
+    work is a few vectorized slices and merges, whoever calculates a row does
+    so before calling setRow, outside of the lock.
+    """
+
+    def __init__(self, budget=None, width=4):
+        """
+        Creates an empty store
+
+        Arguments:
+            budget -> the most bytes the pairs may take up, None for no limit
+            width  -> the number of statistics kept for a pair, see backend.SimilarityKernels
+        """
+
+        self.budget = budget
+        self.width = width
+
+        #implemented as a list of tuple(sorted keys, sorted swapped keys, array of shape (pairs, width) of statistics by
+        #the (low, high) keys), biggest first
+        self.runs = []
+
+        #implemented as an OrderedDict(user->None) of the known users, least recently used first
+        self.known = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = RLock()
+
+
+    def __contains__(self, userIndex):
+        return userIndex in self.known
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.known))
+
+    def __len__(self):
+        return len(self.known)
+
+
+    @property
+    def pairs(self):
+        """
+        The number of stored pairs
+        """
+
+        return sum(len(keys) for keys, swappedKeys, values in self.runs)
+
+
+    @property
+    def bytes(self):
+        """
+        The approximate size of the stored pairs
+        """
+
+        return self.pairs * (PAIR_BYTES + COLUMN_BYTES * (self.width - 4))
+
+
+    @property
+    def keys(self):
+        """
+        The sorted keys of every stored pair, the runs are merged into one to get them
+        """
+
+        with self._lock:
+            return self._merged()[0]
+
+    @property
+    def swappedKeys(self):
+        """
+        The sorted (high << 32) | low keys of every stored pair, the runs are merged into one to get them
+        """
+
+        with self._lock:
+            return self._merged()[1]
+
+    @property
+    def values(self):
+        """
+        The statistics of every stored pair in the order of keys, the runs are merged into one to get them
+        """
+
+        with self._lock:
+            return self._merged()[2]
+
+
+    def row(self, userIndex):
+        """
+        Reads the statistics between a known user and the users they are stored with
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> tuple(sorted array of the other users, array of shape (others, width) from the user's point of view),
+                  every other user shares nothing with the user, or None if the user is not known
+        """
+
+        with self._lock:
+            if userIndex not in self.known:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.known.move_to_end(userIndex)
+
+            partners, statistics = [], []
+            for (keys, swappedKeys, values), (lowPositions, lows, highPositions, highs) in zip(self.runs, self._partners(userIndex)):
+                partners += [lows, highs]
+                statistics += [values[lowPositions][:, SWAPPED[:self.width]], values[highPositions]]
+            partners = np.concatenate(partners) if partners else np.empty(0, dtype=np.int64)
+            statistics = np.concatenate(statistics) if statistics else np.empty((0, self.width))
+            #the lower users come before the higher ones in each run, so one run is sorted already
+            order = np.arange(len(partners)) if len(self.runs) == 1 else np.argsort(partners)
+            #pairs that stopped sharing items stay stored as 0 until the store is compacted
+            order = order[statistics[order, SHARED] > 0]
+            return (partners[order], statistics[order])
+
+
+    def setRow(self, userIndex, others, statistics):
+        """
+        Stores a user's whole row, after which the user is known.  The pairs already stored are up to date and
+            are kept as they are, to calculate pairs again see setPairs
+
+        Arguments:
+            userIndex  -> the dense index of the user
+            others     -> an array of the dense indices of the other users the user shares items with
+            statistics -> an array of shape (others, width) from the user's point of view
+
+        Return -> None
+        """
+
+        with self._lock:
+            #every stored pair is kept up to date, so only the pairs not stored yet are added
+            others = np.asarray(others, dtype=np.int64)
+            stored = np.sort(np.concatenate([np.empty(0, dtype=np.int64)] + self._stored(userIndex)))
+            new = ~np.isin(others, stored, assume_unique=True) & (statistics[:, SHARED] > 0)
+            self._insert(self._key(userIndex, others[new]), self._orient(statistics[new], others[new] > userIndex))
+
+            self.known[userIndex] = None
+            self.known.move_to_end(userIndex)
+            self._evict(userIndex)
+
+
+    def shift(self, userIndex, others, userSquares, otherSquares, multSums, sharedChange, userSums=0, otherSums=0):
+        """
+        Applies changes to the statistics between a user and some other users, each pair is changed once whichever
+            of its users are known.  rss is kept as a root so the change is made to its square
+
+        Arguments:
+            userIndex    -> the dense index of the user
+            others       -> an array of the dense indices of the other users
+            userSquares  -> the change to rss(user) ** 2
+            otherSquares -> the change to rss(other) ** 2
+            multSums     -> the change to multSum(user, other)
+            sharedChange -> the change to the number of shared items
+            userSums     -> the change to the sum of the user's opinions of the shared items, when they are kept
+            otherSums    -> the change to the sum of the other's opinions of the shared items, when they are kept
+
+        Return -> None
+        """
+
+        with self._lock:
+            others = np.asarray(others, dtype=np.int64)
+            changes = np.empty((len(others), 6))
+            changes[:, RSS_USER] = userSquares
+            changes[:, RSS_OTHER] = otherSquares
+            changes[:, MULT_SUM] = multSums
+            changes[:, SHARED] = sharedChange
+            changes[:, SUM_USER] = userSums
+            changes[:, SUM_OTHER] = otherSums
+            changes = changes[:, :self.width]
+
+            keys = self._key(userIndex, others)
+            runs, positions = self._find(keys)
+            found = runs >= 0
+            isLow = others > userIndex
+
+            stored = self._orient(self._gather(runs[found], positions[found]), isLow[found])
+            self._scatter(runs[found], positions[found], self._orient(self._shifted(stored, changes[found]), isLow[found]))
+
+            #pairs that start sharing an item are only needed when one of their users is known
+            if userIndex in self.known:
+                new = ~found
+            else:
+                new = ~found & np.array([other in self.known for other in others.tolist()], dtype=bool)
+            added = self._shifted(np.zeros((new.sum(), self.width)), changes[new])
+            keep = added[:, SHARED] > 0
+            self._insert(keys[new][keep], self._orient(added[keep], isLow[new][keep]))
+
+
+    def setPairs(self, userIndex, others, values):
+        """
+        Stores the statistics between a user and some other users, without the user becoming known.  Pairs already
+            stored are written over, the others are stored when they share an item
+
+        Arguments:
+            userIndex -> the dense index of the user
+            others    -> an array of the dense indices of the other users, not including the user
+            values    -> an array of shape (others, width) from the user's point of view
+
+        Return -> None
+        """
+
+        with self._lock:
+            self._write(userIndex, np.asarray(others, dtype=np.int64), values)
+
+
+    def load(self, keys, values, users):
+        """
+        Replaces everything with the statistics of every pair of users, after which every user is known
+
+        Arguments:
+            keys   -> an array of the (low << 32) | high keys of every pair that shares an item
+            values -> an array of shape (pairs, width) from the lower users' point of view
+            users  -> the number of users
+
+        Return -> None
+        """
+
+        with self._lock:
+            self.runs = []
+            self._insert(keys, values)
+            self.known = OrderedDict.fromkeys(range(users))
+            self._evict(None)
+
+
+    def snapshotArrays(self):
+        """
+        Gets the arrays that make up the store, for backend.Snapshot, the runs are merged into one to get them
+
+        Return -> map(name->array) of the sorted keys, the statistics and the known users, least recently used first
+        """
+
+        with self._lock:
+            keys, swappedKeys, values = self._merged()
+            return {"similarities.keys": keys, "similarities.swappedKeys": swappedKeys, "similarities.values": values,
+                    "similarities.known": np.array(list(self.known), dtype=np.int64)}
+
+
+    def restore(self, arrays):
+        """
+        Replaces everything with the arrays of a snapshot, using the statistics as they are without sorting or
+            reading them, only the known users are read, O(users)
+
+        Arguments:
+            arrays -> map(name->array) as made by snapshotArrays, usually memory mapped by backend.Snapshot
+
+        Return -> None
+        """
+
+        with self._lock:
+            if arrays["similarities.values"].shape[1] != self.width:
+                raise ValueError("The snapshot keeps {} statistics a pair, the store keeps {}".format(arrays["similarities.values"].shape[1], self.width))
+            self.runs = [(arrays["similarities.keys"], arrays["similarities.swappedKeys"], arrays["similarities.values"])]
+            self.known = OrderedDict.fromkeys(arrays["similarities.known"].tolist())
+            self._evict(None)
+
+
+    def forget(self, userIndex):
+        """
+        Forgets that a user's row is stored, the pairs no other known user needs are dropped the next time the store
+            is compacted
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> None
+        """
+
+        with self._lock:
+            self.known.pop(userIndex, None)
+
+
+    def stats(self):
+        """
+        Gets the counters of the store
+
+        Return -> map(name->value) of the known users, pairs, runs, bytes, budget, hits, misses, evictions and hit rate
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self), "pairs": self.pairs, "runs": len(self.runs), "bytes": self.bytes,
+                    "budget": self.budget, "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit rate": self.hits / float(lookups) if lookups else 0}
+
+
+    @staticmethod
+    def _key(userIndex, others):
+        """
+        Gets the keys of the pairs between a user and some other users
+
+        Arguments:
+            userIndex -> the dense index of the user
+            others    -> an array of the dense indices of the other users
+
+        Return -> an array of (low << 32) | high keys
+        """
+
+        others = np.asarray(others, dtype=np.int64)
+        return (np.minimum(others, userIndex) << 32) | np.maximum(others, userIndex)
+
+
+    @staticmethod
+    def _swap(keys):
+        """
+        Return -> the (high << 32) | low keys of (low << 32) | high keys, or the other way around
+        """
+
+        return ((keys & LOW_BITS) << 32) | (keys >> 32)
+
+
+    @staticmethod
+    def _orient(values, isLow):
+        """
+        Turns statistics around between the lower user's and the higher user's point of view, turning them around
+            twice gives them back
+
+        Arguments:
+            values -> an array of shape (pairs, width)
+            isLow  -> a boolean array, True where the user whose point of view it is is the lower user
+
+        Return -> a new array with the rss columns swapped where isLow is False
+        """
+
+        values = values.copy()
+        values[~isLow] = values[~isLow][:, SWAPPED[:values.shape[1]]]
+        return values
+
+
+    @staticmethod
+    def _shifted(values, changes):
+        """
+        Applies changes to statistics
+
+        Arguments:
+            values  -> an array of shape (pairs, width)
+            changes -> an array of shape (pairs, width), with the changes to the squares of the rss columns
+
+        Return -> a new array, pairs that share nothing are exactly 0
+        """
+
+        shifted = np.empty(values.shape)
+        shifted[:, :MULT_SUM] = np.sqrt(np.maximum(values[:, :MULT_SUM] ** 2 + changes[:, :MULT_SUM], 0))
+        shifted[:, MULT_SUM:] = values[:, MULT_SUM:] + changes[:, MULT_SUM:]
+        #instead of whatever rounding left behind
+        shifted[shifted[:, SHARED] == 0] = 0
+        return shifted
+
+
+    def _partners(self, userIndex):
+        """
+        Finds the stored pairs of a user in each run
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> a list with a tuple(positions in the run's statistics, the lower other users, positions, the higher
+                  other users) of sorted arrays for each run
+        """
+
+        found = []
+        bounds = [userIndex << 32, (userIndex + 1) << 32]
+        for keys, swappedKeys, values in self.runs:
+            start, end = keys.searchsorted(bounds)
+            swappedStart, swappedEnd = swappedKeys.searchsorted(bounds)
+            lows = swappedKeys[swappedStart:swappedEnd] & LOW_BITS
+            found.append((keys.searchsorted((lows << 32) | userIndex), lows, np.arange(start, end), keys[start:end] & LOW_BITS))
+        return found
+
+
+    def _stored(self, userIndex):
+        """
+        Finds the users a user has a stored pair with, by slicing the runs and without looking up any pair
+
+        Arguments:
+            userIndex -> the dense index of the user
+
+        Return -> a list of arrays of the other users, two for each run
+        """
+
+        others = []
+        bounds = [userIndex << 32, (userIndex + 1) << 32]
+        for keys, swappedKeys, values in self.runs:
+            start, end = keys.searchsorted(bounds)
+            swappedStart, swappedEnd = swappedKeys.searchsorted(bounds)
+            others += [keys[start:end] & LOW_BITS, swappedKeys[swappedStart:swappedEnd] & LOW_BITS]
+        return others
+
+
+    def _find(self, keys):
+        """
+        Looks up where pairs are stored
+
+        Arguments:
+            keys -> an array of (low << 32) | high keys
+
+        Return -> tuple(array of the run each pair is in or -1 if it is not stored, array of positions in the runs)
+        """
+
+        runs, positions = np.full(len(keys), -1, dtype=np.int64), np.zeros(len(keys), dtype=np.int64)
+        for run, (runKeys, swappedKeys, values) in enumerate(self.runs):
+            if not len(runKeys):
+                continue
+            found = np.minimum(np.searchsorted(runKeys, keys), len(runKeys) - 1)
+            matched = runKeys[found] == keys
+            runs[matched], positions[matched] = run, found[matched]
+        return runs, positions
+
+
+    def _gather(self, runs, positions):
+        """
+        Return -> an array of shape (pairs, width) of the statistics at positions in runs, as _find gives them
+        """
+
+        values = np.empty((len(positions), self.width))
+        for run, (keys, swappedKeys, runValues) in enumerate(self.runs):
+            inRun = runs == run
+            values[inRun] = runValues[positions[inRun]]
+        return values
+
+
+    def _scatter(self, runs, positions, values):
+        """
+        Writes statistics at positions in runs, as _find gives them
+
+        Return -> None
+        """
+
+        for run, (keys, swappedKeys, runValues) in enumerate(self.runs):
+            inRun = runs == run
+            runValues[positions[inRun]] = values[inRun]
+
+
+    def _write(self, userIndex, others, values):
+        """
+        Writes over the stored pairs between a user and some other users, and stores the others that share an item
+
+        Arguments:
+            userIndex -> the dense index of the user
+            others    -> an array of the dense indices of the other users, not including the user
+            values    -> an array of shape (others, width) from the user's point of view
+
+        Return -> None
+        """
+
+        keys = self._key(userIndex, others)
+        runs, positions = self._find(keys)
+        found = runs >= 0
+        isLow = others > userIndex
+
+        self._scatter(runs[found], positions[found], self._orient(values[found], isLow[found]))
+        new = ~found & (values[:, SHARED] > 0)
+        self._insert(keys[new], self._orient(values[new], isLow[new]))
+
+
+    def _insert(self, keys, values):
+        """
+        Adds pairs that are not stored yet as a new run, then merges the smallest runs until they shrink by
+            MERGE_RATIO from one to the next
+
+        Arguments:
+            keys   -> an array of (low << 32) | high keys
+            values -> an array of shape (pairs, width) from the lower users' point of view
+
+        Return -> None
+        """
+
+        if not len(keys):
+            return
+        order = np.argsort(keys, kind="stable")
+        self.runs.append((keys[order], np.sort(self._swap(keys)), values[order]))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) < MERGE_RATIO * len(self.runs[-1][0]):
+            last = self.runs.pop()
+            self.runs[-1] = self._merge(self.runs[-1], last)
+
+
+    @staticmethod
+    def _merge(run, other):
+        """
+        Merges two runs into one, placing the pairs of the smaller run among the pairs of the bigger one instead of
+            sorting them all again
+
+        Arguments:
+            run   -> a run
+            other -> a smaller run, with none of the same pairs
+
+        Return -> the merged run
+        """
+
+        def place(keys, otherKeys, values=None, otherValues=None):
+            #where each of the other keys ends up, the keys before it in both runs
+            positions = np.searchsorted(keys, otherKeys) + np.arange(len(otherKeys))
+            rest = np.ones(len(keys) + len(otherKeys), dtype=bool)
+            rest[positions] = False
+            merged = np.empty(len(rest), dtype=keys.dtype)
+            merged[positions], merged[rest] = otherKeys, keys
+            if values is None:
+                return merged
+            mergedValues = np.empty((len(rest), values.shape[1]))
+            mergedValues[positions], mergedValues[rest] = otherValues, values
+            return merged, mergedValues
+
+        keys, values = place(run[0], other[0], run[2], other[2])
+        return (keys, place(run[1], other[1]), values)
+
+
+    def _merged(self):
+        """
+        Merges every run into one, the lock must be held
+
+        Return -> the single run, empty arrays when nothing is stored
+        """
+
+        if not self.runs:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, self.width)))
+        while len(self.runs) > 1:
+            last = self.runs.pop()
+            self.runs[-1] = self._merge(self.runs[-1], last)
+        return self.runs[0]
+
+
+    def _highest(self):
+        """
+        The highest user index in a stored pair or among the known users, the keys and swapped keys are sorted so the
+            last of each holds the highest lower and higher user of a run
+
+        Return -> the index, 0 when nothing is stored
+        """
+
+        return max([int(keys[-1] >> 32) for keys, swappedKeys, values in self.runs if len(keys)] +
+                   [int(swappedKeys[-1] >> 32) for keys, swappedKeys, values in self.runs if len(keys)] +
+                   [max(self.known, default=0)])
+
+
+    def _compact(self):
+        """
+        Drops the pairs that neither of their users needs
+
+        Return -> None
+        """
+
+        if not self.runs:
+            return
+        known = np.zeros(self._highest() + 1, dtype=bool)
+        known[list(self.known)] = True
+        runs = []
+        for keys, swappedKeys, values in self.runs:
+            keep = known[keys >> 32] | known[keys & LOW_BITS]
+            if keep.any():
+                keys = keys[keep]
+                runs.append((keys, np.sort(self._swap(keys)), values[keep]))
+        self.runs = runs
+
+
+    def _evict(self, keep):
+        """
+        Forgets the least recently used users until the store is within its budget.  A pair only goes once both of
+            its users are forgotten, so how many users to forget is worked out from when each pair would go, and the
+            store is compacted once for all of them
+
+        Arguments:
+            keep -> the dense index of the user just stored, who is never forgotten, or None
+
+        Return -> None
+        """
+
+        if self.budget is None or self.bytes <= self.budget:
+            return
+        order = [user for user in self.known if user != keep]
+        #at least one user stays known
+        limit = min(len(order), len(self.known) - 1)
+        #the number of users forgotten before each user's pairs can go, -1 for the users that are not known
+        rank = np.full(self._highest() + 1, -1, dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        if keep is not None:
+            rank[keep] = len(order)
+        #dropped[forgotten] is the number of pairs that go once that many users are forgotten, and not before
+        dropped = np.zeros(len(order) + 2, dtype=np.int64)
+        for keys, swappedKeys, values in self.runs:
+            dropped += np.bincount(np.maximum(rank[keys >> 32], rank[keys & LOW_BITS]) + 1, minlength=len(order) + 2)
+        remaining = (self.pairs - np.cumsum(dropped)[:limit + 1]) * (PAIR_BYTES + COLUMN_BYTES * (self.width - 4))
+        fits = np.flatnonzero(remaining <= self.budget)
+        forgotten = int(fits[0]) if len(fits) else limit
+        for user in order[:forgotten]:
+            self.forget(user)
+        self.evictions += forgotten
+        self._compact()
@@ -0,0 +1,109 @@
+"""
+Versioned on-disk snapshots of the arrays behind the filtering engines, laid
+out so they can be memory mapped instead of read.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+#the layout of a snapshot, bumped whenever it changes so old snapshots are not misread
+SNAPSHOT_FORMAT = 1
+#the file in a snapshot directory that names its newest version
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+
+
+def saveSnapshot(directory, arrays, metadata=None, keep=2):
+    """
+    Writes arrays as a new version of a snapshot.  The version is written to a temporary directory and renamed into
+        place before CURRENT is switched to it, so a reader only ever sees complete versions.  Old versions are
+        removed, processes that still map their files keep their pages until they let go of them
+
+    Arguments:
+        directory -> the snapshot directory, created if it does not exist
+        arrays    -> map(name->array) of numeric or string arrays, each is written as name.npy
+        metadata  -> a map of json values stored in the manifest
+        keep      -> the number of versions to keep, including the new one
+
+    Return -> the number of the new version
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    versions = snapshotVersions(directory)
+    version = versions[-1] + 1 if versions else 1
+
+    manifest = {"format": SNAPSHOT_FORMAT, "version": version, "metadata": metadata or {}, "arrays": {}}
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=directory)
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if array.dtype.kind not in "biufU":
+                raise ValueError("Snapshot array {} has dtype {}, which can not be memory mapped".format(name, array.dtype))
+            np.save(os.path.join(staging, name + ".npy"), array, allow_pickle=False)
+            manifest["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        with open(os.path.join(staging, MANIFEST), "w") as manifestFile:
+            json.dump(manifest, manifestFile)
+        os.rename(staging, os.path.join(directory, str(version)))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    current = os.path.join(directory, CURRENT + ".tmp")
+    with open(current, "w") as currentFile:
+        currentFile.write(str(version))
+    os.replace(current, os.path.join(directory, CURRENT))
+
+    for old in versions[:max(len(versions) + 1 - keep, 0)]:
+        shutil.rmtree(os.path.join(directory, str(old)), ignore_errors=True)
+    return version
+
+
+def openSnapshot(directory, version=None):
+    """
+    Maps the arrays of a snapshot without reading them, pages are read from disk the first time they are used and
+        are shared by every process that maps the same version.  The arrays are copy on write, changing one only
+        changes this process's copy of the pages it touches
+
+    Arguments:
+        directory -> the snapshot directory
+        version   -> the version to open, the newest one by default
+
+    Return -> tuple(map(name->array), metadata map)
+    """
+
+    if version is None:
+        with open(os.path.join(directory, CURRENT)) as currentFile:
+            version = int(currentFile.read())
+    path = os.path.join(directory, str(version))
+    with open(os.path.join(path, MANIFEST)) as manifestFile:
+        manifest = json.load(manifestFile)
+    if manifest["format"] != SNAPSHOT_FORMAT:
+        raise ValueError("Snapshot {} has format {}, expected {}".format(path, manifest["format"], SNAPSHOT_FORMAT))
+
+    arrays = {}
+    for name, layout in manifest["arrays"].items():
+        #empty files can not be mapped
+        if 0 in layout["shape"]:
+            arrays[name] = np.empty(layout["shape"], dtype=layout["dtype"])
+        else:
+            arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode="c", allow_pickle=False)
+    return arrays, manifest["metadata"]
+
+
+def snapshotVersions(directory):
+    """
+    Lists the complete versions of a snapshot
+
+    Arguments:
+        directory -> the snapshot directory
+
+    Return -> a sorted list of version numbers, empty if there are none
+    """
+
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name) for name in os.listdir(directory)
+                  if name.isdigit() and os.path.exists(os.path.join(directory, name, MANIFEST)))
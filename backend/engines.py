@@ -0,0 +1,31 @@
+"""
+The collaborative filtering engines, by the name used to pick one in configuration
+"""
+
+from backend.CollabFilter import CollaborativeFilter
+from backend.ItemFilter import ItemFilter
+from backend.FactorFilter import FactorFilter
+
+
+#maps engine name -> engine class, every engine shares the BaseFilter interface
+ENGINES = {
+    "user": CollaborativeFilter,
+    "item": ItemFilter,
+    "factor": FactorFilter,
+    }
+
+
+def createFilter(engine, *args, **kwargs):
+    """
+    Creates a filtering engine by name
+
+    Arguments:
+        engine -> the name of the engine, one of ENGINES
+        args   -> passed on to the engine, see BaseFilter
+
+    Return -> the new engine
+    """
+
+    if engine not in ENGINES:
+        raise ValueError("Unknown filter engine {}, expected one of {}".format(engine, ", ".join(sorted(ENGINES))))
+    return ENGINES[engine](*args, **kwargs)
@@ -1,88 +1,167 @@
 """
-extended test cases for the collaorative filter
+benchmarks for the collaborative filter, at several scales of power law data
+
+    python3 -m backend.test [scale ...] [--counts]
+
+writes one json object a line for every benchmark at every scale, with the
+seconds of each operation, and with --counts how many times each of the
+engine's methods was called while predicting and changing opinions
 """
 
-import CollabFilter as collab
-from timeit import timeit
-from string import ascii_uppercase
+from backend.CollabFilter import CollaborativeFilter
+from backend.Evaluate import trainingDatabase
+from backend.utils import powerLawOpinions
+from collections import Counter
+from contextlib import contextmanager
+from sys import argv, stdout
+from timeit import default_timer
+import json
+import random
 import types
-import pprint
+import numpy as np
 
-letters = ascii_uppercase
-names = [a+b for a in letters for b in letters]
-classes = ["CS"+ str(i) + str(n) for i in xrange(10) for n in xrange(10)]
-test_filter = collab.CollaborativeFilter("test.db", "databases/data", "main")
+#maps scale name -> tuple(users, items, density)
+SCALES = {
+    "small": (200, 100, .05),
+    "medium": (2000, 500, .02),
+    "large": (20000, 2000, .005),
+    }
+#_noCacheRating runs a query or two for every other user, so it is only timed a few times
+NO_CACHE_CALLS = {"small": 1, "medium": 0, "large": 0}
 
 
-def fill_database():
+@contextmanager
+def countingCalls(engine):
     """
-    a
+    Counts the calls to every method of an engine for the length of a with block, including the calls the engine
+        makes to itself
+
+    Arguments:
+        engine -> the engine, its methods are wrapped on the instance and put back afterwards
+
+    Return -> a Counter(method name->calls), filled in as the block runs
     """
 
-    for name in names:
-        test_filter.db.addUser(name)
+    counter = Counter()
+    methods = [name for name in dir(engine) if isinstance(getattr(engine, name, None), types.MethodType)]
+
+    def wrapper(name, function):
+        def counted(*args, **kwargs):
+            counter[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    for name in methods:
+        setattr(engine, name, wrapper(name, getattr(engine, name)))
+    try:
+        yield counter
+    finally:
+        for name in methods:
+            delattr(engine, name)
+
 
-    for class_ in classes:
-        test_filter.db.newField(class_)
+def timings(seconds):
+    """
+    Summarizes the seconds a number of calls took
 
-    counter = 0
-    for user in names:
-        for course in classes:
-            test_filter.db.changeOpinion(user, course, counter)
-            #print counter
-            counter += 1
+    Arguments:
+        seconds -> a list of the seconds of each call
 
-    print test_filter.db.currentOpinion("ab", "CS12")
+    Return -> map(name->value) of the calls, the calls a second, and the mean, p50 and p99 milliseconds
+    """
 
+    if not seconds:
+        return {"calls": 0}
+    return {"calls": len(seconds), "calls/sec": len(seconds) / sum(seconds), "mean ms": 1000 * float(np.mean(seconds)),
+            "p50 ms": 1000 * float(np.percentile(seconds, 50)), "p99 ms": 1000 * float(np.percentile(seconds, 99))}
 
-def test_cached(calls, changes, secondary_calls):
-    for position in xrange(calls):
-        test_filter.predictOpinion(names[position], classes[len(classes) - position - 3])
-    for position in xrange(changes):
-        test_filter.changeOpinion(names[position], classes[len(classes) - position - 3], position)
-    for position in xrange(secondary_calls):
-        test_filter.predictOpinion(names[position], classes[len(classes) - position - 3])
 
-def test_no_cache(calls, changes, secondary_calls):
-    for position in xrange(calls):
-        test_filter._noCacheRating(names[position], classes[len(classes) - position - 3])
-    for position in xrange(changes):
-        test_filter.changeOpinion(names[position], classes[len(classes) - position - 3], position)
-    for position in xrange(secondary_calls):
-        test_filter._noCacheRating(names[position], classes[len(classes) - position - 3])
+def timeCalls(function, calls):
+    """
+    Times a function on each of a list of arguments
 
-def overall_test(first, second, third, runs=1):
-    print "no caching with " + str(runs) + " iterations"
-    print timeit("test_no_cache("+str(first)+", "+str(second)+", "+str(third)+")", number=runs, setup="from __main__ import test_no_cache")
-    print "caching with " + str(runs) + " iterations"
-    print timeit("test_cached("+str(first)+", "+str(second)+", "+str(third)+")", number=runs, setup="from __main__ import test_cached")
+    Arguments:
+        function -> the function
+        calls    -> a list of tuples of arguments
 
-def overall_test_with_shenanigans(first, second, third, runs=1):
+    Return -> the list of the seconds each call took
+    """
 
-    methods = [method for method in dir(test_filter) if type(getattr(test_filter, method)) == types.MethodType]
-    counter = {getattr(test_filter, method): 0 for method in methods}
-    #print methods
+    seconds = []
+    for arguments in calls:
+        start = default_timer()
+        function(*arguments)
+        seconds.append(default_timer() - start)
+    return seconds
 
-    for method in methods:
-        def wrapper(function):
-            def newFunction(*args, **kwargs):
-                #print function
-                counter[function] += 1
-                return function(*args, **kwargs)
-            return newFunction
-        setattr(test_filter, method, wrapper(getattr(test_filter, method)))
 
-    test_cached(first, second, third)
-    pprint.pprint(counter)
+def benchmark(scale, predictions=200, changes=50, counts=False, seed=0):
+    """
+    Runs every benchmark at one scale
+
+    Arguments:
+        scale       -> a name from SCALES
+        predictions -> the number of predictOpinion calls, before and after the changes
+        changes     -> the number of changeOpinion calls
+        counts      -> also counts the engine's method calls, which slows everything it counts down
+        seed        -> the seed for the data and for the calls
 
-    for item in counter:
-        counter[item] = 0
+    Return -> a list of map(name->value), one for each benchmark
+    """
 
+    users, items, density = SCALES[scale]
+    results = []
+    def record(name, **values):
+        results.append(dict({"scale": scale, "users": users, "items": items, "benchmark": name}, **values))
+
+    start = default_timer()
+    opinions = powerLawOpinions(users, items, density, seed=seed)
+    record("generate", seconds=default_timer() - start, opinions=len(opinions))
+
+    start = default_timer()
+    db, loaded = trainingDatabase(opinions)
+    seconds = default_timer() - start
+    record("bulk load", seconds=seconds, **{"opinions/sec": loaded / seconds})
+
+    start = default_timer()
+    engine = CollaborativeFilter("benchmark.db", "sqlite://", "opinions", db=db)
+    record("load engine", seconds=default_timer() - start)
+
+    rng = random.Random(seed)
+    predictionCalls = [(rng.randint(1, users), rng.randint(1, items)) for call in range(predictions)]
+    changeCalls = [(rng.randint(1, users), rng.randint(1, items), rng.randint(1, 5)) for call in range(changes)]
+
+    record("predictOpinion cold", **timings(timeCalls(engine.predictOpinion, predictionCalls)))
+    record("predictOpinion warm", **timings(timeCalls(engine.predictOpinion, predictionCalls)))
+    record("changeOpinion", **timings(timeCalls(engine.changeOpinion, changeCalls)))
+    record("predictOpinion after changes", **timings(timeCalls(engine.predictOpinion, predictionCalls)))
+    record("_noCacheRating", **timings(timeCalls(engine._noCacheRating, predictionCalls[:NO_CACHE_CALLS[scale]])))
+
+    start = default_timer()
+    engine.precomputeSimilarities()
+    record("precompute", seconds=default_timer() - start, pairs=int(len(engine.similarities.keys)))
+
+    if counts:
+        fresh = CollaborativeFilter("benchmark.db", "sqlite://", "opinions", db=db)
+        with countingCalls(fresh) as counter:
+            for user, item in predictionCalls[:10]:
+                fresh.predictOpinion(user, item)
+            #the database already holds changeCalls, so each opinion is changed again to something else
+            for user, item, opinion in changeCalls[:10]:
+                fresh.changeOpinion(user, item, opinion % 5 + 1)
+            for user, item in predictionCalls[:10]:
+                fresh.predictOpinion(user, item)
+        record("calls cached", calls=dict(counter))
+        with countingCalls(fresh) as counter:
+            for user, item in predictionCalls[:NO_CACHE_CALLS[scale]]:
+                fresh._noCacheRating(user, item)
+        record("calls no cache", calls=dict(counter))
+    return results
 
-    test_no_cache(first, second, third)
-    pprint.pprint(counter)
 
 if __name__ == "__main__":
-    #fill_database()
-    #overall_test(1, 1, 1)
-    overall_test_with_shenanigans(1,1,1)
+    scales = [scale for scale in argv[1:] if not scale.startswith("--")] or ["small", "medium"]
+    for scale in scales:
+        for result in benchmark(scale, counts="--counts" in argv):
+            stdout.write(json.dumps(result) + "\n")
+            stdout.flush()
@@ -0,0 +1,261 @@
+"""
+Helpers shared by the filtering engines, their tests and their benchmarks
+"""
+
+from contextlib import contextmanager
+from threading import Condition, RLock, local
+import numpy as np
+import scipy.sparse as sparse
+import databases.database as databases
+
+
+def syntheticOpinions(users, items, density, groups=5, seed=0):
+    """
+    Generates opinions with some structure to them: every user belongs to one
+        of a few groups with shared tastes and rates items close to their group's
+        opinion of them
+
+    Arguments:
+        users   -> the number of users, their ids are 1 to users
+        items   -> the number of items, their ids are 1 to items
+        density -> the fraction of (user, item) pairs that have an opinion
+        groups  -> the number of groups of users with similar tastes
+        seed    -> the seed for the random numbers
+
+    Return -> a list of tuple(user, item, rating) with ratings 1-5
+    """
+
+    random = np.random.RandomState(seed)
+    tastes = random.uniform(1, 5, (groups, items))
+    group = random.randint(groups, size=users)
+    known = random.random_sample((users, items)) < density
+    ratings = np.clip(np.rint(tastes[group] + random.normal(0, .75, (users, items))), 1, 5)
+    rows, columns = np.nonzero(known)
+    return list(zip((rows + 1).tolist(), (columns + 1).tolist(), ratings[rows, columns].tolist()))
+
+
+def syntheticSparseOpinions(users, items, perUser, groups=5, seed=0):
+    """
+    The same kind of opinions as syntheticOpinions, for catalogues too big to draw every (user, item) pair: every
+        user rates about perUser items picked at random
+
+    Arguments:
+        users   -> the number of users, their dense indices are 0 to users - 1
+        items   -> the number of items, their dense indices are 0 to items - 1
+        perUser -> the number of items each user rates, fewer where the same item is picked twice
+        groups  -> the number of groups of users with similar tastes
+        seed    -> the seed for the random numbers
+
+    Return -> a scipy csr matrix of shape (users, items) with ratings 1-5
+    """
+
+    random = np.random.RandomState(seed)
+    tastes = random.uniform(1, 5, (groups, items))
+    group = random.randint(groups, size=users)
+    rows = np.repeat(np.arange(users), perUser)
+    columns = random.randint(items, size=users * perUser)
+    ratings = np.clip(np.rint(tastes[group[rows], columns] + random.normal(0, .75, len(rows))), 1, 5)
+    matrix = sparse.csr_matrix((ratings, (rows, columns)), shape=(users, items))
+    #an item picked twice for a user was summed, it is set back to a single rating
+    matrix.data = np.clip(matrix.data, 1, 5)
+    matrix.sort_indices()
+    return matrix
+
+
+def powerLawOpinions(users, items, density, exponent=1., groups=5, seed=0):
+    """
+    Generates opinions the way real ones are spread out: a few users rate a lot and most rate a little, and a few
+        items are rated by nearly everyone while most are rated by few.  How active a user and how popular an item is
+        falls off as rank ** -exponent, and the ratings have the same group structure as syntheticOpinions
+
+    Arguments:
+        users    -> the number of users, their ids are 1 to users
+        items    -> the number of items, their ids are 1 to items
+        density  -> the fraction of (user, item) pairs that have an opinion, fewer where the same pair is drawn twice
+        exponent -> how steeply activity and popularity fall off, 0 for uniform
+        groups   -> the number of groups of users with similar tastes
+        seed     -> the seed for the random numbers
+
+    Return -> a list of tuple(user, item, rating) with ratings 1-5, each pair at most once
+    """
+
+    random = np.random.RandomState(seed)
+    tastes = random.uniform(1, 5, (groups, items))
+    group = random.randint(groups, size=users)
+    userWeights = np.arange(1, users + 1) ** -float(exponent)
+    itemWeights = np.arange(1, items + 1) ** -float(exponent)
+    count = int(density * users * items)
+    rows = random.choice(users, count, p=userWeights / userWeights.sum())
+    columns = random.choice(items, count, p=itemWeights / itemWeights.sum())
+    cells = np.unique(rows.astype(np.int64) * items + columns)
+    rows, columns = cells // items, cells % items
+    ratings = np.clip(np.rint(tastes[group[rows], columns] + random.normal(0, .75, len(cells))), 1, 5)
+    return list(zip((rows + 1).tolist(), (columns + 1).tolist(), ratings.tolist()))
+
+
+def syntheticDatabase(users, items, density, groups=5, seed=0, path="sqlite://"):
+    """
+    Creates a database filled with synthetic opinions, see syntheticOpinions
+
+    Arguments:
+        path -> the sqlalchemy database url, an in memory database by default
+
+    Return -> the new databases.database.Database
+    """
+
+    db = databases.Database("synthetic.db", path)
+    with db.session_scope() as session:
+        for user, item, rating in syntheticOpinions(users, items, density, groups, seed):
+            session.add(db.opinion(user_id=user, item_id=item, rating=rating))
+    return db
+
+#the example matrix from Math/CollabFilter.tex, users W, X, Y, Z are 1-4 and items A, B, C, D are 10-13
+EXAMPLE = [[1, 2, 3, 5],
+           [1, 0, 3, 5],
+           [1, 1, 1, 1],
+           [5, 5, 5, 5]]
+USERS = [1, 2, 3, 4]
+ITEMS = [10, 11, 12, 13]
+
+
+def exampleDatabase():
+    """
+    Creates an in memory database filled with the example matrix
+
+    Return -> the new databases.database.Database
+    """
+
+    db = databases.Database("test.db", "sqlite://")
+    with db.session_scope() as session:
+        for user, row in zip(USERS, EXAMPLE):
+            for item, rating in zip(ITEMS, row):
+                if rating:
+                    db.add_opinion(session, user, item, rating)
+    return db
+
+
+
+class ReadWriteLock(object):
+    """
+    A lock any number of readers can hold at once, or a single writer.  Once a
+    writer is waiting new readers wait behind it, so a steady stream of
+    predictions can not keep a change out forever.
+
+    Both sides are reentrant: a thread that holds the lock can take it again
+    for reading, and a writer can take it again for writing.  A reader can not
+    become a writer, that would wait forever for itself to finish reading.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._readers = 0
+        self._writer = None
+        self._waitingWriters = 0
+        #implemented as the per thread depth of reads and writes held
+        self._held = local()
+
+
+    def _depth(self):
+        """
+        Return -> the calling thread's state, with reads and writes counting how many times it holds the lock
+        """
+
+        if not hasattr(self._held, "reads"):
+            self._held.reads = self._held.writes = 0
+        return self._held
+
+
+    @contextmanager
+    def reading(self):
+        """
+        Holds the lock for reading for the length of a with block
+
+        Return -> None
+        """
+
+        held = self._depth()
+        if held.reads or held.writes:
+            held.reads += 1
+            try:
+                yield
+            finally:
+                held.reads -= 1
+            return
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._writer is None and not self._waitingWriters)
+            self._readers += 1
+        held.reads = 1
+        try:
+            yield
+        finally:
+            held.reads = 0
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+
+    @contextmanager
+    def writing(self):
+        """
+        Holds the lock for writing for the length of a with block, once every reader has let go of it
+
+        Return -> None
+        """
+
+        held = self._depth()
+        if held.writes:
+            held.writes += 1
+            try:
+                yield
+            finally:
+                held.writes -= 1
+            return
+        if held.reads:
+            raise RuntimeError("A reader can not take the lock for writing")
+
+        with self._condition:
+            self._waitingWriters += 1
+            try:
+                self._condition.wait_for(lambda: self._writer is None and not self._readers)
+            finally:
+                self._waitingWriters -= 1
+            self._writer = held
+        held.writes = 1
+        try:
+            yield
+        finally:
+            held.writes = 0
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
+class StripedLocks(object):
+    """
+    A fixed number of locks shared out between any number of keys, so that
+    work on different keys can run at once without a lock for every key.  Two
+    keys sharing a stripe only wait for each other.
+    """
+
+    def __init__(self, stripes=64):
+        """
+        Arguments:
+            stripes -> the number of locks
+        """
+
+        self.locks = [RLock() for stripe in range(stripes)]
+
+
+    def __call__(self, key):
+        """
+        Gets the lock of a key
+
+        Arguments:
+            key -> a hashable key, such as a dense user index
+
+        Return -> the reentrant lock of the key's stripe
+        """
+
+        return self.locks[hash(key) % len(self.locks)]
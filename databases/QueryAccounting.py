@@ -0,0 +1,154 @@
+"""
+Counts and times the sql statements a Database runs, per request or per
+session_scope, and points out the statements run over and over with only
+their parameters changed, the N+1 pattern of a query inside a loop
+"""
+
+from contextlib import contextmanager
+from timeit import default_timer
+import contextvars
+import logging
+import re
+import sqlalchemy.event
+
+LOGGER = logging.getLogger("databases.queries")
+
+# a parenthesized list of placeholders in any of the dbapi paramstyles, so IN lists of different lengths share a shape
+PLACEHOLDERS = re.compile(r"\((?:\?|%s|%\(\w+\)s|:\w+)(?:, ?(?:\?|%s|%\(\w+\)s|:\w+))*\)")
+
+
+def statement_shape(statement):
+    """
+    The statement with its whitespace and lists of placeholders collapsed,
+        the same for every run of a query whatever its parameters
+    """
+    return PLACEHOLDERS.sub("(...)", " ".join(statement.split()))
+
+
+class QueryScope(object):
+    """
+    The statements run during one request or session_scope
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.seconds = 0.
+        # maps statement shape -> [times run, seconds]
+        self.shapes = {}
+        # the contextvars token of the scope becoming current, end resets it
+        self.token = None
+
+    def record(self, shape, seconds):
+        self.statements += 1
+        self.seconds += seconds
+        counts = self.shapes.setdefault(shape, [0, 0.])
+        counts[0] += 1
+        counts[1] += seconds
+
+    def repeated(self, threshold):
+        """
+        A list of tuple(shape, times run, seconds) of the shapes run at least
+            threshold times, the most run first
+        """
+        return sorted(((shape, runs, seconds) for shape, (runs, seconds) in self.shapes.items() if runs >= threshold),
+                      key=lambda repeat: repeat[1], reverse=True)
+
+
+class QueryAccounting(object):
+    """
+    Listens to every statement an engine runs and adds it to the scope active
+        in the current thread or coroutine, if there is one.  Scopes do not
+        nest, a scope begun inside another one is the outer one, so a
+        request's session_scopes all count towards the request
+
+    Disabled, no scope begins and the listeners return straight away
+    """
+
+    def __init__(self, engine, enabled=False, threshold=5):
+        """
+        Keyword Arguments:
+            engine -- the sqlalchemy engine to listen to
+            enabled -- whether statements are counted, can be changed at any time
+            threshold -- how many runs of the same shape in one scope are reported as repeated
+        """
+        self.enabled = enabled
+        self.threshold = threshold
+        self._current = contextvars.ContextVar("query_scope", default=None)
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self._before_execute)
+        sqlalchemy.event.listen(engine, "after_cursor_execute", self._after_execute)
+        sqlalchemy.event.listen(engine, "handle_error", self._handle_error)
+
+    def begin(self, name):
+        """
+        Starts counting statements, returns the new scope to hand to end, or
+            None when disabled or already inside a scope
+        """
+        if not self.enabled or self._current.get() is not None:
+            return None
+        scope = QueryScope(name)
+        scope.token = self._current.set(scope)
+        return scope
+
+    def end(self, scope):
+        """
+        Stops counting the statements of a scope from begin and logs them,
+            as a warning when some were repeated
+        """
+        if scope is None:
+            return
+        try:
+            self._current.reset(scope.token)
+        except ValueError:
+            # ended in another context than it began in, which keeps its own value
+            pass
+        repeated = scope.repeated(self.threshold)
+        if repeated:
+            LOGGER.warning("%s ran %d statements in %.1f ms, repeated: %s", scope.name, scope.statements, scope.seconds * 1000,
+                           "; ".join("{} x {}".format(runs, shape) for shape, runs, seconds in repeated))
+        else:
+            LOGGER.debug("%s ran %d statements in %.1f ms", scope.name, scope.statements, scope.seconds * 1000)
+
+    @contextmanager
+    def scope(self, name):
+        """
+        begin and end around a with block, yields the scope or None
+        """
+        scope = self.begin(name)
+        try:
+            yield scope
+        finally:
+            self.end(scope)
+
+    def headers(self, scope, length=200):
+        """
+        A list of tuple(header, value) describing the statements of a scope so
+            far, one X-Query-Repeated header for each repeated shape
+        """
+        if scope is None:
+            return []
+        headers = [("X-Query-Count", "{} statements, {:.1f} ms".format(scope.statements, scope.seconds * 1000))]
+        for shape, runs, seconds in scope.repeated(self.threshold):
+            headers.append(("X-Query-Repeated", "{} x {:.1f} ms {}".format(runs, seconds * 1000, shape[:length])))
+        return headers
+
+    def _before_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if self._current.get() is not None:
+            connection.info.setdefault("query_starts", []).append((statement, default_timer()))
+
+    def _after_execute(self, connection, cursor, statement, parameters, context, executemany):
+        scope = self._current.get()
+        starts = connection.info.get("query_starts")
+        if scope is not None and starts:
+            scope.record(statement_shape(statement), default_timer() - starts.pop()[1])
+
+    def _handle_error(self, context):
+        # a statement that failed after it started never reaches _after_execute, its start is dropped here so
+        # it is not taken for the next statement's, and it still counts towards the scope.  a failure before
+        # the statement started, like a refused connection, has no start of its own to drop
+        starts = context.connection.info.get("query_starts") if context.connection is not None else None
+        if starts and starts[-1][0] == context.statement:
+            seconds = default_timer() - starts.pop()[1]
+            scope = self._current.get()
+            if scope is not None:
+                scope.record(statement_shape(context.statement), seconds)
@@ -0,0 +1,70 @@
+"""
+tests for the counting of the sql statements a database runs
+"""
+
+import unittest
+import contextvars
+import sqlalchemy.exc
+from databases.QueryAccounting import statement_shape
+from backend.utils import ITEMS, exampleDatabase
+
+
+class QueryAccountingTests(unittest.TestCase):
+
+    def test_01_disabled(self):
+        db = exampleDatabase()
+        self.assertIsNone(db.queries.begin("test"))
+
+    def test_02_repeated_statements(self):
+        db = exampleDatabase()
+        db.queries.enabled = True
+        with self.assertLogs("databases.queries", "WARNING") as logs:
+            with db.queries.scope("test") as scope:
+                #the session scopes inside count towards the outer scope
+                for item in ITEMS:
+                    with db.session_scope() as session:
+                        db.fetch_opinion(session, 1, item)
+                with db.session_scope() as session:
+                    db.fetch_opinion(session, 2, 10)
+        (shape, runs, seconds), = scope.repeated(db.queries.threshold)
+        self.assertEqual(runs, len(ITEMS) + 1)
+        self.assertTrue(shape.startswith("SELECT "))
+        self.assertEqual(scope.statements, len(ITEMS) + 1)
+        self.assertIn("test ran 5 statements", logs.output[0])
+        #a scope of its own when there is no outer one, below the threshold
+        with db.queries.scope("fetch") as scope:
+            with db.session_scope() as session:
+                db.fetch_opinion(session, 1, 10)
+        self.assertEqual((scope.statements, scope.repeated(db.queries.threshold)), (1, []))
+
+    def test_03_shapes(self):
+        self.assertEqual(statement_shape("SELECT a\n  FROM b WHERE c IN (?, ?, ?)"), "SELECT a FROM b WHERE c IN (...)")
+        self.assertEqual(statement_shape("SELECT a FROM b WHERE c IN (%(c_1)s, %(c_2)s)"), "SELECT a FROM b WHERE c IN (...)")
+
+    def test_04_failed_statement(self):
+        db = exampleDatabase()
+        db.queries.enabled = True
+        with db.queries.scope("test") as scope:
+            with db.engine.connect() as connection:
+                with self.assertRaises(sqlalchemy.exc.OperationalError):
+                    connection.exec_driver_sql("SELECT * FROM missing")
+                #the failed statement's start is gone, the next one is timed from its own
+                self.assertEqual(connection.info["query_starts"], [])
+                connection.exec_driver_sql("SELECT 1")
+                self.assertEqual(connection.info["query_starts"], [])
+        self.assertEqual(scope.statements, 2)
+
+    def test_05_context_reset(self):
+        db = exampleDatabase()
+        db.queries.enabled = True
+        outer = contextvars.copy_context()
+        #a scope begun and ended inside a context leaves the value it found
+        scope = outer.run(db.queries.begin, "inner")
+        self.assertIs(outer.run(db.queries._current.get), scope)
+        outer.run(db.queries.end, scope)
+        self.assertIsNone(outer.run(db.queries._current.get))
+        self.assertIsNone(db.queries._current.get())
+
+
+if __name__ == "__main__":
+    unittest.main()
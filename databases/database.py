@@ -11,13 +11,22 @@ from contextlib import contextmanager
 import sqlalchemy
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
+import sqlalchemy.dialects.mysql
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
 from . import CalculationDatabase
 from . import OpinionDatabase
 from . import SimilarityDatabase
+from .QueryAccounting import QueryAccounting
+from itertools import islice
+from timeit import default_timer
 import hashlib
 import os
 from  base64 import b64encode
 
+# ratings are rounded to this fraction of a point for the opinions fingerprint, so its sums are exact integers
+FINGERPRINT_SCALE = 1000
+
 
 class Database(object):
     """
@@ -58,6 +67,15 @@ class Database(object):
         self.metadata.create_all(self.engine)
         self.sessionmaker = sqlalchemy.orm.sessionmaker(bind=self.engine, expire_on_commit=False)
 
+        # callables of a list of (user, item, rating), run with the opinions a session added, updated or removed once
+        # it commits, and with each committed batch of bulk_load_opinions, rating is 0 on removal
+        self.opinion_listeners = []
+        sqlalchemy.event.listen(self.sessionmaker, "after_commit", self._opinions_committed)
+        sqlalchemy.event.listen(self.sessionmaker, "after_rollback", self._opinions_rolled_back)
+
+        # counts and times the statements of each session_scope, or of each request that begins a scope, when enabled
+        self.queries = QueryAccounting(self.engine)
+
         # on first run, create an admin account
 
     # the rest is just abstraction to make life less terrible
@@ -70,34 +88,122 @@ class Database(object):
             `with Database.session_scope() as session: #or similar`
         for operations requiring a session
         """
-        session = self.sessionmaker()
-        try:
-            yield session
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+        with self.queries.scope("session_scope"):
+            session = self.sessionmaker()
+            try:
+                yield session
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
 
 
     def add_opinion(self, session, user_id, movie_id, rating):
-        if not self.opinion_exists(session, item=movie_id, user=user_id):
-            session.add(self.opinion(user_id=user_id, item_id=movie_id, rating=rating))
+        if self._insert_new(session, self.opinion, ("user_id", "item_id"), {"user_id": user_id, "item_id": movie_id, "rating": rating}):
+            self.opinion_changed(session, user_id, movie_id, rating)
             return True
         return False
 
     def add_similarity(self, session, user_a, user_b, a, b):
-        if not self.similarity_exists(session, usera_id=user_a, userb_id=user_b):
-            session.add(self.similarity(usera_id=user_a, userb_id=user_b, a=a, b=b))
-            return True
-        return False
+        return self._insert_new(session, self.similarity, ("usera_id", "userb_id"), {"usera_id": user_a, "userb_id": user_b, "a": a, "b": b})
 
     def add_calculation(self, session, user, movie, rating):
-        if not self.calculation_exists(session, user_id=user, item_id=item):
-            session.add(self.calculation(user_id=user, item_id=item, rating=rating))
-            return True
-        return False
+        return self._insert_new(session, self.calculation, ("user_id", "item_id"), {"user_id": user, "item_id": movie, "rating": rating})
+
+    def upsert_opinion(self, session, user, item, rating):
+        """
+        stores an opinion whether or not the user already had one of the item, with a single statement on sqlite,
+        postgresql and mysql instead of a lookup and then an insert or an update
+        """
+        self.upsert_opinions(session, [(user, item, rating)])
+
+    def upsert_opinions(self, session, opinions):
+        """
+        stores many opinions, see upsert_opinion, with one executemany statement
+
+        opinions -- an iterable of (user, item, rating), each opinion at most once
+        """
+        opinions = list(opinions)
+        self._upsert(session, self.opinion, ("user_id", "item_id"), [{"user_id": user, "item_id": item, "rating": rating} for user, item, rating in opinions])
+        for user, item, rating in opinions:
+            self.opinion_changed(session, user, item, rating)
+
+    def upsert_similarity(self, session, usera, userb, a, b):
+        """
+        stores a similarity whether or not it is already stored, see upsert_opinion
+        """
+        self.upsert_similarities(session, [(usera, userb, a, b)])
+
+    def upsert_similarities(self, session, similarities):
+        """
+        stores many similarities, an iterable of (usera, userb, a, b), see upsert_opinions
+        """
+        self._upsert(session, self.similarity, ("usera_id", "userb_id"), [{"usera_id": usera, "userb_id": userb, "a": a, "b": b} for usera, userb, a, b in similarities])
+
+    def upsert_calculation(self, session, user, item, rating):
+        """
+        stores a calculation whether or not it is already stored, see upsert_opinion
+        """
+        self.upsert_calculations(session, [(user, item, rating)])
+
+    def upsert_calculations(self, session, calculations):
+        """
+        stores many calculations, an iterable of (user, item, rating), see upsert_opinions
+        """
+        self._upsert(session, self.calculation, ("user_id", "item_id"), [{"user_id": user, "item_id": item, "rating": rating} for user, item, rating in calculations])
+
+    def _conflict_insert(self, table, keys, update):
+        """
+        the dialect's insert of table that, when a row with the same keys is already stored, updates its other columns
+        (update is True) or leaves it be (update is False), None when the dialect has no such insert
+        """
+        dialect = self.engine.dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            insert = getattr(sqlalchemy.dialects, dialect).insert(table)
+            if not update:
+                return insert.on_conflict_do_nothing(index_elements=keys)
+            return insert.on_conflict_do_update(index_elements=keys, set_={column.name: insert.excluded[column.name] for column in table.c if column.name not in keys})
+        if dialect == "mysql":
+            insert = sqlalchemy.dialects.mysql.insert(table)
+            if not update:
+                return insert.prefix_with("IGNORE")
+            return insert.on_duplicate_key_update({column.name: insert.inserted[column.name] for column in table.c if column.name not in keys})
+        return None
+
+    def _insert_new(self, session, model, keys, row):
+        """
+        inserts row, a dict of every column, unless a row with the same keys is already stored
+
+        returns whether it was inserted
+        """
+        table = model.__table__
+        insert = self._conflict_insert(table, keys, update=False)
+        if insert is not None:
+            return session.execute(insert, row).rowcount == 1
+        if session.query(model).filter_by(**{key: row[key] for key in keys}).first() is not None:
+            return False
+        session.execute(table.insert(), row)
+        return True
+
+    def _upsert(self, session, model, keys, rows):
+        """
+        inserts rows, dicts of every column, updating those already stored, with a single executemany statement
+        where the dialect allows it and an update then maybe an insert for each row where it does not
+        """
+        if not rows:
+            return
+        table = model.__table__
+        upsert = self._conflict_insert(table, keys, update=True)
+        if upsert is not None:
+            session.execute(upsert, rows)
+            return
+        match = sqlalchemy.and_(*(table.c[key] == sqlalchemy.bindparam("b_" + key) for key in keys))
+        update = table.update().where(match).values({column: sqlalchemy.bindparam("b_" + column) for column in rows[0] if column not in keys})
+        for row in rows:
+            if not session.execute(update, {"b_" + column: value for column, value in row.items()}).rowcount:
+                session.execute(table.insert(), row)
 
 
     def opinion_exists(self, session, user, item):
@@ -150,9 +256,49 @@ class Database(object):
         except sqlalchemy.orm.exc.NoResultFound:
             raise ItemDoesNotExistError(DatabaseObjects.Calculation, user, item)
 
+    def fetch_user_opinions(self, session, user, items=None, chunk_size=500):
+        """
+        a dict of item -> rating of a user's opinions
+
+        items -- the items to fetch the user's opinions of, None for all of them
+        chunk_size -- the number of items looked up at a time, kept under the limit on bound parameters
+        """
+        query = session.query(self.opinion.item_id, self.opinion.rating).filter(self.opinion.user_id == user)
+        if items is None:
+            return dict(query)
+        items = list(items)
+        opinions = {}
+        for start in range(0, len(items), chunk_size):
+            opinions.update(query.filter(self.opinion.item_id.in_(items[start:start + chunk_size])))
+        return opinions
+
+    def fetch_user_profile(self, session, user):
+        """
+        the (count, sum, sum of squares) of a user's ratings, added up by the database
+        """
+        rating = self.opinion.rating
+        count, total, squares = session.query(sqlalchemy.func.count(rating), sqlalchemy.func.sum(rating),
+                                              sqlalchemy.func.sum(rating * rating)).filter(self.opinion.user_id == user).one()
+        return (count, total or 0, squares or 0)
+
+    def fetch_opinions_fingerprint(self, session):
+        """
+        the (count, sum of ratings, sum of user_id * rating, sum of item_id * rating) of every opinion that is not 0,
+        added up by the database, nearly any change to the opinions changes it.  the ratings are scaled by
+        FINGERPRINT_SCALE and added up as integers, so the sums are exact however many opinions there are and
+        fingerprints can be compared with ==
+        """
+        rating = sqlalchemy.cast(sqlalchemy.func.round(self.opinion.rating * FINGERPRINT_SCALE), sqlalchemy.BigInteger)
+        count, total, users, items = session.query(sqlalchemy.func.count(rating), sqlalchemy.func.sum(rating),
+                                                   sqlalchemy.func.sum(self.opinion.user_id * rating),
+                                                   sqlalchemy.func.sum(self.opinion.item_id * rating)).filter(self.opinion.rating != 0).one()
+        # some databases add up integers as decimals
+        return (count, int(total or 0), int(users or 0), int(items or 0))
+
     def remove_opinion(self, session, user, item):  # done, this can be made better
         if self.opinion_exists(session, user, item):
             session.query(self.opinion).filter(self.opinion.user_id == user, self.opinion.item_id == item).delete()
+            self.opinion_changed(session, user, item, 0)
 
     def remove_similarity(self, session, usera, userb):  # done
         if self.similarity_exists(session, usera, userb):
@@ -185,23 +331,155 @@ class Database(object):
         session.Calculation.query.delete()
 
     def update_opinion(self, session, user, item, rating):
-        if self.opinion_exists(session, user, item):
-            changes = {}
-            changes["rating"] = rating
-            session.query(self.opinion).filter(self.opinion.user_id == user, self.opinion.item_id == item).update(changes)
+        # the number of rows matched tells whether there was an opinion, without looking it up first
+        if session.query(self.opinion).filter(self.opinion.user_id == user, self.opinion.item_id == item).update({"rating": rating}):
+            self.opinion_changed(session, user, item, rating)
+
+    def change_opinions(self, session, changes, chunk_size=500):
+        """
+        adds, updates and removes many opinions with a handful of statements, instead of a few queries for each one
+
+        changes -- an iterable of (user, item, rating), a rating of 0 or None removes the opinion, each opinion at most once
+        chunk_size -- the number of users looked up at a time, kept under the limit on bound parameters
+        """
+        changes = list(changes)
+        table = self.opinion.__table__
+        users = list({user for user, item, rating in changes})
+        existing = set()
+        for start in range(0, len(users), chunk_size):
+            rows = session.query(self.opinion.user_id, self.opinion.item_id).filter(self.opinion.user_id.in_(users[start:start + chunk_size]))
+            existing.update((user, item) for user, item in rows)
+
+        inserts = [{"user_id": user, "item_id": item, "rating": rating} for user, item, rating in changes if rating and (user, item) not in existing]
+        updates = [{"b_user": user, "b_item": item, "b_rating": rating} for user, item, rating in changes if rating and (user, item) in existing]
+        deletes = [{"b_user": user, "b_item": item} for user, item, rating in changes if not rating and (user, item) in existing]
+        match = sqlalchemy.and_(table.c.user_id == sqlalchemy.bindparam("b_user"), table.c.item_id == sqlalchemy.bindparam("b_item"))
+        if inserts:
+            session.execute(table.insert(), inserts)
+        if updates:
+            session.execute(table.update().where(match).values(rating=sqlalchemy.bindparam("b_rating")), updates)
+        if deletes:
+            session.execute(table.delete().where(match), deletes)
+
+        for user, item, rating in changes:
+            if rating or (user, item) in existing:
+                self.opinion_changed(session, user, item, rating or 0)
+
+    def bulk_load_opinions(self, opinions, batch_size=10000, on_conflict="error", chunk_size=500, progress=None):
+        """
+        streams opinions into the table with one executemany insert and one commit a batch, instead of a query and an
+        orm add for each opinion, so the memory used does not grow with the number of opinions
+
+        opinions -- an iterable of (user, item, rating)
+        batch_size -- the number of opinions inserted and committed at a time
+        on_conflict -- what happens to an opinion that is already stored, or given twice:
+            "error" fails on it and is the fastest, the batch it is in is rolled back
+            "ignore" keeps the opinion already stored, or the first one given
+            "replace" overwrites it with the one loaded, the last one given
+        chunk_size -- the number of opinions looked up at a time for the other modes
+        progress -- a callable of (rows so far, seconds so far) run after each batch, or None
+
+        returns a dict of the rows read, inserted and replaced, the seconds and the rows per second.  a batch that fails
+        raises BulkLoadError, which carries the same dict for the batches committed before it
+        """
+        if on_conflict not in ("error", "ignore", "replace"):
+            raise ValueError("Unknown on_conflict {}, expected error, ignore or replace".format(on_conflict))
+        opinions = iter(opinions)
+        result = {"rows": 0, "inserted": 0, "replaced": 0}
+        start = default_timer()
+        while True:
+            batch = list(islice(opinions, batch_size))
+            if not batch:
+                break
+            try:
+                inserts, updates = self._load_batch(batch, on_conflict, chunk_size)
+            except sqlalchemy.exc.SQLAlchemyError as error:
+                raise BulkLoadError(self._load_rate(result, start), error) from error
+            if self.opinion_listeners:
+                # each batch is committed by the time _load_batch returns
+                self._notify_opinion_listeners([(row["user_id"], row["item_id"], row["rating"]) for row in inserts] +
+                                               [(row["b_user"], row["b_item"], row["b_rating"]) for row in updates])
+            result["rows"] += len(batch)
+            result["inserted"] += len(inserts)
+            result["replaced"] += len(updates)
+            if progress is not None:
+                progress(result["rows"], default_timer() - start)
+        return self._load_rate(result, start)
+
+    def _load_batch(self, batch, on_conflict, chunk_size):
+        """
+        stores one batch of bulk_load_opinions in a transaction of its own, returns the rows inserted and updated
+        """
+        table = self.opinion.__table__
+        match = sqlalchemy.and_(table.c.user_id == sqlalchemy.bindparam("b_user"), table.c.item_id == sqlalchemy.bindparam("b_item"))
+        with self.engine.begin() as connection:
+            if on_conflict == "error":
+                inserts, updates = [{"user_id": user, "item_id": item, "rating": rating} for user, item, rating in batch], []
+            else:
+                # maps (user, item) -> rating, the first or last given of each opinion
+                ratings = {}
+                for user, item, rating in batch:
+                    if on_conflict == "replace" or (user, item) not in ratings:
+                        ratings[(user, item)] = rating
+                existing = self._existing_opinions(connection, ratings, chunk_size)
+                inserts = [{"user_id": user, "item_id": item, "rating": rating} for (user, item), rating in ratings.items() if (user, item) not in existing]
+                updates = [{"b_user": user, "b_item": item, "b_rating": rating} for (user, item), rating in ratings.items()
+                           if (user, item) in existing and on_conflict == "replace"]
+            if inserts:
+                connection.execute(table.insert(), inserts)
+            if updates:
+                connection.execute(table.update().where(match).values(rating=sqlalchemy.bindparam("b_rating")), updates)
+        return inserts, updates
+
+    @staticmethod
+    def _load_rate(result, start):
+        """
+        adds the seconds since start and the rows per second to a bulk_load_opinions result
+        """
+        result["seconds"] = default_timer() - start
+        result["rows/sec"] = result["rows"] / result["seconds"] if result["seconds"] else None
+        return result
+
+    def _existing_opinions(self, connection, pairs, chunk_size):
+        """
+        the set of the (user, item) pairs in pairs that are already stored, looked up chunk_size pairs at a time
+        """
+        # only the pairs themselves are read, not every opinion of their users
+        pairs = sorted(pairs)
+        table = self.opinion.__table__
+        key = sqlalchemy.tuple_(table.c.user_id, table.c.item_id)
+        existing = set()
+        for start in range(0, len(pairs), chunk_size):
+            rows = connection.execute(sqlalchemy.select(table.c.user_id, table.c.item_id).where(key.in_(pairs[start:start + chunk_size])))
+            existing.update((user, item) for user, item in rows)
+        return existing
+
+    def opinion_changed(self, session, user, item, rating):
+        """
+        notes an opinion changed in session, the opinion listeners hear of it once the session commits and never if
+        it rolls back
+        """
+        if self.opinion_listeners:
+            session.info.setdefault("opinion_changes", []).append((user, item, rating))
+
+    def _opinions_committed(self, session):
+        changes = session.info.pop("opinion_changes", None)
+        if changes:
+            self._notify_opinion_listeners(changes)
+
+    def _opinions_rolled_back(self, session):
+        session.info.pop("opinion_changes", None)
+
+    def _notify_opinion_listeners(self, changes):
+        for listener in self.opinion_listeners:
+            listener(changes)
 
     def update_similarity(self, session, usera, userb, a, b):
-        if self.similarity_exists(session, usera, userb):
-            changes = {}
-            changes["a"] = a
-            changes["b"] = b
-            session.query(self.similarity).filter(self.similarity.usera_id == usera, self.similarity.userb_id == userb).update(changes)
+        # an update of a similarity that is not stored changes nothing, so there is no need to look it up first
+        session.query(self.similarity).filter(self.similarity.usera_id == usera, self.similarity.userb_id == userb).update({"a": a, "b": b})
 
     def update_calculation(self, session, user, item, rating):
-        if self.calculation_exists(session, user, item):
-            changes = {}
-            changes["rating"] = rating
-            session.query(self.calculation).filter(self.calculation.user_id == user, self.calculation.item_id == item).update(changes)
+        session.query(self.calculation).filter(self.calculation.user_id == user, self.calculation.item_id == item).update({"rating": rating})
 
     def __enter__(self):
         """
@@ -274,6 +552,17 @@ class ItemDoesNotExistError(Exception):
     def __str__(self):
         return "A {} named {} does not exist".format(self.identifier.name, self.name)
 
+class BulkLoadError(Exception):
+    """
+    Exception raised when a batch of Database.bulk_load_opinions fails, the batches before it stay committed
+    """
+    def __init__(self, result, error):
+        self.result = result
+        self.error = error
+
+    def __str__(self):
+        return "Bulk load failed after {} opinions were committed: {}".format(self.result["rows"], self.error)
+
 class UserDoesNotExistError(Exception):
     def __init__(self, identifier, name, *args):
         self.identifier = identifier
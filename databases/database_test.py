@@ -0,0 +1,113 @@
+"""
+tests for the bulk and batched writes of the database
+"""
+
+import unittest
+import databases.database as databases
+from backend.utils import exampleDatabase
+
+
+class BulkLoadTests(unittest.TestCase):
+
+    def ratings(self, db):
+        with db.session_scope() as session:
+            return {(opinion.user_id, opinion.item_id): opinion.rating for opinion in session.query(db.opinion)}
+
+    def test_01_batches(self):
+        db = databases.Database("test.db", "sqlite://")
+        changed, batches = [], []
+        db.opinion_listeners.append(changed.extend)
+        opinions = ((user, item, (user + item) % 5 + 1) for user in range(1, 11) for item in range(1, 8))
+        result = db.bulk_load_opinions(opinions, batch_size=30, progress=lambda rows, seconds: batches.append(rows))
+        self.assertEqual((result["rows"], result["inserted"], result["replaced"]), (70, 70, 0))
+        self.assertGreater(result["rows/sec"], 0)
+        self.assertEqual(batches, [30, 60, 70])
+        self.assertEqual(len(changed), 70)
+        self.assertEqual(self.ratings(db)[(3, 4)], 3)
+
+    def test_02_conflicts(self):
+        db = exampleDatabase()
+        opinions = [(1, 10, 4), (1, 10, 2), (1, 99, 3), (1, 99, 5)]
+        #the batch with the conflict is rolled back, those before it stay and are counted
+        with self.assertRaises(databases.BulkLoadError) as raised:
+            db.bulk_load_opinions([(5, 10, 1), (6, 10, 2)] + opinions, batch_size=2)
+        self.assertIsInstance(raised.exception.error, databases.sqlalchemy.exc.IntegrityError)
+        self.assertEqual((raised.exception.result["rows"], raised.exception.result["inserted"]), (2, 2))
+        self.assertEqual((self.ratings(db)[(5, 10)], self.ratings(db)[(6, 10)]), (1, 2))
+        self.assertNotIn((1, 99), self.ratings(db))
+
+        #a lookup per chunk of the opinions loaded, which reads only those opinions and not the rest of their users'
+        db.queries.enabled = True
+        with db.queries.scope("load") as scope:
+            result = db.bulk_load_opinions(opinions + [(2, item, 1) for item in range(20, 30)], on_conflict="ignore", chunk_size=5)
+        db.queries.enabled = False
+        self.assertEqual(scope.statements, 4)
+        with db.engine.connect() as connection:
+            self.assertEqual(db._existing_opinions(connection, {(1, 10): 4, (1, 98): 1, (2, 25): 1}, 2), {(1, 10), (2, 25)})
+        self.assertEqual((result["inserted"], result["replaced"]), (11, 0))
+        self.assertEqual((self.ratings(db)[(1, 10)], self.ratings(db)[(1, 99)]), (1, 3))
+        result = db.bulk_load_opinions(opinions, on_conflict="replace")
+        self.assertEqual((result["inserted"], result["replaced"]), (0, 2))
+        self.assertEqual((self.ratings(db)[(1, 10)], self.ratings(db)[(1, 99)]), (2, 5))
+        self.assertRaises(ValueError, db.bulk_load_opinions, opinions, on_conflict="merge")
+
+
+class UpsertTests(unittest.TestCase):
+
+    def statements(self, db, write):
+        db.queries.enabled = True
+        with db.queries.scope("write") as scope:
+            with db.session_scope() as session:
+                write(session)
+        db.queries.enabled = False
+        return scope.statements
+
+    def test_01_upserts(self):
+        db = exampleDatabase()
+        changed = []
+        db.opinion_listeners.append(changed.extend)
+        #one statement whether the opinion is new or not
+        self.assertEqual(self.statements(db, lambda session: db.upsert_opinion(session, 2, 11, 4)), 1)
+        self.assertEqual(self.statements(db, lambda session: db.upsert_opinion(session, 1, 10, 3)), 1)
+        self.assertEqual(self.statements(db, lambda session: db.upsert_opinions(session, [(1, 10, 2), (9, 9, 1)])), 1)
+        self.assertEqual(changed, [(2, 11, 4), (1, 10, 3), (1, 10, 2), (9, 9, 1)])
+        with db.session_scope() as session:
+            self.assertEqual([db.fetch_opinion(session, user, item).rating for user, item in ((2, 11), (1, 10), (9, 9))], [4, 2, 1])
+            db.upsert_similarities(session, [(1, 2, .5, 1), (1, 2, .25, 2)])
+            db.upsert_calculation(session, 1, 10, 3.5)
+            db.upsert_calculation(session, 1, 10, 4.5)
+        with db.session_scope() as session:
+            similarity = db.fetch_similarity(session, 1, 2)
+            self.assertEqual((similarity.a, similarity.b), (.25, 2))
+            self.assertEqual(db.fetch_calculation(session, 1, 10).rating, 4.5)
+
+    def test_02_add_and_update(self):
+        db = exampleDatabase()
+        with db.session_scope() as session:
+            self.assertFalse(db.add_opinion(session, 1, 10, 5))
+            self.assertTrue(db.add_calculation(session, 1, 10, 2))
+            self.assertFalse(db.add_calculation(session, 1, 10, 3))
+            self.assertTrue(db.add_similarity(session, 1, 2, .5, 1))
+            db.update_opinion(session, 7, 10, 5)
+            db.update_similarity(session, 1, 2, .75, 1)
+        self.assertEqual(self.statements(db, lambda session: db.update_opinion(session, 1, 10, 4)), 1)
+        with db.session_scope() as session:
+            self.assertEqual(db.fetch_opinion(session, 1, 10).rating, 4)
+            self.assertEqual(db.fetch_calculation(session, 1, 10).rating, 2)
+            self.assertEqual(db.fetch_similarity(session, 1, 2).a, .75)
+            self.assertFalse(db.opinion_exists(session, 7, 10))
+
+    def test_03_other_dialects(self):
+        db = exampleDatabase()
+        #a dialect without a native upsert updates, then inserts what was not there to update
+        db._conflict_insert = lambda table, keys, update: None
+        with db.session_scope() as session:
+            db.upsert_opinions(session, [(1, 10, 4), (9, 9, 1)])
+            self.assertFalse(db.add_opinion(session, 9, 9, 2))
+            self.assertTrue(db.add_opinion(session, 9, 8, 2))
+        with db.session_scope() as session:
+            self.assertEqual([db.fetch_opinion(session, user, item).rating for user, item in ((1, 10), (9, 9), (9, 8))], [4, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,54 +1,33 @@
-import glob, os
+"""
+loads the Netflix prize training set into the opinions table
+
+    python3 dataparser.py dataset/training_set sqlite:///data/netflix.db [batch size] [error|ignore|replace]
+
+customers are the users and movies the items, as in backend/Evaluate.py
+"""
+from sys import argv, stdout
 import databases.database as databases
-import datetime
-
-
-#class DataParser(object):
-
-#def __init__(self, folder, db):
-#    self.folder = folder
-#    self.databaes = db
-start = datetime.datetime.now()
-databaes = databases.Database("test.db", "sqlite:////Users/mfender/School/PROJECT/CollaborativeFiltering/rawr.db")
-
-#def parse_data(self):
-files = []
-for x in os.listdir('dataset/training_set/'):
-    if not os.path.isfile(x):
-        files.append(x)
-
-movies = dict()
-
-for item in files:
-    with open('dataset/training_set/'+ item, 'r') as f:
-        data = f.readlines()
-        mid = 0
-        #loop through it all!
-        for line in data:
-            if ":" in line:
-                mid = int(line.split(':')[0])
-                movies[mid] = {}
-            else:
-                d = line.split(',')
-                movies[mid][int(d[0])] = int(d[1])
-#return movies
-#now import it all into the database!
-#def import_data(self, data):
-
-counter = 0
-with open('import.sql', 'w') as f:
-    f.write('PRAGMA synchronous = OFF;')
-    f.write('PRAGMA journal_mode = MEMORY;')
-    f.write('begin transaction;')
-    for key, value in movies.items():
-        for k in value:
-            if counter <= 1000000:
-                f.write('insert into opinions values({}, {}, {});\n'.format(key, k, movies[key][k]))
-                print('Movie {} rated by user {} with rating {}'.format(key, k, movies[key][k]))
-#            databaes.add_opinion(session, key, k, movies[key][k])
-            else:
-                count = 0
-                f.write('end transaction; begin transaction;\n')
-
-end = datetime.datetime.now()
-print('Time to complete: {}'.format((end - start)))
+from backend.Evaluate import netflixOpinions
+
+
+def report_progress(rows, seconds):
+    stdout.write("\r{} opinions loaded, {:.0f} a second".format(rows, rows / seconds if seconds else 0))
+    stdout.flush()
+
+
+def load_netflix(folder, path, batch_size=100000, on_conflict="error", progress=report_progress):
+    """
+    streams every opinion of a training_set folder into the database at path, see Database.bulk_load_opinions
+    """
+    database = databases.Database("netflix.db", path)
+    return database.bulk_load_opinions(netflixOpinions(folder), batch_size, on_conflict, progress=progress)
+
+
+if __name__ == "__main__":
+    batch_size = int(argv[3]) if len(argv) > 3 else 100000
+    on_conflict = argv[4] if len(argv) > 4 else "error"
+    try:
+        result = load_netflix(argv[1], argv[2], batch_size, on_conflict)
+    except databases.BulkLoadError as error:
+        raise SystemExit("\n{} ({inserted} inserted, {replaced} replaced)".format(error, **error.result))
+    print("\nloaded {rows} opinions ({inserted} inserted, {replaced} replaced) in {seconds:.1f} seconds, {rows/sec:.0f} a second".format(**result))
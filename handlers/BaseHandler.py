@@ -3,9 +3,10 @@ The base class from which most (all? other handlers will inherit)
 """
 from tornado.web import RequestHandler
 import tornado
+from handlers.RequestAccounting import RequestAccounting
 
 
-class BaseHandler(RequestHandler):
+class BaseHandler(RequestAccounting, RequestHandler):
     """
     """
     def get_current_user(self):
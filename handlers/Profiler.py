@@ -0,0 +1,250 @@
+"""
+An opt-in profiling layer for the request handlers, it runs cProfile on a
+fraction of the requests and adds each profile to its route's statistics in
+memory, which every process dumps now and then to its own file per route in a
+profile directory
+"""
+import cProfile
+import os
+import pstats
+import random
+import re
+from timeit import default_timer
+
+#the file in the profile directory holding the fraction of requests to profile and the number of clears so far,
+#written by set_fraction and clear
+CONTROL_FILE = "fraction"
+#the fraction in a control file written by a clear before any set_fraction, which leaves every server's as it is
+UNSET = "-"
+#the extension of the per route profiles
+SUFFIX = ".prof"
+#a profile file's name, the route and the id of the process that wrote it
+PROFILE_NAME = re.compile(r"^(.+)\.(\d+)" + re.escape(SUFFIX) + "$")
+#maps sort name -> the index of the value it sorts by in a hot_functions row
+SORTS = {"calls": 0, "time": 1, "cumulative": 2}
+
+
+class Profiler(object):
+    """
+    Profiles a fraction of the requests, 0 profiles none of them.  The fraction
+        can be changed while servers run by writing the control file in the
+        profile directory (see set_fraction), which every server sharing the
+        directory checks at most once an interval
+
+    A profile covers whatever runs on the thread between begin and end, a
+        handler that yields to the ioloop mid request also profiles the
+        requests that run in the meantime
+
+    The profiles are added up in memory and written out by dump, at most once
+        a dump_interval from end and when the server stops, each process to
+        files of its own so servers sharing the directory never overwrite
+        each other.  clear counts itself in the control file, and every
+        server drops its statistics and files when it sees the count change
+    """
+    def __init__(self, directory="profiles", fraction=0., interval=1., dump_interval=60.):
+        self.directory = directory
+        self.fraction = fraction
+        self.interval = interval
+        self.dump_interval = dump_interval
+        #maps route name -> the pstats.Stats of this process's profiles of it
+        self.stats = {}
+        self._dumped = default_timer()
+        #when the control file was last checked and the modification time it had, None before the first check
+        self._checked = None
+        self._modified = None
+        #the number of clears in the control file when it was last read, none until there is one
+        self._clears = 0
+
+    def control_path(self):
+        return os.path.join(self.directory, CONTROL_FILE)
+
+    def route_name(self, route):
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", route)
+
+    def route_path(self, route, pid=None):
+        """
+        The file of a route's profile written by a process, this one by default
+        """
+        return os.path.join(self.directory, "{}.{}{}".format(self.route_name(route), os.getpid() if pid is None else pid, SUFFIX))
+
+    def set_fraction(self, fraction):
+        """
+        Changes the fraction of requests profiled, here and in every server
+            using the same profile directory
+        """
+        fraction = min(max(float(fraction), 0.), 1.)
+        try:
+            clears = self._read_control()[1]
+        except (OSError, ValueError):
+            clears = 0
+        self._write_control(fraction, clears)
+        self.fraction, self._checked = fraction, None
+
+    def _read_control(self):
+        """
+        The tuple(fraction or None when it is unset, clears) in the control
+            file, raises OSError when there is none and ValueError when it is
+            being written
+        """
+        with open(self.control_path()) as control:
+            #a file from before clears were counted holds the fraction alone
+            fraction, *clears = control.read().split()
+        fraction = None if fraction == UNSET else min(max(float(fraction), 0.), 1.)
+        return fraction, int(clears[0]) if clears else 0
+
+    def _write_control(self, fraction, clears):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.control_path() + ".tmp", "w") as control:
+            control.write("{} {}".format(UNSET if fraction is None else fraction, clears))
+        os.replace(self.control_path() + ".tmp", self.control_path())
+
+    def current_fraction(self):
+        """
+        The fraction of requests to profile, read again from the control file
+            when it changed and the interval has passed, along with the clears
+            made since, which drop this process's statistics
+        """
+        now = default_timer()
+        if self._checked is None or now - self._checked >= self.interval:
+            self._checked = now
+            try:
+                modified = os.stat(self.control_path()).st_mtime
+                if modified != self._modified:
+                    fraction, clears = self._read_control()
+                    if fraction is not None:
+                        self.fraction = fraction
+                    if clears != self._clears:
+                        self._clears = clears
+                        self._reset()
+                    self._modified = modified
+            except (OSError, ValueError):
+                #no control file, or one being written, keeps the fraction as it is
+                pass
+        return self.fraction
+
+    def begin(self):
+        """
+        Starts profiling a request if it is sampled, returns the
+            cProfile.Profile to hand to end or None
+        """
+        if not self.current_fraction() or random.random() >= self.fraction:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            #another profiler is already running on this thread
+            return None
+        return profile
+
+    def end(self, route, profile):
+        """
+        Stops a profile from begin and adds it to the route's statistics,
+            dumping them all when the dump_interval has passed
+        """
+        profile.disable()
+        name = self.route_name(route)
+        if name in self.stats:
+            self.stats[name].add(profile)
+        else:
+            self.stats[name] = pstats.Stats(profile)
+        if default_timer() - self._dumped >= self.dump_interval:
+            self.dump()
+
+    def dump(self):
+        """
+        Writes this process's statistics of every route to its own files, each
+            holding everything profiled since the process started or the last clear
+        """
+        self._dumped = default_timer()
+        if not self.stats:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for route, stats in self.stats.items():
+            path = self.route_path(route)
+            #written aside and moved, so a server reading the profiles never sees half of one
+            stats.dump_stats(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def _profiles(self):
+        """
+        A list of tuple(route, pid) of the profile files in the directory
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return [(match.group(1), int(match.group(2))) for match in map(PROFILE_NAME.match, os.listdir(self.directory)) if match]
+
+    def routes(self):
+        """
+        The routes with a profile, written by any process or in this one's memory, by name
+        """
+        return sorted({route for route, pid in self._profiles()} | set(self.stats))
+
+    def _route_stats(self, route):
+        """
+        The statistics of each process's profile of a route, this process's
+            from memory as they include whatever it dumped
+        """
+        stats = [pstats.Stats(self.route_path(route, pid)) for name, pid in self._profiles() if name == route and pid != os.getpid()]
+        if route in self.stats:
+            stats.append(self.stats[route])
+        return stats
+
+    def hot_functions(self, limit=20, sort="cumulative", routes=None):
+        """
+        The functions that took the longest across the routes' profiles
+
+        Arguments:
+            limit  -> the most functions to return
+            sort   -> one of SORTS, what the functions are ordered by
+            routes -> the routes to read, None for all of them
+
+        Return -> a list of tuple(calls, seconds, cumulative seconds, function, list of the routes calling it)
+        """
+        functions = {}
+        for route in self.routes() if routes is None else routes:
+            for stats in self._route_stats(route):
+                for function, (primitive, calls, seconds, cumulative, callers) in stats.stats.items():
+                    row = functions.setdefault(function, [0, 0., 0., pstats.func_std_string(function), []])
+                    row[0] += calls
+                    row[1] += seconds
+                    row[2] += cumulative
+                    if route not in row[4]:
+                        row[4].append(route)
+        return [tuple(row) for row in sorted(functions.values(), key=lambda row: row[SORTS[sort]], reverse=True)[:limit]]
+
+    def clear(self):
+        """
+        Removes every process's profiles and this one's statistics, and counts
+            the clear in the control file so the servers sharing the directory
+            drop theirs too instead of dumping them again
+        """
+        try:
+            fraction, clears = self._read_control()
+        except (OSError, ValueError):
+            fraction, clears = None, 0
+        self._write_control(fraction, clears + 1)
+        self._clears = clears + 1
+        for route, pid in self._profiles():
+            self._remove(route, pid)
+        self.stats = {}
+
+    def _reset(self):
+        """
+        Drops this process's statistics and its files, after a clear by
+            another process
+        """
+        for route, pid in self._profiles():
+            if pid == os.getpid():
+                self._remove(route, pid)
+        self.stats = {}
+
+    def _remove(self, route, pid):
+        try:
+            os.remove(self.route_path(route, pid))
+        except FileNotFoundError:
+            #removed by another process clearing at the same time
+            pass
+
+#the profiler the handlers share, routing.py sets its directory and fraction
+PROFILER = Profiler()
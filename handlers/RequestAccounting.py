@@ -0,0 +1,46 @@
+"""
+The per request profiling and sql statement counting shared by the page and
+api handlers
+"""
+from handlers.Profiler import PROFILER
+
+
+class RequestAccounting(object):
+    """
+    A mixin for a RequestHandler with a db attribute, put it before
+        RequestHandler in the bases so its finish runs first
+    """
+    #the request's cProfile.Profile and QueryScope, None when it is not sampled or counted
+    profile = None
+    queries = None
+
+    def prepare(self):
+        """
+        Starts profiling the request, if the profiler samples it, and counting
+            its sql statements, if the database counts them
+        """
+        self.profile = PROFILER.begin()
+        if hasattr(self.db, "queries"):
+            self.queries = self.db.queries.begin(type(self).__name__)
+
+    def finish(self, chunk=None):
+        """
+        Describes the request's sql statements in debug headers, when they are
+            counted, before the response is sent
+        """
+        if self.queries is not None and not self._headers_written:
+            for name, value in self.db.queries.headers(self.queries):
+                self.add_header(name, value)
+        return super().finish(chunk)
+
+    def on_finish(self):
+        """
+        Adds the request's profile, if there is one, to its handler's profile,
+            and logs its sql statements
+        """
+        if self.profile is not None:
+            PROFILER.end(type(self).__name__, self.profile)
+            self.profile = None
+        if self.queries is not None:
+            self.db.queries.end(self.queries)
+            self.queries = None
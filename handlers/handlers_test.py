@@ -0,0 +1,128 @@
+"""
+tests for the request handlers and the profiling layer around them
+"""
+
+import unittest
+from handlers.Profiler import Profiler, PROFILER, CONTROL_FILE
+from api.handlers.ApiHome import ApiHome
+from api.handlers.BaseApi import BaseHandler as BaseApiHandler
+from backend.utils import ITEMS, exampleDatabase
+import random
+import os
+import shutil
+import tempfile
+import tornado.testing
+import tornado.web
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_01_sampling(self):
+        profiler = Profiler(self.directory, interval=0)
+        self.assertIsNone(profiler.begin())
+        profiler.fraction = 1
+        for call in range(2):
+            profile = profiler.begin()
+            sorted(random.random() for number in range(100))
+            profiler.end("/dash", profile)
+        profile = profiler.begin()
+        profiler.end("ApiUser", profile)
+        self.assertEqual(profiler.routes(), ["ApiUser", "_dash"])
+        #the two requests of the same route are added together, in memory until a dump
+        self.assertEqual(os.listdir(self.directory), [])
+        hot = {function: (calls, routes) for calls, seconds, cumulative, function, routes in profiler.hot_functions(limit=100, sort="calls")}
+        self.assertEqual(hot["{built-in method builtins.sorted}"], (2, ["_dash"]))
+        profiler.clear()
+        self.assertEqual(profiler.routes(), [])
+
+    def test_02_runtime_switch(self):
+        server, command = Profiler(self.directory, interval=0), Profiler(self.directory)
+        self.assertEqual(server.current_fraction(), 0)
+        command.set_fraction(.25)
+        self.assertEqual(server.current_fraction(), .25)
+        command.set_fraction(2)
+        self.assertEqual(server.current_fraction(), 1)
+
+    def test_03_process_files(self):
+        profiler = Profiler(self.directory, fraction=1, interval=0, dump_interval=0)
+        profile = profiler.begin()
+        sorted(random.random() for number in range(100))
+        profiler.end("/dash", profile)
+        path = profiler.route_path("/dash")
+        self.assertTrue(os.path.exists(path))
+        #another process's file of the same route is added to this one's statistics, which supersede its own file
+        shutil.copy(path, profiler.route_path("/dash", pid=1))
+        profile = profiler.begin()
+        sorted(random.random() for number in range(100))
+        profiler.end("/dash", profile)
+        hot = {function: calls for calls, seconds, cumulative, function, routes in profiler.hot_functions(limit=100, sort="calls")}
+        self.assertEqual(hot["{built-in method builtins.sorted}"], 3)
+        profiler.clear()
+        self.assertEqual(os.listdir(self.directory), [CONTROL_FILE])
+
+    def test_04_clear_servers(self):
+        #a clear reaches the servers, which drop their statistics instead of dumping them again
+        server, command = Profiler(self.directory, fraction=1, interval=0, dump_interval=0), Profiler(self.directory)
+        for call in range(2):
+            profile = server.begin()
+            sorted(random.random() for number in range(100))
+            server.end("/dash", profile)
+        command.clear()
+        self.assertEqual(command.routes(), [])
+        profile = server.begin()
+        sorted(random.random() for number in range(100))
+        server.end("/dash", profile)
+        hot = {function: calls for calls, seconds, cumulative, function, routes in server.hot_functions(limit=100, sort="calls")}
+        self.assertEqual(hot["{built-in method builtins.sorted}"], 1)
+        #a clear keeps the fraction, set or not
+        self.assertEqual(server.current_fraction(), 1)
+        command.set_fraction(.5)
+        command.clear()
+        self.assertEqual((server.current_fraction(), len(server.stats)), (.5, 0))
+
+
+class ProfiledHandlerTests(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return tornado.web.Application([(r'/api/?', ApiHome, dict(db=None))], cookie_secret="test")
+
+    def test_01_profiled_request(self):
+        directory, fraction = PROFILER.directory, PROFILER.fraction
+        PROFILER.directory, PROFILER.fraction = tempfile.mkdtemp(), 1
+        try:
+            self.assertEqual(self.fetch("/api").code, 200)
+            self.assertEqual(PROFILER.routes(), ["ApiHome"])
+        finally:
+            PROFILER.clear()
+            shutil.rmtree(PROFILER.directory)
+            PROFILER.directory, PROFILER.fraction = directory, fraction
+
+
+class QueryHeaderTests(tornado.testing.AsyncHTTPTestCase):
+
+    class Opinions(BaseApiHandler):
+        def get(self):
+            with self.db.session_scope() as session:
+                self.write(self.render_object([self.db.fetch_opinion(session, 1, item).rating for item in ITEMS]))
+
+    def get_app(self):
+        self.db = exampleDatabase()
+        self.db.queries.enabled, self.db.queries.threshold = True, len(ITEMS)
+        return tornado.web.Application([(r'/opinions', self.Opinions, dict(db=self.db))], cookie_secret="test")
+
+    def test_01_debug_headers(self):
+        with self.assertLogs("databases.queries", "WARNING"):
+            response = self.fetch("/opinions")
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers["X-Query-Count"].startswith("4 statements"))
+        self.assertTrue(response.headers["X-Query-Repeated"].startswith("4 x "))
+
+
+if __name__ == "__main__":
+    unittest.main()
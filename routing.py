@@ -25,21 +25,44 @@ from api.handlers.ApiUsers import ApiUsers
 from api.handlers.ApiUser import ApiUser
 from api.handlers.ApiToggleSocket import ApiToggleSocket
 from api.handlers.ApiAddCourse import ApiAddCourse
+from api.handlers.ApiMetrics import ApiMetrics
+from handlers.Profiler import PROFILER, SORTS
 
 from databases.database import Database
 
 from backend.Filter import Filter
+from backend.engines import ENGINES, createFilter
+from backend.Metrics import METRICS
 
 global_settings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
     "autoreload": True,
     "template_path": os.path.join(os.path.dirname(__file__), "templates"),
     "login_url": "/login",
-    "cookie_secret": "This is actually a secret cookie!986425&(!@"
+    "cookie_secret": "This is actually a secret cookie!986425&(!@",
+    # the engine that predicts opinions, "user" or "item" (see backend/engines.py)
+    "filter_engine": os.environ.get("FILTER_ENGINE", "user"),
+    # a snapshot directory the "user" engine warm starts from, written by `routing.py snapshot`
+    "filter_snapshot": os.environ.get("FILTER_SNAPSHOT"),
+    # when set, the "user" engine pushes changed opinions out on a background thread instead of during the request
+    "filter_write_behind": bool(os.environ.get("FILTER_WRITE_BEHIND")),
+    # when set, the engines count and time what they do, read at /api/metrics
+    "filter_metrics": bool(os.environ.get("FILTER_METRICS")),
+    # the fraction of requests profiled, changed while running with `routing.py profile fraction <fraction>`
+    "profile_fraction": float(os.environ.get("PROFILE_FRACTION", 0)),
+    # where each handler's aggregated profile is written, read by `routing.py profile`
+    "profile_directory": os.environ.get("PROFILE_DIRECTORY", os.path.join(os.path.dirname(__file__), "profiles")),
+    # when set, every request's sql statements are counted, logged and described in X-Query-* response headers
+    "debug_queries": bool(os.environ.get("DEBUG_QUERIES")),
     }
 
+METRICS.enabled = global_settings["filter_metrics"]
+PROFILER.directory = global_settings["profile_directory"]
+PROFILER.fraction = global_settings["profile_fraction"]
+
 # the gloabl database
 db = Database()
+db.queries.enabled = global_settings["debug_queries"]
 
 rating_filter = Filter(db, "rating")
 grade_filter = Filter(db, "grade")
@@ -52,6 +75,20 @@ filters = Filters()
 filters.rating = rating_filter
 filters.grade = grade_filter
 filters.difficulty = difficulty_filter
+filters.opinion = None  # created by create_opinion_filter
+filter_options = {"snapshot": global_settings["filter_snapshot"]} if global_settings["filter_snapshot"] else {}
+if global_settings["filter_write_behind"]:
+    filter_options["writeBehind"] = True
+
+
+def create_opinion_filter():
+    """
+    Loads the configured engine into filters.opinion, only the commands that
+        use it pay for reading every opinion
+    """
+    filters.opinion = createFilter(global_settings["filter_engine"], "CF.db", "data", "opinions", db=db, **filter_options)
+    return filters.opinion
+
 
 # a list of web routes and the objects to which they connect
 class_rank = Application([
@@ -105,6 +142,10 @@ class_rank = Application([
     (r'/api/toggle/?', ApiToggleSocket, dict(db=db)),  # websocket
     # Adds a course for a given user
     (r'/api/add_course/?', ApiAddCourse, dict(db=db)),  # websocket
+    # catches the following:
+    #     /api/metrics => json
+    #     /api/metrics?format=prometheus => prometheus text format
+    (r'/api/metrics/?', ApiMetrics, dict(db=db, metrics=METRICS)),
     (r'/api/?', ApiHome, dict(db=db)),
     # user/(#####) #maybe?
     # user/user_name
@@ -122,8 +163,13 @@ class_rank = Application([
 
 
 def runserver():
+    create_opinion_filter()
     class_rank.listen(int(os.environ.get("PORT", 5000)))
-    ioloop.IOLoop.instance().start()
+    try:
+        ioloop.IOLoop.instance().start()
+    finally:
+        # the profiles taken since the last periodic dump
+        PROFILER.dump()
 
 
 if __name__ == "__main__":
@@ -135,5 +181,43 @@ if __name__ == "__main__":
     if argv[1] == "admin":
         with db.session_scope() as session:
             db.update_user(session, argv[2], admin=True)
+    if argv[1] == "snapshot":
+        # computes every similarity and saves them, so servers started with FILTER_SNAPSHOT begin warm
+        engine = global_settings["filter_engine"]
+        if not hasattr(ENGINES.get(engine), "saveSnapshot"):
+            raise SystemExit("The {} engine has no snapshots, only the user engine does, set FILTER_ENGINE=user".format(engine))
+        create_opinion_filter().precomputeSimilarities()
+        print(filters.opinion.saveSnapshot(argv[2] if len(argv) > 2 else global_settings["filter_snapshot"]))
+    if argv[1] == "evaluate":
+        # holds out the probe set (or a random tenth) of a Netflix training_set folder and scores the configured engine
+        # evaluate <training_set> [probe] [warm] => warm precomputes every similarity before predicting
+        from backend.Evaluate import netflixOpinions, netflixProbe, splitOpinions, evaluate, report
+        warm = "warm" in argv[3:]
+        arguments = [argument for argument in argv[3:] if argument != "warm"]
+        probe = netflixProbe(arguments[0]) if arguments else None
+        train, holdout = splitOpinions(netflixOpinions(argv[2]), probe)
+        # a snapshot belongs to the site's database, not to the training opinions
+        report(evaluate(train, holdout, global_settings["filter_engine"], warm=warm,
+                        **{name: value for name, value in filter_options.items() if name != "snapshot"}))
+    if argv[1] == "profile":
+        # profile fraction <fraction> => changes how many requests running servers profile, 0 turns it off
+        # profile clear               => removes the profiles
+        # profile [limit] [sort]      => the hottest functions across every handler's profile, either or both in any order
+        if len(argv) > 3 and argv[2] == "fraction":
+            PROFILER.set_fraction(argv[3])
+        elif len(argv) > 2 and argv[2] == "clear":
+            PROFILER.clear()
+        else:
+            limit, sort = 20, "cumulative"
+            for argument in argv[2:4]:
+                if argument.isdigit():
+                    limit = int(argument)
+                elif argument in SORTS:
+                    sort = argument
+                else:
+                    raise SystemExit("Unknown limit or sort {}, expected a number or one of {}".format(argument, ", ".join(sorted(SORTS))))
+            print("{:>10} {:>10} {:>10}  {}".format("calls", "seconds", "cumulative", "function (handlers)"))
+            for calls, seconds, cumulative, function, routes in PROFILER.hot_functions(limit, sort):
+                print("{:>10} {:>10.4f} {:>10.4f}  {} ({})".format(calls, seconds, cumulative, function, ", ".join(routes)))
     if argv[1] == "filter_test":
         print(rating_filter.calculated_rating(4, 5))
\ No newline at end of file